@@ -0,0 +1,92 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Benchmark ms/alignment of img_archive.findTranslationOffsetGray on a
+sequence of PTZ images, comparing the full resolution ECC search from zero
+shift with the coarse-to-fine mode (phase correlation estimate on a
+downsampled pyramid level, then ECC refinement at full resolution).  Each
+image is aligned to the first image of the sequence, like fetchPriorAligned
+and genMovie do.  Also reports how many alignments agree between the modes.
+
+Without an image directory, it uses a synthetic 2048x1536 sequence with
+random shifts and noise.
+
+"""
+
+import os, sys
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import img_archive
+
+import logging
+import time
+import numpy as np
+import cv2
+
+
+def readSequence(imgDir):
+    fileNames = sorted([x for x in os.listdir(imgDir) if x.endswith('.jpg')])
+    return [cv2.cvtColor(cv2.imread(os.path.join(imgDir, x)), cv2.COLOR_BGR2GRAY) for x in fileNames]
+
+
+def syntheticSequence(numImages):
+    rng = np.random.default_rng(0)
+    (width, height, margin) = (2048, 1536, 32)
+    noise = rng.normal(0, 1, (height + 2*margin, width + 2*margin)).astype(np.float32)
+    # mix of fine and coarse texture
+    scene = sum([cv2.GaussianBlur(noise, (0, 0), sigma) * sigma for sigma in [2, 8, 32]])
+    scene = cv2.normalize(scene, None, 0, 255, cv2.NORM_MINMAX)
+    images = []
+    for i in range(numImages):
+        (dx, dy) = (0, 0) if i == 0 else (int(rng.integers(-15, 16)), int(rng.integers(-8, 9)))
+        img = scene[margin+dy:margin+dy+height, margin+dx:margin+dx+width]
+        img = img + rng.normal(0, 2, img.shape).astype(np.float32)
+        images.append(np.clip(img, 0, 255).astype(np.uint8))
+    return images
+
+
+def main():
+    optArgs = [
+        ["i", "imgDir", "(optional) directory with jpg images of one PTZ camera and heading (default synthetic images)"],
+        ["n", "numImages", "(optional) number of synthetic images (default 10)", int],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    images = readSequence(args.imgDir) if args.imgDir else syntheticSequence(args.numImages or 10)
+    if len(images) < 2:
+        logging.error('Need at least 2 images')
+        return
+    maxIterations = 40
+    terminationEps = 1e-6
+
+    results = {}
+    for coarseToFine in [False, True]:
+        results[coarseToFine] = []
+        startTime = time.time()
+        for img in images[1:]:
+            (alignable, dx, dy) = img_archive.findTranslationOffsetGray(images[0], img, maxIterations, terminationEps, coarseToFine)
+            results[coarseToFine].append((alignable, alignable and round(dx), alignable and round(dy)))
+        msPerAlignment = (time.time() - startTime) * 1000 / (len(images) - 1)
+        numAligned = len([x for x in results[coarseToFine] if x[0]])
+        logging.warning('coarseToFine %s: %.1f ms/alignment, aligned %d of %d', coarseToFine, msPerAlignment, numAligned, len(images) - 1)
+    numSame = len([1 for (a, b) in zip(results[False], results[True]) if a == b])
+    logging.warning('Same result in both modes: %d of %d', numSame, len(images) - 1)
+    for (a, b) in zip(results[False], results[True]):
+        if a != b:
+            logging.warning('Different: full %s, coarseToFine %s', a, b)
+
+
+if __name__=="__main__":
+    main()
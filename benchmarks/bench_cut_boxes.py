@@ -0,0 +1,83 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Micro-benchmark comparing the float32 cutBoxesArray path with the uint8
+cutBoxesArrayUint8 + normalizeCrops path.  Each mode runs in its own process
+so the reported peak RSS is not polluted by the other mode.
+
+"""
+
+import os, sys
+from firecam.lib import collect_args
+from firecam.lib import rect_to_squares
+
+import logging
+import multiprocessing
+import resource
+import time
+import numpy as np
+from PIL import Image
+
+
+def loadImage(imgPath):
+    if imgPath:
+        img = Image.open(imgPath)
+        img.load()
+        return img
+    # synthetic Mobotix sized frame
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, size=(2048, 3072, 3), dtype=np.uint8))
+
+
+def runMode(mode, imgPath, numFrames, resultQueue):
+    img = loadImage(imgPath)
+    baseRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cropsBuffer = None
+    normBuffer = None
+    startTime = time.time()
+    for i in range(numFrames):
+        if mode == 'float':
+            (crops, segments) = rect_to_squares.cutBoxesArray(img, 0, None, 50, -50)
+        else:
+            (cropsUint8, segments) = rect_to_squares.cutBoxesArrayUint8(img, 0, None, 50, -50, batchBuffer=cropsBuffer)
+            crops = rect_to_squares.normalizeCrops(cropsUint8, out=normBuffer)
+            (cropsBuffer, normBuffer) = (cropsUint8, crops)
+    msPerFrame = (time.time() - startTime) * 1000 / numFrames
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    resultQueue.put((mode, len(segments), msPerFrame, baseRss, peakRss))
+
+
+def main():
+    optArgs = [
+        ["i", "imgPath", "(optional) image to segment instead of synthetic 3072x2048 frame"],
+        ["n", "numFrames", "(optional) number of frames per mode (default 20)", int],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    numFrames = args.numFrames or 20
+
+    resultQueue = multiprocessing.Queue()
+    for mode in ['float', 'uint8']:
+        proc = multiprocessing.Process(target=runMode, args=(mode, args.imgPath, numFrames, resultQueue))
+        proc.start()
+        proc.join()
+        (mode, numSegments, msPerFrame, baseRss, peakRss) = resultQueue.get()
+        # ru_maxrss is in KB on linux
+        logging.warning('%s: segments=%d, ms/frame=%.1f, peakRSS=%.1f MB (+%.1f MB over decoded frame)',
+                        mode, numSegments, msPerFrame, peakRss/1024, (peakRss - baseRss)/1024)
+
+
+if __name__=="__main__":
+    main()
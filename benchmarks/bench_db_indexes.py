@@ -0,0 +1,144 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Benchmark ms/query and show the query plans of the hot detection queries
+(score_history query of _postFilter, fetchCurrentFromDB, isDuplicateDetection)
+without and with the secondary indexes declared in DbManager.
+
+Uses a temporary sqlite DB filled with synthetic rows unless postgres
+connection args are given (use a scratch DB since it drops the indexes and
+inserts rows).
+
+"""
+
+import os, sys
+from firecam.lib import collect_args
+from firecam.lib import db_manager
+from firecam.lib import score_history
+
+import logging
+import random
+import tempfile
+import time
+
+NUM_CAMERAS = 100
+NOW = 1600000000
+
+
+def fillTables(dbManager, numRows):
+    rng = random.Random(0)
+    dbManager.add_data('sources', [{'name': 'cam-%d' % i, 'locationID': 'loc-%d' % (i // 2)} for i in range(NUM_CAMERAS)])
+    historyRows = []
+    archiveRows = []
+    for i in range(numRows):
+        cameraName = 'cam-%d' % (i % NUM_CAMERAS)
+        timestamp = NOW - rng.randint(0, score_history.HISTORY_SECONDS)
+        historyRows.append({'CameraName': cameraName, 'Heading': (i // NUM_CAMERAS) % 4 * 90, 'ModelId': 'model/benchmark',
+                            'MinX': rng.randint(0, 9) * 250, 'MinY': 0, 'MaxX': 299, 'MaxY': 299,
+                            'Timestamp': timestamp // score_history.BUCKET_SECONDS * score_history.BUCKET_SECONDS,
+                            'Cnt': 15, 'AvgScore': rng.random() / 2, 'MaxScore': rng.random()})
+        archiveRows.append({'CameraId': cameraName, 'Heading': (i // NUM_CAMERAS) % 4 * 90,
+                            'Timestamp': NOW - rng.randint(0, 60*60), 'ImagePath': '/tmp/%d.jpg' % i,
+                            'FieldOfView': 110, 'Processed': 0})
+    dbManager.add_data('score_history', historyRows)
+    dbManager.add_data('archive', archiveRows)
+    dbManager.add_data('detections', [{'CameraName': 'cam-%d' % (i % NUM_CAMERAS), 'Timestamp': NOW - rng.randint(0, 30*24*60*60),
+                                       'FireHeading': rng.randint(0, 359), 'AngularWidth': 20, 'IsProto': 0}
+                                      for i in range(numRows // 10)])
+
+
+def getQueries():
+    cameraID = 'cam-7'
+    timestamp = NOW
+    # same SQL as ScoreHistoryCache._queryScores used by _postFilter
+    postFilterSql = """SELECT MinX,MinY,MaxX,MaxY,Timestamp/%s as bucket,sum(Cnt) as cnt, sum(Cnt*AvgScore) as sums, max(MaxScore) as maxs FROM score_history
+        WHERE CameraName='%s' and Heading>=%s and Heading<=%s and Timestamp >= %s and Timestamp < %s and ModelId='%s'
+        GROUP BY MinX,MinY,MaxX,MaxY,bucket""" % (score_history.BUCKET_SECONDS, cameraID, 89, 91,
+                                                   timestamp - score_history.HISTORY_SECONDS, timestamp - score_history.SETTLE_SECONDS, 'model/benchmark')
+    # same SQL as img_archive.fetchCurrentFromDB
+    fetchCurrentSql = """SELECT i.heading as heading, i.maxts as maxts, o.fieldofview as fov, o.imagepath as maxpath, o.processed as processed
+                       FROM archive o
+                       INNER JOIN (SELECT heading, max(timestamp) as maxts
+                                     FROM archive
+                                     WHERE CameraID='%s' and imagepath != '' and timestamp >= %s and timestamp <= %s
+                                     GROUP by heading) i
+                       ON o.heading=i.heading and o.timestamp=i.maxts
+                       WHERE o.CameraID='%s'
+                       ORDER by i.maxts""" % (cameraID, timestamp - 5*60, timestamp, cameraID)
+    # same SQL as detect_fire.isDuplicateDetection
+    duplicateSql = """SELECT fireheading, angularwidth, isproto FROM detections
+                        WHERE timestamp > %s and timestamp < %s and CameraName in (
+                            SELECT name FROM sources WHERE locationid = (SELECT locationid FROM sources WHERE name='%s')
+                            )""" % (timestamp - 2*60*60, timestamp, cameraID)
+    return [('_postFilter', postFilterSql), ('fetchCurrentFromDB', fetchCurrentSql), ('isDuplicateDetection', duplicateSql)]
+
+
+def getPlan(dbManager, sqlStr):
+    if dbManager.dbType == 'sqlite':
+        dbResult = dbManager.query('EXPLAIN QUERY PLAN ' + sqlStr)
+        return [dbRow['detail'] for dbRow in dbResult]
+    dbResult = dbManager.query('EXPLAIN ' + sqlStr)
+    return [list(dbRow.values())[0] for dbRow in dbResult]
+
+
+def timeQuery(dbManager, sqlStr, numQueries):
+    startTime = time.time()
+    for i in range(numQueries):
+        dbManager.query(sqlStr)
+    return (time.time() - startTime) * 1000 / numQueries
+
+
+def main():
+    optArgs = [
+        ["n", "numRows", "(optional) number of score_history and archive rows (default 200000)", int],
+        ["q", "numQueries", "(optional) number of times each query is timed (default 20)", int],
+        ["s", "psqlHost", "(optional) postgres host (default uses temporary sqlite DB)"],
+        ["b", "psqlDb", "(optional) postgres database"],
+        ["u", "psqlUser", "(optional) postgres user"],
+        ["p", "psqlPasswd", "(optional) postgres password"],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    numRows = args.numRows or 200000
+    numQueries = args.numQueries or 20
+
+    if args.psqlHost:
+        logging.warning('Note: benchmark drops indexes and inserts rows, so only use a scratch DB')
+        dbManager = db_manager.DbManager(psqlHost=args.psqlHost, psqlDb=args.psqlDb,
+                                         psqlUser=args.psqlUser, psqlPasswd=args.psqlPasswd, createIndexes=False)
+    else:
+        tmpDir = tempfile.TemporaryDirectory()
+        dbManager = db_manager.DbManager(sqliteFile=os.path.join(tmpDir.name, 'bench.db'), createIndexes=False)
+    for tableIndexes in dbManager.indexes.values():
+        for (indexName, columns) in tableIndexes:
+            dbManager.execute('DROP INDEX IF EXISTS %s' % indexName)
+    fillTables(dbManager, numRows)
+
+    queries = getQueries()
+    for mode in ['without indexes', 'with indexes']:
+        if mode == 'with indexes':
+            startTime = time.time()
+            dbManager.createIndexes()
+            logging.warning('Created indexes in %.1f seconds', time.time() - startTime)
+        dbManager.execute('ANALYZE')
+        for (name, sqlStr) in queries:
+            msPerQuery = timeQuery(dbManager, sqlStr, numQueries)
+            logging.warning('%s %s: %.2f ms/query', name, mode, msPerQuery)
+            for line in getPlan(dbManager, sqlStr):
+                logging.warning('    %s', line)
+
+
+if __name__=="__main__":
+    main()
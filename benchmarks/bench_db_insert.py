@@ -0,0 +1,115 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Benchmark rows/sec of inserting scores table rows (one add_data call per
+image, like InceptionV3AndHistoricalThreshold._recordScores) comparing the
+bound parameter DbManager.add_data with the previous implementation that
+formatted all values into the SQL text.
+
+Uses a temporary sqlite DB unless postgres connection args are given.
+
+"""
+
+import os, sys
+from firecam.lib import collect_args
+from firecam.lib import db_manager
+
+import logging
+import random
+import tempfile
+import time
+import numpy as np
+
+
+def addDataSqlText(dbManager, tableName, kvList, commit=True):
+    # previous add_data implementation: values formatted into SQL text with repr()
+    valuesList = []
+    firstKeys = [key for (key,_) in kvList[0].items()]
+    for kvEntry in kvList:
+        rowData = ", ".join(repr(val) for (_, val) in kvEntry.items())
+        valuesList.append('(%s)' % rowData)
+    sql_template = 'insert into {table_name} ({fields}) values {values}'
+    db_command = sql_template.format(
+        table_name = tableName,
+        fields = ", ".join(firstKeys),
+        values = ', '.join(valuesList)
+    )
+    dbManager.execute(db_command, commit=commit)
+
+
+def genImageRows(imageNum, rowsPerImage):
+    timestamp = 1600000000 + imageNum * 60
+    dbRows = []
+    for i in range(rowsPerImage):
+        dbRows.append({
+            'CameraName': 'cam-%d' % (imageNum % 50),
+            'Heading': 90,
+            'Timestamp': timestamp,
+            'MinX': (i % 10) * 250,
+            'MinY': (i // 10) * 250,
+            'MaxX': (i % 10) * 250 + 299,
+            'MaxY': (i // 10) * 250 + 299,
+            'Score': random.random(), # python float so legacy repr() formatting also works
+            'MinusMinutes': 0,
+            'SecondsInDay': timestamp % 86400,
+            'ModelId': 'model/benchmark'
+        })
+    return dbRows
+
+
+def runMode(dbManager, addFn, numImages, rowsPerImage):
+    images = [genImageRows(i, rowsPerImage) for i in range(numImages)]
+    dbManager.execute('DELETE FROM scores')
+    startTime = time.time()
+    for dbRows in images:
+        addFn(dbManager, 'scores', dbRows)
+    elapsed = time.time() - startTime
+    return numImages * rowsPerImage / elapsed
+
+
+def main():
+    optArgs = [
+        ["n", "numImages", "(optional) number of images (add_data calls) per mode (default 1000)", int],
+        ["r", "rowsPerImage", "(optional) score rows per image (default 60)", int],
+        ["s", "psqlHost", "(optional) postgres host (default uses temporary sqlite DB)"],
+        ["b", "psqlDb", "(optional) postgres database"],
+        ["u", "psqlUser", "(optional) postgres user"],
+        ["p", "psqlPasswd", "(optional) postgres password"],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    numImages = args.numImages or 1000
+    rowsPerImage = args.rowsPerImage or 60
+
+    if args.psqlHost:
+        logging.warning('Note: benchmark deletes all rows in scores table')
+        dbManager = db_manager.DbManager(psqlHost=args.psqlHost, psqlDb=args.psqlDb,
+                                         psqlUser=args.psqlUser, psqlPasswd=args.psqlPasswd)
+    else:
+        tmpDir = tempfile.TemporaryDirectory()
+        dbManager = db_manager.DbManager(sqliteFile=os.path.join(tmpDir.name, 'bench.db'))
+
+    modes = [
+        ('sql text', addDataSqlText),
+        ('bound params', db_manager.DbManager.add_data),
+    ]
+    for (name, addFn) in modes:
+        rowsPerSec = runMode(dbManager, addFn, numImages, rowsPerImage)
+        logging.warning('%s: %d images x %d rows: %.0f rows/sec', name, numImages, rowsPerImage, rowsPerSec)
+    dbManager.execute('DELETE FROM scores')
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,124 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Benchmark ms/frame of img_archive.diffWithChecks (numpy/cv2 uint8 version)
+comparing with the previous Pillow ImageMath/ImageStat based version, and
+check the outputs are pixel identical.
+
+"""
+
+import os, sys
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import img_archive
+
+import logging
+import time
+import numpy as np
+import cv2
+from PIL import Image, ImageMath, ImageStat
+
+# ImageMath.eval was renamed to unsafe_eval in newer Pillow versions
+imageMathEval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+
+def diffImagesPillow(imgA, imgB):
+    # previous diffImages implementation
+    bandsImgA = imgA.split()
+    bandsImgB = imgB.split()
+    absDiff = imageMathEval("convert(abs(a0-b0) + abs(a1-b1) + abs(a2-b2), 'L')",
+        a0 = bandsImgA[0], b0 = bandsImgB[0],
+        a1 = bandsImgA[1], b1 = bandsImgB[1],
+        a2 = bandsImgA[2], b2 = bandsImgB[2])
+    bandsImgOut = [
+        imageMathEval("convert(a + 2*diff, 'L')", a = bandsImgA[0], diff = absDiff),
+        imageMathEval("convert(a - diff, 'L')", a = bandsImgA[1], diff = absDiff),
+        imageMathEval("convert(a - diff, 'L')", a = bandsImgA[2], diff = absDiff),
+    ]
+    return Image.merge('RGB', bandsImgOut)
+
+
+def smoothImagePillow(img):
+    # previous smoothImage implementation
+    imgBGR = cv2.cvtColor(np.asarray(img), cv2.COLOR_BGR2RGB)
+    smoothImgBGR = cv2.bilateralFilter(imgBGR, 9, 75, 75)
+    smoothImgRGB = cv2.cvtColor(smoothImgBGR, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(smoothImgRGB)
+
+
+def brightnessPillow(img):
+    medians = ImageStat.Stat(img).median
+    brightness = (medians[0] + medians[1] + medians[2]) / 3
+    return max(brightness, .01)
+
+
+def diffWithChecksPillow(baseImg, earlierImg):
+    # previous diffWithChecks implementation
+    brightnessRatio = brightnessPillow(baseImg)/brightnessPillow(earlierImg)
+    if (brightnessRatio < 0.92) or (brightnessRatio > 1.08):
+        return None
+    diffImg = diffImagesPillow(smoothImagePillow(baseImg), smoothImagePillow(earlierImg))
+    extremas = diffImg.getextrema()
+    if (extremas[0][0] == 128 and extremas[0][1] == 128) or (extremas[1][0] == 128 and extremas[1][1] == 128) or (extremas[2][0] == 128 and extremas[2][1] == 128):
+        return None
+    return diffImg
+
+
+def loadImages(imgPathA, imgPathB):
+    if imgPathA and imgPathB:
+        return (Image.open(imgPathA).convert('RGB'), Image.open(imgPathB).convert('RGB'))
+    # synthetic Mobotix sized frames with a changed region
+    rng = np.random.default_rng(0)
+    arrA = rng.integers(0, 256, size=(2048, 3072, 3), dtype=np.uint8)
+    arrB = arrA.copy()
+    arrB[800:1200, 1000:1600] = rng.integers(0, 256, size=(400, 600, 3), dtype=np.uint8)
+    return (Image.fromarray(arrA), Image.fromarray(arrB))
+
+
+def timeFn(fn, numFrames):
+    startTime = time.time()
+    for i in range(numFrames):
+        result = fn()
+    return (result, (time.time() - startTime) * 1000 / numFrames)
+
+
+def main():
+    optArgs = [
+        ["a", "imgPathA", "(optional) base image (default synthetic 3072x2048 frames)"],
+        ["b", "imgPathB", "(optional) earlier image aligned with base image"],
+        ["n", "numFrames", "(optional) number of frames per mode (default 10)", int],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    numFrames = args.numFrames or 10
+    (imgA, imgB) = loadImages(args.imgPathA, args.imgPathB)
+
+    modes = [
+        ('diffImages', lambda: diffImagesPillow(imgA, imgB), lambda: img_archive.diffImages(imgA, imgB)),
+        ('smoothImage', lambda: smoothImagePillow(imgA), lambda: img_archive.smoothImage(imgA)),
+        ('diffWithChecks', lambda: diffWithChecksPillow(imgA, imgB), lambda: img_archive.diffWithChecks(imgA, imgB)),
+    ]
+    for (name, oldFn, newFn) in modes:
+        (oldResult, oldMs) = timeFn(oldFn, numFrames)
+        (newResult, newMs) = timeFn(newFn, numFrames)
+        if (oldResult == None) or (newResult == None):
+            identical = (oldResult == None) and (newResult == None)
+        else:
+            identical = np.array_equal(np.asarray(oldResult), np.asarray(newResult))
+        logging.warning('%s: pillow %.1f ms/frame, numpy %.1f ms/frame, identical %s', name, oldMs, newMs, identical)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,125 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Compare the previous archiver sweeps (cameras assigned round-robin to threads
+that are all joined each sweep) with fetch_scheduler, using simulated fetches
+with time scaled down 100x.  Rotating cameras are due every 13s and fixed
+cameras every 60s, and a few cameras are slow.  Reports the mean and max
+lateness of fetches vs when they were due, and worker utilization.
+
+"""
+
+import os, sys
+from firecam.lib import collect_args
+from firecam.lib import fetch_scheduler
+
+import logging
+import random
+import threading
+import time
+
+TIME_SCALE = 0.01
+INTERVAL_ROTATE = 13 * TIME_SCALE
+INTERVAL_FIXED = 60 * TIME_SCALE
+
+
+def getCameras(numCameras):
+    rng = random.Random(0)
+    cameras = {}
+    for i in range(numCameras):
+        fetchSeconds = rng.uniform(0.5, 2) * TIME_SCALE
+        if i % 50 == 0:
+            fetchSeconds = 15 * TIME_SCALE # slow camera
+        cameras['cam%d' % i] = {'interval': INTERVAL_ROTATE if i % 3 == 0 else INTERVAL_FIXED, 'fetchSeconds': fetchSeconds}
+    return cameras
+
+
+def summarize(name, lateness, busySeconds, elapsed):
+    allLateness = [x for values in lateness.values() for x in values]
+    logging.warning('%s: %d fetches, lateness mean %.1fs max %.1fs, utilization %.2f', name, len(allLateness),
+                    sum(allLateness) / len(allLateness) / TIME_SCALE, max(allLateness) / TIME_SCALE,
+                    busySeconds / elapsed / NUM_THREADS)
+
+
+def runSweeps(cameras, duration):
+    # previous archiver: every sweep queue due cameras round-robin to threads, then join all threads
+    lastFetch = {name: 0 for name in cameras}
+    lateness = {name: [] for name in cameras}
+    busy = [0]
+    lock = threading.Lock()
+    def threadFn(names):
+        for name in names:
+            startTime = time.time()
+            with lock:
+                lateness[name].append(max(startTime - (lastFetch[name] + cameras[name]['interval']), 0) if lastFetch[name] else 0)
+            time.sleep(cameras[name]['fetchSeconds'])
+            with lock:
+                lastFetch[name] = time.time()
+                busy[0] += time.time() - startTime
+    startTime = time.time()
+    while time.time() - startTime < duration:
+        sweepStart = time.time()
+        threadParams = [[] for i in range(NUM_THREADS)]
+        nextThread = 0
+        for name in cameras:
+            if lastFetch[name] < time.time() - cameras[name]['interval']:
+                threadParams[nextThread].append(name)
+                nextThread = (nextThread + 1) % NUM_THREADS
+        threads = [threading.Thread(target=threadFn, args=(x,)) for x in threadParams]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sweepTime = time.time() - sweepStart
+        if sweepTime < INTERVAL_ROTATE:
+            time.sleep(INTERVAL_ROTATE - sweepTime)
+    summarize('sweeps', lateness, busy[0], time.time() - startTime)
+
+
+def runScheduler(cameras, duration):
+    def taskFn(name):
+        time.sleep(cameras[name]['fetchSeconds'])
+        return cameras[name]['interval']
+    scheduler = fetch_scheduler.FetchScheduler(taskFn, NUM_THREADS)
+    for name in cameras:
+        scheduler.add(name)
+    scheduler.start()
+    time.sleep(duration)
+    scheduler.stop()
+    stats = scheduler.getStats()
+    logging.warning('scheduler: %d fetches, lateness mean %.1fs max %.1fs, utilization %.2f', stats['tasks'],
+                    stats['meanLateness'] / TIME_SCALE, stats['maxLateness'] / TIME_SCALE,
+                    sum(stats['utilization']) / NUM_THREADS)
+
+
+NUM_THREADS = 12
+def main():
+    global NUM_THREADS
+    optArgs = [
+        ["c", "numCameras", "(optional) number of cameras (default 200)", int],
+        ["t", "numThreads", "(optional) number of fetch threads (default 12)", int],
+        ["s", "seconds", "(optional) seconds to run each method (default 10)", int],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    NUM_THREADS = args.numThreads or NUM_THREADS
+    cameras = getCameras(args.numCameras or 200)
+    duration = args.seconds or 10
+    runSweeps(cameras, duration)
+    runScheduler(cameras, duration)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,139 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Benchmark the cycle time of archiver style fetch sweeps (every camera fetched
+by a pool of threads) using urllib.request.urlretrieve vs http_fetcher.
+
+A local server stands in for the cameras, serving canned JPEGs with ETags.
+Each new connection is delayed to simulate the TCP+TLS handshake of remote
+cameras, and a fraction of the cameras change their image between sweeps.
+
+"""
+
+import os, sys
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import http_fetcher
+
+import logging
+import random
+import tempfile
+import threading
+import time
+import http.server
+import urllib.request
+
+
+class CameraHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.server.handshakeDelay)
+        with self.server.lock:
+            self.server.numConnections += 1
+
+    def do_GET(self):
+        (etag, body) = self.server.images[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def startServer(numCameras, imageKB, handshakeDelay):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), CameraHandler)
+    server.daemon_threads = True
+    server.handshakeDelay = handshakeDelay
+    server.numConnections = 0
+    server.lock = threading.Lock()
+    body = b'\xff\xd8' + os.urandom(imageKB * 1024)
+    server.images = {'/cam%d.jpg' % i: ('"0"', body) for i in range(numCameras)}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def changeImages(server, changeFraction, sweep):
+    for path in server.images:
+        if random.random() < changeFraction:
+            server.images[path] = ('"%d"' % sweep, server.images[path][1])
+
+
+def runSweep(urls, outDir, numThreads, fetchFn):
+    nextIndex = [0]
+    lock = threading.Lock()
+    def threadFn():
+        while True:
+            with lock:
+                index = nextIndex[0]
+                nextIndex[0] += 1
+            if index >= len(urls):
+                return
+            fetchFn(urls[index], os.path.join(outDir, 'cam%d.jpg' % index))
+    threads = [threading.Thread(target=threadFn) for i in range(numThreads)]
+    startTime = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - startTime
+
+
+def main():
+    optArgs = [
+        ["c", "numCameras", "(optional) number of cameras (default 200)", int],
+        ["t", "numThreads", "(optional) number of fetch threads (default 16)", int],
+        ["s", "numSweeps", "(optional) number of sweeps (default 5)", int],
+        ["k", "imageKB", "(optional) image size in KB (default 300)", int],
+        ["l", "handshakeMs", "(optional) simulated connection setup ms (default 50)", int],
+        ["f", "changeFraction", "(optional) fraction of cameras with new image each sweep (default 0.8)", float],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    numCameras = args.numCameras or 200
+    numThreads = args.numThreads or 16
+    numSweeps = args.numSweeps or 5
+    handshakeMs = args.handshakeMs if args.handshakeMs != None else 50
+    changeFraction = args.changeFraction if args.changeFraction != None else 0.8
+    random.seed(0)
+    server = startServer(numCameras, args.imageKB or 300, handshakeMs / 1000)
+    urls = ['http://127.0.0.1:%d%s' % (server.server_address[1], path) for path in server.images]
+    outDir = tempfile.TemporaryDirectory()
+
+    fetcher = http_fetcher.HttpFetcher(connectionsPerHost=numThreads)
+    for (name, fetchFn) in [('urlretrieve', urllib.request.urlretrieve), ('http_fetcher', fetcher.fetch)]:
+        server.numConnections = 0
+        sweepTimes = []
+        for sweep in range(numSweeps):
+            changeImages(server, changeFraction, sweep + 1)
+            sweepTimes.append(runSweep(urls, outDir.name, numThreads, fetchFn))
+        logging.warning('%s: cycle time per sweep %s seconds, connections %d', name,
+                        ' '.join(['%.2f' % x for x in sweepTimes]), server.numConnections)
+    logging.warning('http_fetcher stats %s', fetcher.stats)
+    server.shutdown()
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,82 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Parity and latency benchmark of the tf_helper inference backends against
+keras model.predict() (tf_helper.loadModel).  Reports the max score
+difference vs. keras and median milliseconds per classification call for
+small (checkShifts re-scan) and full image batch sizes.
+
+"""
+
+import os, sys
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # quiet down tensorflow logging (must be done before tf_helper)
+from firecam.lib import collect_args
+from firecam.lib import tf_helper
+
+import logging
+import time
+import numpy as np
+
+
+def timeCalls(model, crops, numIterations):
+    segments = [{} for i in range(len(crops))]
+    tf_helper.classifySegments(model, crops, segments) # warmup
+    times = []
+    for i in range(numIterations):
+        startTime = time.time()
+        tf_helper.classifySegments(model, crops, segments)
+        times.append(time.time() - startTime)
+    return (np.array([x['score'] for x in segments]), np.median(times) * 1000)
+
+
+def main():
+    reqArgs = [
+        ["m", "model", "keras model directory (local or GCS)"],
+    ]
+    optArgs = [
+        ["t", "tflitePath", "(optional) converted .tflite model"],
+        ["x", "onnxPath", "(optional) converted .onnx model"],
+        ["b", "batchSizes", "(optional) comma separated batch sizes (default 4,96)"],
+        ["n", "numIterations", "(optional) number of timed calls per batch size (default 10)", int],
+        ["p", "numThreads", "(optional) number of threads for tflite and onnx", int],
+    ]
+    args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs)
+    batchSizes = [int(x) for x in (args.batchSizes or '4,96').split(',')]
+    numIterations = args.numIterations or 10
+
+    kerasModel = tf_helper.loadModel(args.model)
+    models = [
+        ('keras', kerasModel),
+        ('tf_function', tf_helper.TfFunctionModel(kerasModel)),
+    ]
+    if args.tflitePath:
+        models.append(('tflite', tf_helper.loadInferenceModel(args.tflitePath, numThreads=args.numThreads, useServer=False)))
+    if args.onnxPath:
+        models.append(('onnx', tf_helper.loadInferenceModel(args.onnxPath, numThreads=args.numThreads, useServer=False)))
+
+    rng = np.random.default_rng(0)
+    for batchSize in batchSizes:
+        crops = rng.integers(0, 256, size=(batchSize, 299, 299, 3), dtype=np.uint8)
+        crops = (crops.astype(np.float32) - 128) / 128
+        (kerasScores, x) = timeCalls(kerasModel, crops, 1)
+        for (name, model) in models:
+            (scores, msPerCall) = timeCalls(model, crops, numIterations)
+            maxDiff = np.max(np.abs(scores - kerasScores))
+            logging.warning('batch %d, %s: %.1f ms/call, max score diff %.2e', batchSize, name, msPerCall, maxDiff)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,133 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Benchmark us/name of img_archive.parseFilename over a directory listing,
+comparing with the previous regex + dateutil based version, and check the
+results are identical.  Also times the memoized repeat parse of recent names
+and the parseFilenames batch API.
+
+Without a directory, it uses 500k synthetic names from 200 cameras.
+
+"""
+
+import os, sys
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import img_archive
+
+import logging
+import time
+import random
+import re
+import datetime, dateutil.parser
+
+
+def parseFilenameDateutil(fileName):
+    # previous parseFilename implementation
+    regexExpanded = r'([A-Za-z0-9-_]+[^_])_+(\d{4}-\d\d-\d\d)T(\d\d)[_;](\d\d)[_;](\d\d)'
+    regexDiff = r'(_Diff(\d+))?'
+    regexOptionalCrop = r'(_Crop_(-?\d+)x(-?\d+)x(\d+)x(\d+))?'
+    matchesExp = re.findall(regexExpanded + regexDiff + regexOptionalCrop, fileName)
+    regexUnixTime = r'(1\d{9})'
+    matchesUnix = re.findall(regexUnixTime + regexDiff + regexOptionalCrop, fileName)
+    cropInfo = None
+    if len(matchesExp) == 1:
+        match = matchesExp[0]
+        parsed = {
+            'cameraID': match[0],
+            'date': match[1],
+            'hours': match[2],
+            'minutes': match[3],
+            'seconds': match[4]
+        }
+        isoStr = '{date}T{hour}:{min}:{sec}'.format(date=parsed['date'],hour=parsed['hours'],min=parsed['minutes'],sec=parsed['seconds'])
+        dt = dateutil.parser.parse(isoStr)
+        unixTime = int(dt.timestamp())
+        parsed['diffMinutes'] = int(match[6] or 0)
+        cropInfo = match[-4:]
+    elif len(matchesUnix) == 1:
+        match = matchesUnix[0]
+        unixTime = int(match[0])
+        dt = datetime.datetime.fromtimestamp(unixTime)
+        isoStr = datetime.datetime.fromtimestamp(unixTime).isoformat()
+        parsed = {
+            'cameraID': 'UNKNOWN_' + fileName,
+            'date': dt.date().isoformat(),
+            'hours': str(dt.hour),
+            'minutes': str(dt.minute),
+            'seconds': str(dt.second)
+        }
+        parsed['diffMinutes'] = int(match[2] or 0)
+        cropInfo = match[-4:]
+    else:
+        return None
+    if cropInfo[0]:
+        parsed['minX'] = int(cropInfo[0])
+        parsed['minY'] = int(cropInfo[1])
+        parsed['maxX'] = int(cropInfo[2])
+        parsed['maxY'] = int(cropInfo[3])
+    parsed['isoStr'] = isoStr
+    parsed['unixTime'] = int(unixTime)
+    return parsed
+
+
+def syntheticNames(numNames):
+    rng = random.Random(0)
+    startTime = int(time.time()) - 30*24*3600
+    names = []
+    for i in range(numNames):
+        cameraID = 'cam%03d-n-mobo-c' % (i % 200)
+        timestamp = startTime + (i // 200) * 60 + rng.randint(0, 59)
+        names.append(os.path.basename(img_archive.getImgPath('', cameraID, timestamp)))
+    return names
+
+
+def timeFn(fn, names):
+    startTime = time.time()
+    result = fn(names)
+    return (result, (time.time() - startTime) * 1000000 / len(names))
+
+
+def main():
+    optArgs = [
+        ["d", "imgDir", "(optional) directory of images to list (default synthetic names)"],
+        ["n", "numNames", "(optional) number of synthetic names (default 500000)", int],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    if args.imgDir:
+        names = [x for x in os.listdir(args.imgDir) if x.endswith('.jpg')]
+    else:
+        names = syntheticNames(args.numNames or 500000)
+    logging.warning('Parsing %d names', len(names))
+
+    (oldResult, oldUs) = timeFn(lambda x: [parseFilenameDateutil(name) for name in x], names)
+    img_archive._parseFilenameCached.cache_clear()
+    img_archive._getLocalHourStart.cache_clear()
+    (newResult, newUs) = timeFn(lambda x: [img_archive.parseFilename(name) for name in x], names)
+    # repeat parse of recent names (memo holds the most recent 100k names)
+    (cachedResult, cachedUs) = timeFn(lambda x: [img_archive.parseFilename(name) for name in x], names[-50000:])
+    img_archive._parseFilenameCached.cache_clear()
+    ((cameraIDs, cameraCodes, unixTimes), batchUs) = timeFn(img_archive.parseFilenames, names)
+
+    batchTimes = [parsed['unixTime'] if parsed else 0 for parsed in oldResult]
+    logging.warning('dateutil %.2f us/name, direct %.2f us/name, memoized %.2f us/name, batch %.2f us/name',
+                    oldUs, newUs, cachedUs, batchUs)
+    logging.warning('identical %s, batch identical %s, cameras %d', oldResult == newResult,
+                    batchTimes == unixTimes.tolist(), len(cameraIDs))
+
+
+if __name__=="__main__":
+    main()
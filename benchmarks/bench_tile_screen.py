@@ -0,0 +1,131 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Recall regression benchmark for the cascade pre-screen (tile_screen) on the
+2019a dataset smoke images and bounding boxes (datasets/2019a).  Download and
+unzip the full smoke images from the link in datasets/2019a/README.md.
+
+Images of each camera are run in timestamp order through a TileScreen for
+each threshold.  Smoke segments are the ones covering at least half of the
+bounding box (or half of the segment for large boxes).  For each threshold
+it reports the skip rate, the fraction of smoke images where a smoke segment
+was sent to the model, and the fraction where a smoke segment was either
+sent to the model or reused a score from a classification that already had
+smoke in it (i.e., the model saw the smoke).
+
+"""
+
+import os, sys
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import img_archive
+from firecam.lib import rect_to_squares
+from firecam.lib import tile_screen
+
+import csv
+import logging
+import time
+import numpy as np
+from PIL import Image
+
+
+def readBoundingBoxes(csvPath, imgDir):
+    """Return dict mapping camera ID to list of (timestamp, imgPath, bbox) sorted by timestamp
+    """
+    cameras = {}
+    with open(csvPath) as csvFile:
+        for row in csv.DictReader(csvFile):
+            imgPath = os.path.join(imgDir, row['Filename'])
+            if not os.path.isfile(imgPath):
+                continue
+            parsed = img_archive.parseFilename(row['Filename'])
+            bbox = (int(row['MinX']), int(row['MinY']), int(row['MaxX']), int(row['MaxY']))
+            cameras.setdefault(parsed['cameraID'], []).append((parsed['unixTime'], imgPath, bbox))
+    for images in cameras.values():
+        images.sort()
+    return cameras
+
+
+def getSmokeSegments(segments, bbox):
+    """Return the indexes of segments that cover at least half the bbox (or half the segment)
+    """
+    bboxArea = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    smoke = []
+    for (i, segmentInfo) in enumerate(segments):
+        (minX, minY, maxX, maxY) = segmentInfo['coords']
+        overlapX = min(maxX, bbox[2]) - max(minX, bbox[0])
+        overlapY = min(maxY, bbox[3]) - max(minY, bbox[1])
+        if (overlapX <= 0) or (overlapY <= 0):
+            continue
+        segmentArea = (maxX - minX) * (maxY - minY)
+        if overlapX * overlapY >= 0.5 * min(bboxArea, segmentArea):
+            smoke.append(i)
+    return smoke
+
+
+def main():
+    reqArgs = [
+        ["i", "imgDir", "directory with the unzipped 2019a full smoke images"],
+    ]
+    optArgs = [
+        ["c", "csvPath", "(optional) bounding boxes csv (default datasets/2019a/2019a-bounding-boxes.csv)"],
+        ["t", "thresholds", "(optional) comma separated list of thresholds (default 4,6,8,12,16)"],
+        ["a", "maxAge", "(optional) max seconds between classifications of a segment (default 600)", int],
+    ]
+    args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs)
+    csvPath = args.csvPath or os.path.join(os.path.dirname(__file__), '..', 'datasets', '2019a', '2019a-bounding-boxes.csv')
+    thresholds = [float(x) for x in (args.thresholds or '4,6,8,12,16').split(',')]
+    maxAge = args.maxAge or tile_screen.DEFAULT_MAX_AGE
+
+    cameras = readBoundingBoxes(csvPath, args.imgDir)
+    numImages = sum([len(images) for images in cameras.values()])
+    logging.warning('Found %d images from %d cameras', numImages, len(cameras))
+    if numImages == 0:
+        return
+
+    screens = [tile_screen.TileScreen(threshold, maxAge) for threshold in thresholds]
+    results = [{'classified': 0, 'covered': 0, 'selectMs': 0} for threshold in thresholds]
+    # whether the last classification of each (screen, camera, segment) had smoke in it
+    classifiedSmoke = [{} for threshold in thresholds]
+    cropsBuffer = None
+    for (cameraID, images) in cameras.items():
+        for (timestamp, imgPath, bbox) in images:
+            img = Image.open(imgPath)
+            crops, segments = rect_to_squares.cutBoxesArrayUint8(img, batchBuffer=cropsBuffer)
+            img.close()
+            cropsBuffer = crops if (cropsBuffer is None) or (len(crops) > len(cropsBuffer)) else cropsBuffer
+            smokeSegments = getSmokeSegments(segments, bbox)
+            for (screen, result, smokeState) in zip(screens, results, classifiedSmoke):
+                startTime = time.time()
+                (indexes, pending) = screen.select(cameraID, 0, timestamp, crops, segments)
+                result['selectMs'] += (time.time() - startTime) * 1000
+                for i in indexes:
+                    segments[i]['score'] = 0
+                    smokeState[(cameraID, segments[i]['coords'])] = i in smokeSegments
+                screen.update(pending, segments)
+                if set(smokeSegments) & set(indexes):
+                    result['classified'] += 1
+                if any([smokeState.get((cameraID, segments[i]['coords'])) for i in smokeSegments]):
+                    result['covered'] += 1
+
+    for (threshold, screen, result) in zip(thresholds, screens, results):
+        logging.warning('threshold %.1f: skip rate %.3f, smoke classified %.3f, smoke covered %.3f, select ms/image %.1f',
+                        threshold, screen.getSkipRate(), result['classified'] / numImages,
+                        result['covered'] / numImages, result['selectMs'] / numImages)
+
+
+if __name__=="__main__":
+    main()
@@ -25,35 +25,17 @@ from firecam.lib import collect_args
 from firecam.lib import goog_helper
 from firecam.lib import img_archive
 from firecam.lib import db_manager
+from firecam.lib import fetch_scheduler
+from firecam.lib import http_fetcher
+from firecam.lib import score_history
 
 import time, datetime, dateutil.parser
 import random
 import logging
-import threading
 from google.cloud import compute_v1
 
-def getSpinFetchInfo(dbManager, cameraInfo, timestamp):
-    # check DB for last 3 entries from this camera
-    # if all three have same heading, spinning is False
-    sqlTemplate = """SELECT heading,timestamp FROM archive
-        where CameraID='%s' and timestamp > %s order by timestamp desc limit 3"""
-    sqlStr = sqlTemplate % (cameraInfo['name'], timestamp - 60*60)
-    dbResult = dbManager.query(sqlStr)
-    # logging.warning('arch dbR %s: %s', len(dbResult), dbResult)
-    if len(dbResult) == 0:
-        return (False, 0)
-    rot = False
-    topHeading = dbResult[0]['heading']
-    for entry in dbResult:
-        if abs(entry['heading'] - topHeading) % 360 > 1: # allow 1 degree difference
-            rot = True
-            break
-    fetchTime = dbResult[0]['timestamp']
-    return (rot, fetchTime)
-
-
 def fetchImage(dbManager, cameraInfo, lastFetchTime, dirName, latestCamInfo):
-    # fetch image to given path
+    # fetch image to given path, and return the archive DB row added (or None)
     imgPath = None
     heading = None
     timestamp = None
@@ -61,15 +43,15 @@ def fetchImage(dbManager, cameraInfo, lastFetchTime, dirName, latestCamInfo):
         imgInfo = img_archive.fetchImageAndMeta(dbManager, cameraInfo['name'], cameraInfo['url'], dirName, newOnly=True, latestCamInfo=latestCamInfo)
         (imgPath, heading, timestamp, fov) = imgInfo
         if not imgPath:
-            logging.error('No image path for %s', cameraInfo['name'])
-            return
+            # image unchanged since last fetch (or invalid image already logged by img_archive)
+            return None
     except Exception as e:
         logging.error('Error fetching image from %s %s', cameraInfo['name'], str(e))
-        return
+        return None
     if lastFetchTime == timestamp:
         # XXX should current timestamp be stored to indicate last time it was checked?
         # XXX filename should be same, so no need to delete
-        return
+        return None
     dbRow = {
         'CameraId': cameraInfo['name'],
         'Heading': round(heading) % 360,
@@ -87,7 +69,7 @@ def fetchImage(dbManager, cameraInfo, lastFetchTime, dirName, latestCamInfo):
         dbRow['FieldOfView'] = 0
     # update DB
     dbManager.add_data('archive', dbRow)
-    return
+    return dbRow
 
 
 DELETE_CHECK_INTERVAL = 2*60  # 2 minutes
@@ -267,9 +249,17 @@ def deleteOldSqlEntries(dbManager, tableName, firstTimestamp):
     dbManager.execute(sqlStr)
 
 
+def foldScores(dbManager):
+    # add today's scores to score_history rollup table used by historical threshold filter
+    score_history.foldScores(dbManager, int(time.time()))
+
+
 def deleteOldScores(dbManager):
-    firstTimestamp = int(time.time()-3600*24*7*3) # 3 weeks
+    # raw scores are only needed until they are folded into score_history
+    firstTimestamp = int(time.time()-3600*24*3) # 3 days
     deleteOldSqlEntries(dbManager, 'scores', firstTimestamp)
+    firstTimestamp = int(time.time()-3600*24*7*3) # 3 weeks
+    deleteOldSqlEntries(dbManager, 'score_history', firstTimestamp)
     # vacuum and reindex code is here (in case needed in future) but disabled for now
     # System already uses autovacuum, so manual vacuum should not be needed
     # Also scores table should not need daily reindex
@@ -305,6 +295,7 @@ def checkDailyPostWork(dbManager, archiveDir):
     logging.warning('checkDailyPostWork %s, %s, %s', postWorkActive and not checkDailyPostWork.prevActive, postWorkActive, checkDailyPostWork.prevActive)
     if postWorkActive and not checkDailyPostWork.prevActive:
         updateStats(dbManager)
+        foldScores(dbManager)
         deleteOldScores(dbManager)
         deleteOldMultiPolicy(dbManager)
         deleteOldFiles(dbManager)
@@ -326,26 +317,61 @@ def main():
     ]
     args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs, parentParsers=[goog_helper.getParentParser()])
     stateless = True if args.noState else False
+    # fetch threads and main thread share the DbManager, so give them pooled connections
+    poolSize = getattr(settings, 'dbPoolSize', None) or (args.numThreads + 1)
     dbManager = db_manager.DbManager(sqliteFile=settings.db_file,
                                     psqlHost=settings.psqlHost, psqlDb=settings.psqlDb,
-                                    psqlUser=settings.psqlUser, psqlPasswd=settings.psqlPasswd)
+                                    psqlUser=settings.psqlUser, psqlPasswd=settings.psqlPasswd,
+                                    poolSize=poolSize)
     cameras = dbManager.get_sources(activeOnly=True, restrictType=args.restrictType)
     camerasPTZ = list(filter (lambda x: img_archive.isPTZ(x['name']), cameras))
 
     # cameras = cameras[0:4]
     logging.warning('cameras %s: %s', len(cameras), cameras[0:2])
 
-    # images are fetched with multiple threads to overlap network wait time
-    def threadFn(threadParams):
-        logging.warning('Child thread %s with %d fetches', threading.get_ident(), len(threadParams))
-        for (cameraInfo, lastFetchTime, latestCamInfo) in threadParams:
-            fetchImage(dbManager, cameraInfo, lastFetchTime, args.archiveDir, latestCamInfo)
-        logging.warning('Exiting child thread %s', threading.get_ident())
-
     MAX_INTERVAL_SEC_FIXED = 60
     MAX_INTERVAL_SEC_ROTATE = 13
+    camerasByName = {cameraInfo['name']: cameraInfo for cameraInfo in cameras}
+    intervals = {cameraInfo['name']: fetch_scheduler.AdaptiveInterval() for cameraInfo in cameras}
+    alertCams = {'byName': {}} # replaced (not modified) by main thread, so fetches see consistent dict
+    # recent (heading, timestamp) of each camera, loaded once and then kept up to date by the fetches.
+    # Only the worker fetching a camera updates its entries, and scheduler never runs a camera twice at once
+    recentFetches = img_archive.getRecentArchiveEntries(dbManager, int(time.time()) - 60*60)
+
+    # called by scheduler worker threads when camera is due, returns seconds until it's due again
+    def fetchCamera(cameraName):
+        cameraInfo = camerasByName[cameraName]
+        timestamp = int(time.time())
+        latestCamInfo = alertCams['byName'].get(cameraName)
+        recentEntries = recentFetches.get(cameraName, [])
+        isSpinning, lastFetchTime = img_archive.getSpinFetchInfo(recentEntries, timestamp - 60*60)
+        checkTimeDiff = MAX_INTERVAL_SEC_ROTATE if isSpinning else MAX_INTERVAL_SEC_FIXED
+        if latestCamInfo:
+            timeStr = latestCamInfo['image']['time']
+            if not timeStr:
+                logging.error('No time/url for %s, %s', cameraName, latestCamInfo['image'])
+                return MAX_INTERVAL_SEC_ROTATE
+            timestamp = min(timestamp, int(dateutil.parser.parse(timeStr).timestamp()))
+        if lastFetchTime >= timestamp - checkTimeDiff:
+            # not due yet (e.g. image timestamp earlier than fetch time)
+            return min(lastFetchTime + checkTimeDiff - timestamp + 1, checkTimeDiff)
+        dbRow = fetchImage(dbManager, cameraInfo, lastFetchTime, args.archiveDir, latestCamInfo)
+        if dbRow:
+            recentFetches[cameraName] = [(dbRow['Heading'], dbRow['Timestamp'])] + recentEntries[:img_archive.SPIN_CHECK_ENTRIES - 1]
+        intervals[cameraName].update(bool(dbRow and dbRow['ImagePath']))
+        return intervals[cameraName].getInterval(checkTimeDiff)
+
+    # images are fetched with multiple threads to overlap network wait time.  Each camera is
+    # fetched when due by whichever thread is free, so slow cameras don't delay the others
+    scheduler = fetch_scheduler.FetchScheduler(fetchCamera, args.numThreads)
+    startTime = time.time()
+    for cameraInfo in cameras:
+        # spread initial fetches over the shortest interval
+        scheduler.add(cameraInfo['name'], startTime + random.random() * MAX_INTERVAL_SEC_ROTATE)
+    scheduler.setPaused(True)
+    scheduler.start()
+
     numIterations = 0
-    numFetches = 0
     while True:
         timeType = getTimeType()
         if timeType == 'detect':
@@ -354,74 +380,34 @@ def main():
             checkDetectGroups(False)
         else:
             assert timeType == 'inactive'
+            scheduler.setPaused(True)
             checkDetectGroups(False)
             checkDailyPostWork(dbManager, args.archiveDir)
             checkDailyExit()
             time.sleep(1*60)
             continue
 
-        threadParams = []
-        for threadNum in range(args.numThreads):
-            threadParams.append([])
-        nextThread = 0
-
         numIterations += 1
-        startTime = time.time()
-        alertCamsDict = {}
         if len(camerasPTZ) > 0:
-            alertCams = img_archive.fetchAlertCamsInfo(settings.alertCamsUrl, settings.alertCamsKey)
+            alertCamsList = img_archive.fetchAlertCamsInfo(settings.alertCamsUrl, settings.alertCamsKey)
             # convert list to dict for faster lookup
-            for cam in alertCams:
-                alertCamsDict[cam['name']] = cam
-
-        for cameraInfo in cameras:
-            timestamp = int(time.time())
-            latestCamInfo = None
-            if cameraInfo['name'] in alertCamsDict:
-                latestCamInfo = alertCamsDict[cameraInfo['name']]
-            # logging.warning('Check camera %s, ts %s', cameraInfo['name'], timestamp)
-            isSpinning, lastFetchTime = getSpinFetchInfo(dbManager, cameraInfo, timestamp)
-            checkTimeDiff = MAX_INTERVAL_SEC_ROTATE if isSpinning else MAX_INTERVAL_SEC_FIXED
-            if latestCamInfo:
-                timeStr = latestCamInfo['image']['time']
-                if not timeStr:
-                    logging.error('No time/url for %s, %s', cameraInfo['name'], latestCamInfo['image'])
-                    continue
-                timestamp = min(timestamp, int(dateutil.parser.parse(timeStr).timestamp()))
-            if (lastFetchTime < timestamp - checkTimeDiff):
-                # fetchImage(dbManager, cameraInfo, lastFetchTime, args.archiveDir)
-                # queue the fetching work to a thread and change the thread for enqueueing next fetch
-                threadParams[nextThread].append([cameraInfo, lastFetchTime, latestCamInfo])
-                nextThread = (nextThread + 1) % args.numThreads
-                numFetches += 1
-
-        # start all the threads to work concurrently
-        threads = []
-        for threadNum in range(args.numThreads):
-            # logging.warning('params for thread %d: %s', threadNum, threadParams[threadNum])
-            thread = threading.Thread(target=threadFn, args=(threadParams[threadNum],))
-            threads.append(thread)
-            thread.start()
-            logging.warning('started thread %d: %s with %d fetches', threadNum, thread.ident, len(threadParams[threadNum]))
-
-        # wait for all threads to finish
-        for thread in threads:
-            thread.join()
-        logging.warning('All threads ended')
-
-        endTime = time.time()
-        MIN_CYCLE_SECONDS = min(MAX_INTERVAL_SEC_FIXED, MAX_INTERVAL_SEC_ROTATE)
-        if endTime - startTime < MIN_CYCLE_SECONDS:
-            logging.warning('Sleeping for %.1f', MIN_CYCLE_SECONDS - (endTime - startTime))
-            time.sleep(MIN_CYCLE_SECONDS - (endTime - startTime))
-        else:
-            logging.warning('Sleep overdue by %.1f', (endTime - startTime) - MIN_CYCLE_SECONDS)
+            alertCams['byName'] = {cam['name']: cam for cam in alertCamsList}
+        scheduler.setPaused(False)
+
+        # refresh PTZ info and check other work at the rate of the most frequent fetches
+        time.sleep(MAX_INTERVAL_SEC_ROTATE)
         deleteOldFiles(dbManager)
         if (numIterations % 10) == 0:
             sqlStr = """SELECT count(*) FROM archive"""
             dbResult = dbManager.query(sqlStr)
             lsRes = os.listdir(args.archiveDir)
-            logging.warning('Stats: iterations %s fetches %s, dbR %s, ls %s', numIterations, numFetches, dbResult[0]['count'], len(lsRes))
+            logging.warning('Stats: iterations %s, dbR %s, ls %s', numIterations, dbResult[0]['count'], len(lsRes))
+            logging.warning('Fetch scheduler stats: %s', scheduler.getStats())
+            logging.warning('DB pool stats: %s', dbManager.getPoolStats())
+            logging.warning('HTTP fetch stats: %s', http_fetcher.getHttpFetcher().stats)
+            duplicateCounts = img_archive.getDuplicateCounts()
+            logging.warning('Duplicate images skipped: %d, top cameras %s', sum(duplicateCounts.values()),
+                            sorted(duplicateCounts.items(), key=lambda x: -x[1])[:5])
 
 if __name__=="__main__":
     main()
@@ -49,10 +49,9 @@ def main():
     args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs, parentParsers=[goog_helper.getParentParser()])
     cacheDir = img_archive.cacheDir(args.inputDir)
     cameraCounts = []
-    for cameraID in cacheDir:
-        if isinstance(cacheDir[cameraID], list):
-            cameraCounts.append((cameraID, len(cacheDir[cameraID])))
-            # logging.warning('cam %s, images %s', cameraID, len(cacheDir[cameraID]))
+    for cameraID in cacheDir.getCameraIDs():
+        cameraCounts.append((cameraID, len(cacheDir.getEntries(cameraID))))
+        # logging.warning('cam %s, images %s', cameraID, len(cacheDir.getEntries(cameraID)))
     counts = list(map(lambda x: x[1], cameraCounts))
     logging.warning('counts: %s', counts)
     logging.warning('mean: %s, median: %s', round(np.mean(counts)), round(np.median(counts)))
@@ -70,7 +69,7 @@ def main():
 
     for (cameraID, count) in camsAboveThreshold:
         logging.warning('ID, count: %s, %s', cameraID, count)
-        cameraTimes = cacheDir[cameraID]
+        cameraTimes = [{'time': unixTime, 'fileName': fileName} for (unixTime, fileName) in cacheDir.getEntries(cameraID)]
         for x in range(count - int(threshold)):
             updateDistances(cameraTimes)
             minDist = min(cameraTimes, key=lambda x: x['distance'])
@@ -79,6 +78,7 @@ def main():
                 oldPath = os.path.join(args.inputDir, minDist['fileName'])
                 newPath = os.path.join(args.outputDir, minDist['fileName'])
                 os.rename(oldPath, newPath)
+                cacheDir.remove(minDist['fileName'])
             cameraTimes.remove(minDist)
 
     return
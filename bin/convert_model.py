@@ -0,0 +1,81 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Convert keras smoke classification model into TFLite or ONNX formats
+usable by tf_helper.loadInferenceModel().  By default the converted model is
+written inside the keras model directory, so policies using the converted
+model keep the same modelId (and historical scores) as the original model.
+
+"""
+
+import os, sys
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # quiet down tensorflow logging (must be done before tf_helper)
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import goog_helper
+from firecam.lib import tf_helper
+
+import logging
+import tensorflow as tf
+
+
+def convertTflite(model, outputPath):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    tfliteModel = converter.convert()
+    with open(outputPath, 'wb') as f:
+        f.write(tfliteModel)
+
+
+def convertOnnx(model, outputPath):
+    import tf2onnx # only needed for ONNX conversion
+    inputShape = [None] + list(model.inputs[0].shape[1:])
+    inputSignature = [tf.TensorSpec(inputShape, tf.float32, name='input')]
+    tf2onnx.convert.from_keras(model, input_signature=inputSignature, output_path=outputPath)
+
+
+def main():
+    reqArgs = [
+        ["m", "model", "keras model directory (local or GCS)"],
+        ["f", "format", "output format (tflite or onnx)"],
+    ]
+    optArgs = [
+        ["o", "outputPath", "(optional) output file path (default: model.<format> in local model dir)"],
+    ]
+    args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs)
+    if args.format not in ['tflite', 'onnx']:
+        logging.error('Unsupported format %s', args.format)
+        exit(1)
+    if args.outputPath:
+        outputPath = args.outputPath
+    elif os.path.isdir(args.model):
+        outputPath = os.path.join(args.model, 'model.' + args.format)
+    else:
+        logging.error('Output path is required for models not in local directory')
+        exit(1)
+    if goog_helper.parseGCSPath(outputPath):
+        logging.error('Output path must be local: %s', outputPath)
+        exit(1)
+
+    model = tf_helper.loadModel(args.model)
+    if args.format == 'tflite':
+        convertTflite(model, outputPath)
+    else:
+        convertOnnx(model, outputPath)
+    logging.warning('Converted model written to %s', outputPath)
+
+
+if __name__=="__main__":
+    main()
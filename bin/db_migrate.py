@@ -0,0 +1,69 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Create the secondary indexes declared in DbManager on an existing DB.
+
+DbManager only creates missing indexes when it connects for sqlite and new
+postgres tables, because building them on large existing postgres tables
+takes a while.  So run this before deploying code that adds indexes.  On
+postgres, indexes are built concurrently so detection and archiving can keep
+writing meanwhile, and invalid indexes left by failed builds are rebuilt.
+
+"""
+
+import os, sys
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import db_manager
+
+import logging
+import time
+
+
+def main():
+    reqArgs = [
+        ["m", "mode", "list, create"],
+    ]
+    optArgs = [
+        ["b", "blocking", "(optional) build postgres indexes without concurrently (faster, but blocks writes)"],
+    ]
+    args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs)
+    dbManager = db_manager.DbManager(sqliteFile=settings.db_file,
+                                     psqlHost=settings.psqlHost, psqlDb=settings.psqlDb,
+                                     psqlUser=settings.psqlUser, psqlPasswd=settings.psqlPasswd,
+                                     createIndexes=False)
+    missingIndexes = dbManager.getMissingIndexes()
+    logging.warning('Missing %d indexes: %s', len(missingIndexes), missingIndexes)
+    if args.mode == 'list':
+        for sqlCmd in dbManager.getIndexCommands():
+            logging.warning('%s', sqlCmd)
+    elif args.mode == 'create':
+        if missingIndexes:
+            startTime = time.time()
+            dbManager.createIndexes(concurrently=not args.blocking)
+            logging.warning('Created indexes in %.1f seconds', time.time() - startTime)
+        missingIndexes = dbManager.getMissingIndexes()
+        if missingIndexes:
+            logging.error('Still missing indexes: %s', missingIndexes)
+            exit(1)
+    else:
+        logging.error('unexpected mode: %s', args.mode)
+        exit(1)
+    dbManager.close()
+
+
+if __name__=="__main__":
+    main()
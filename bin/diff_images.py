@@ -48,9 +48,8 @@ def main():
 
     args = collect_args.collectArgs(reqArgs, optionalArgs=optArgs, parentParsers=[goog_helper.getParentParser()])
 
-    imgA = Image.open(args.imgA)
-    imgB = Image.open(args.imgB)
-    diffImg = img_archive.diffWithChecks(imgA, imgB)
+    # pass filepaths so smoothed images are cached (see settings.smoothCacheDir)
+    diffImg = img_archive.diffWithChecks(args.imgA, args.imgB)
     diffImg.save(args.imgOutput, format='JPEG', quality=95)
     # cvImgA = cv2.imread(args.imgA)
     # cvImgB = cv2.imread(args.imgB)
@@ -0,0 +1,62 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Local inference server shared by all detection processes on a VM.  Holds a
+single copy of each model and batches requests from the detection processes.
+Detection processes use it when settings.inferenceSocket is set to the same
+socket path (see firecam/lib/inference_service.py).
+
+"""
+
+import os, sys
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # quiet down tensorflow logging (must be done before tf_helper)
+from firecam.lib import settings
+from firecam.lib import collect_args
+from firecam.lib import inference_service
+
+import logging
+import threading
+import time
+
+
+def main():
+    optArgs = [
+        ["s", "socketPath", "(optional) Unix socket path (default settings.inferenceSocket)"],
+        ["b", "maxBatch", "(optional) max number of crops in a batch (default 256)", int],
+        ["l", "maxLatencyMs", "(optional) max milliseconds to wait for more requests to batch (default 20)", float],
+        ["p", "numThreads", "(optional) number of threads for tflite and onnx backends", int],
+        ["m", "models", "(optional) comma separated list of models to load at startup (others load on first use)"],
+    ]
+    args = collect_args.collectArgs([], optionalArgs=optArgs)
+    socketPath = args.socketPath or getattr(settings, 'inferenceSocket', None)
+    if not socketPath:
+        logging.error('Socket path must be specified via --socketPath or settings.inferenceSocket')
+        exit(1)
+    server = inference_service.InferenceServer(socketPath, maxBatch=args.maxBatch or 256,
+                                               maxLatencyMs=args.maxLatencyMs or 20, numThreads=args.numThreads)
+    if args.models:
+        for modelPath in args.models.split(','):
+            server.getBatcher(modelPath, None)
+    serverThread = threading.Thread(target=server.serve_forever, daemon=True)
+    serverThread.start()
+    logging.warning('Inference server listening on %s', socketPath)
+    while True:
+        time.sleep(10*60)
+        server.logStats()
+
+
+if __name__=="__main__":
+    main()
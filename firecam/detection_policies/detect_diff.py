@@ -16,10 +16,18 @@
 
 This detection policy uses diff images on underlying inception_and_threshold policy
 
+The prior image for the diff comes from an in memory buffer of the recent
+frames of each camera and heading (see frame_buffer.py) when settings.diffBufferMB
+is set, falling back to fetching it from the archive when the buffer has no
+usable frame.
+
 """
 
 import os, sys
+from firecam.lib import settings
 from firecam.lib import img_archive
+from firecam.lib import image_frame
+from firecam.lib import frame_buffer
 from . import inception_and_threshold
 
 import tempfile
@@ -33,6 +41,46 @@ class DetectDiff:
         self.basePolicy = BasePolicy(args, dbManager, stateless=stateless, modelLocation=modelLocation)
         self.modelId = self.basePolicy.modelId
         self.outputDirObj = tempfile.TemporaryDirectory()
+        maxMB = getattr(settings, 'diffBufferMB', None) or frame_buffer.DEFAULT_MAX_MB
+        self.priorFrames = None
+        if maxMB:
+            self.priorFrames = frame_buffer.PriorFrameBuffer(maxMB * 1024 * 1024)
+
+
+    def _diffWithBuffered(self, last_image_spec, baseInput):
+        """Diff the image with the most recent usable frame in the buffer from 0.5 to 1.5 minutes prior
+
+        Returns:
+            (found, diffImg) where found is False if no buffered frame was usable
+        """
+        if not self.priorFrames:
+            return (False, None)
+        cameraID = last_image_spec['cameraID']
+        timestamp = last_image_spec['timestamp']
+        # same time range as detect_fire.fetchPriorAligned
+        priorFrames = self.priorFrames.find(cameraID, last_image_spec.get('heading'), timestamp - 90, timestamp - 31)
+        if not priorFrames:
+            return (False, None)
+        for (priorTimestamp, priorInput) in priorFrames:
+            if img_archive.isPTZ(cameraID): # PTZ iamges require alignment
+                alignedArray = img_archive.alignArray(priorInput['array'], last_image_spec['frame'])
+                if alignedArray is None:
+                    continue
+                priorInput = img_archive.getDiffInput(alignedArray)
+            return (True, img_archive.diffInputsWithChecks(baseInput, priorInput))
+        self.priorFrames.recordUnaligned()
+        return (False, None)
+
+
+    def _addToBuffer(self, last_image_spec, baseInput):
+        if not self.priorFrames:
+            return
+        bufferedInput = baseInput.copy()
+        if img_archive.isPTZ(last_image_spec['cameraID']):
+            bufferedInput['smoothed'] = None # smoothed data can't be used after aligning
+        elif bufferedInput['smoothed'] is not None:
+            bufferedInput['array'] = None # only smoothed data is needed for fixed cameras
+        self.priorFrames.add(last_image_spec['cameraID'], last_image_spec.get('heading'), last_image_spec['timestamp'], bufferedInput)
 
 
     def detect(self, image_spec, checkShifts=False, silent=False, fetchDiff=None):
@@ -44,7 +92,14 @@ class DetectDiff:
         diffImgPath = None
         if not parsedName['diffMinutes']:
             outputDirName = self.outputDirObj.name
-            diffImg = fetchDiff(outputDirName)
+            if 'frame' not in last_image_spec:
+                last_image_spec['frame'] = image_frame.Frame(last_image_spec['path'])
+            # decodes with Frame.getArray, so the data stays in the frame for the alerting code
+            baseInput = img_archive.getDiffInput(last_image_spec['frame'])
+            (found, diffImg) = self._diffWithBuffered(last_image_spec, baseInput)
+            if not found:
+                diffImg = fetchDiff(outputDirName)
+            self._addToBuffer(last_image_spec, baseInput)
             if not diffImg:
                 logging.warning('Failed to fetch diff image for %s', last_image_spec['path'])
                 return {
@@ -55,6 +110,7 @@ class DetectDiff:
             diffImg.save(diffImgPath, format='JPEG', quality=95)
             last_image_spec = last_image_spec.copy()
             last_image_spec['path'] = diffImgPath
+            last_image_spec.pop('frame', None) # frame is for the original path
             base_image_spec = [last_image_spec]
 
         detectionResult = self.basePolicy.detect(base_image_spec, checkShifts=checkShifts, silent=silent)
@@ -52,6 +52,42 @@ class DetectMulti:
 
     def detect(self, image_spec, checkShifts=False, silent=False, fetchDiff=None):
         mainDetectionResult = self.mainPolicy.detect(image_spec, checkShifts=checkShifts, fetchDiff=fetchDiff)
+        return self._confirm(image_spec, mainDetectionResult, checkShifts, fetchDiff)
+
+
+    def detect_batch(self, image_specs, checkShifts=False, silent=False, fetchDiffs=None):
+        """Detect fires in multiple images.  Main policy classifies all images in one batch
+           when it supports detect_batch, and confirmation policies check each image with fire
+
+        Args:
+            image_specs (list): list of image_spec values (as passed to detect()), one per image
+            fetchDiffs (list): [optional] list of fetchDiff functions parallel to image_specs
+
+        Returns:
+            List of detection results parallel to image_specs
+        """
+        fetchDiffs = fetchDiffs or [None] * len(image_specs)
+        if hasattr(self.mainPolicy, 'detect_batch'):
+            mainDetectionResults = self.mainPolicy.detect_batch(image_specs, checkShifts=checkShifts, fetchDiffs=fetchDiffs)
+        else:
+            mainDetectionResults = [self.mainPolicy.detect(image_spec, checkShifts=checkShifts, fetchDiff=fetchDiff)
+                                        for (image_spec, fetchDiff) in zip(image_specs, fetchDiffs)]
+        detectionResults = []
+        for (image_spec, mainDetectionResult, fetchDiff) in zip(image_specs, mainDetectionResults, fetchDiffs):
+            detectionResults.append(self._confirm(image_spec, mainDetectionResult, checkShifts, fetchDiff))
+        return detectionResults
+
+
+    def _confirm(self, image_spec, mainDetectionResult, checkShifts, fetchDiff):
+        """Check the fire found by main policy with all the confirmation policies
+
+        Args:
+            image_spec (list): image_spec passed to detect()
+            mainDetectionResult (dict): detection result from main policy
+
+        Returns:
+            Detection result
+        """
         mainFireSegment = mainDetectionResult['fireSegment']
         if not mainFireSegment:
             return mainDetectionResult
@@ -26,6 +26,9 @@ from firecam.lib import settings
 from firecam.lib import goog_helper
 from firecam.lib import tf_helper
 from firecam.lib import rect_to_squares
+from firecam.lib import score_history
+from firecam.lib import tile_screen
+from firecam.lib import image_frame
 
 import pathlib
 from PIL import Image
@@ -33,6 +36,7 @@ import logging
 import datetime
 import time
 import random
+import numpy as np
 
 import tensorflow as tf
 
@@ -49,50 +53,119 @@ class InceptionV3AndHistoricalThreshold:
         self.minusMinutes = 0
         self.stateless = stateless
         self.collectPositivesRatio = 1
+        backend = None
+        # modelLocation format: path[,collectPositivesRatio[,inferenceBackend]]
         if modelLocation:
             argParts = modelLocation.split(',')
             modelLocation = argParts[0]
-            if len(argParts) > 1:
+            if len(argParts) > 1 and argParts[1]:
                 self.collectPositivesRatio = float(argParts[1])
                 logging.warning('InceptionV3 init collectPositive %f', self.collectPositivesRatio)
+            if len(argParts) > 2 and argParts[2]:
+                backend = argParts[2]
         else:
             modelLocation = settings.model_file
-        self.modelId = '/'.join(modelLocation.split('/')[-2:]) # the last two dirpath components
+        modelDir = modelLocation
+        if tf_helper.getBackendForPath(modelLocation): # converted models stored inside original model dir
+            modelDir = modelLocation.rsplit('/', 1)[0]
+        self.modelId = '/'.join(modelDir.split('/')[-2:]) # the last two dirpath components
         logging.warning('InceptionV3 init model %s', self.modelId)
+        # reusable uint8 and float32 batch buffers for segmenting images
+        self.cropsBuffer = None
+        self.cropsNormalizedBuffer = None
         if testMode:
             self.model = None
         else:
-            self.model = tf_helper.loadModel(modelLocation)
+            self.model = tf_helper.loadInferenceModel(modelLocation, backend=backend)
+        self.scoreHistory = None
+        if not stateless:
+            maxMB = getattr(settings, 'scoreHistoryCacheMB', None) or score_history.DEFAULT_MAX_MB
+            self.scoreHistory = score_history.ScoreHistoryCache(dbManager, self.modelId, maxMB * 1024 * 1024)
+            if not testMode:
+                self.scoreHistory.prewarm(int(time.time()))
+        # optional cascade pre-screen that skips segments unchanged since last classified
+        self.tileScreen = None
+        cascadeThreshold = getattr(settings, 'cascadeThreshold', None)
+        if cascadeThreshold and not stateless:
+            cascadeMaxAge = getattr(settings, 'cascadeMaxAge', None) or tile_screen.DEFAULT_MAX_AGE
+            self.tileScreen = tile_screen.TileScreen(cascadeThreshold, cascadeMaxAge)
+
+
+    def _normalizeCrops(self, crops):
+        """Normalize the given uint8 crops reusing the float32 batch buffer across images
 
+        Args:
+            crops (np.array): uint8 crops from rect_to_squares.cutBoxesArrayUint8
+
+        Returns:
+            np.array with normalized crops
+        """
+        cropsNormalized = rect_to_squares.normalizeCrops(crops, out=self.cropsNormalizedBuffer)
+        # keep the largest buffer around for reuse by the following images
+        if (self.cropsNormalizedBuffer is None) or (len(crops) > len(self.cropsNormalizedBuffer)):
+            self.cropsNormalizedBuffer = cropsNormalized
+        return cropsNormalized
+
+
+    def _getImageArray(self, last_image_spec):
+        """Return the decoded uint8 data of the image in given image_spec entry
+
+        The image is decoded by the Frame in the image_spec entry ('frame'),
+        which is added if the caller didn't provide one.  So the shifted
+        segments for checkShifts, the DetectMulti confirmation policies, and
+        the alerting code handling the same image don't decode it again.
+
+        Returns:
+            np.array (HxWx3) of the image
+        """
+        if 'frame' not in last_image_spec:
+            last_image_spec['frame'] = image_frame.Frame(last_image_spec['path'])
+        return last_image_spec['frame'].getArray()
 
-    def _segmentImage(self, imgPath, startX, endX, startY, endY):
-        """Segment the given image into sections to for smoke classificaiton
+
+    def _cutImage(self, imgPath, startX, endX, startY, endY, imgArray=None):
+        """Cut the given image into uint8 squares reusing the uint8 batch buffer across images
 
         Args:
             imgPath (str): filepath of the image
+            imgArray (np.array): [optional] already decoded data of image at imgPath
 
         Returns:
-            List of dictionary containing information on each segment
+            (np.array, list): pair of uint8 crops and list of metadata on each segment
         """
-        img = Image.open(imgPath)
-        crops, segments = rect_to_squares.cutBoxesArray(img, startX, endX, startY, endY)
-        img.close()
+        img = imgArray if imgArray is not None else Image.open(imgPath)
+        crops, segments = rect_to_squares.cutBoxesArrayUint8(img, startX, endX, startY, endY, batchBuffer=self.cropsBuffer)
+        if imgArray is None:
+            img.close()
+        # keep the largest buffer around for reuse by the following images
+        if len(crops) and ((self.cropsBuffer is None) or (len(crops) > len(self.cropsBuffer))):
+            self.cropsBuffer = crops
         return crops, segments
 
 
-    def _segmentAndClassify(self, imgPath, startX, endX, startY, endY):
-        """Segment the given image into squares and classify each square
+    def _segmentImage(self, imgPath, startX, endX, startY, endY, imgArray=None):
+        """Segment the given image into sections to for smoke classificaiton
 
         Args:
-            imgPath (str): filepath of the image to segment and clasify
+            imgPath (str): filepath of the image
+            imgArray (np.array): [optional] already decoded data of image at imgPath
 
         Returns:
-            list of segments with scores sorted by decreasing score
+            List of dictionary containing information on each segment
         """
-        # logging.warning('SAC %s: %s, %s, %s, %s, %s', self.modelId, startX, startY, endX, endY, imgPath)
-        crops, segments = self._segmentImage(imgPath, startX, endX, startY, endY)
+        crops, segments = self._cutImage(imgPath, startX, endX, startY, endY, imgArray=imgArray)
         if len(crops) == 0:
-            return []
+            return crops, segments
+        return self._normalizeCrops(crops), segments
+
+
+    def _classifySegments(self, crops, segments):
+        """Classify the given normalized crops and record the score in each segment
+
+        Args:
+            crops (np.array): normalized crops
+            segments (list): parallel list of metadata associated with each crop
+        """
         # testMode fakes all scores
         if testMode:
             for segmentInfo in segments:
@@ -100,12 +173,68 @@ class InceptionV3AndHistoricalThreshold:
         else:
             tf_helper.classifySegments(self.model, crops, segments)
 
+
+    def _classifyImages(self, lastImageSpecs, cropsList, segmentsList):
+        """Classify the uint8 crops of the given images using a single classification call
+
+        When the cascade pre-screen is enabled, only the segments that changed
+        since they were last classified are sent to the model, and the others
+        keep their previous scores.
+
+        Args:
+            lastImageSpecs (list): image_spec entries for the images
+            cropsList (list): parallel list of uint8 crops of each image
+            segmentsList (list): parallel list of segments of each image (sorted by decreasing score on return)
+        """
+        selectedCrops = []
+        selectedSegments = []
+        pendingList = [None] * len(segmentsList) # tileScreen state of each image until its scores are known
+        for (imageIndex, (last_image_spec, crops, segments)) in enumerate(zip(lastImageSpecs, cropsList, segmentsList)):
+            if len(segments) == 0:
+                continue
+            if self.tileScreen:
+                (indexes, pendingList[imageIndex]) = self.tileScreen.select(last_image_spec['cameraID'], last_image_spec['heading'],
+                                                                            last_image_spec['timestamp'], crops, segments)
+                if len(indexes) < len(segments):
+                    crops = crops[indexes]
+                    segments = [segments[i] for i in indexes]
+            if len(segments):
+                selectedCrops.append(crops)
+                selectedSegments += segments
+        if len(selectedSegments) > 0:
+            if len(selectedCrops) == 1:
+                allCrops = self._normalizeCrops(selectedCrops[0])
+            else:
+                allCrops = self._normalizeCrops(np.concatenate(selectedCrops))
+            self._classifySegments(allCrops, selectedSegments)
+        for (segments, pending) in zip(segmentsList, pendingList):
+            if pending:
+                self.tileScreen.update(pending, segments)
+            segments.sort(key=lambda x: -x['score'])
+
+
+    def _segmentAndClassify(self, imgPath, startX, endX, startY, endY, imgArray=None):
+        """Segment the given image into squares and classify each square
+
+        Args:
+            imgPath (str): filepath of the image to segment and clasify
+            imgArray (np.array): [optional] already decoded data of image at imgPath
+
+        Returns:
+            list of segments with scores sorted by decreasing score
+        """
+        # logging.warning('SAC %s: %s, %s, %s, %s, %s', self.modelId, startX, startY, endX, endY, imgPath)
+        crops, segments = self._segmentImage(imgPath, startX, endX, startY, endY, imgArray=imgArray)
+        if len(crops) == 0:
+            return []
+        self._classifySegments(crops, segments)
+
         segments.sort(key=lambda x: -x['score'])
         # logging.warning('SAC top: %s', segments[0])
         return segments
 
 
-    def _collectPositves(self, imgPath, segments):
+    def _collectPositves(self, imgPath, imgArray, segments):
         """Collect all positive scoring segments
 
         Copy the images for all segments that score highter than > .5 to folder
@@ -114,6 +243,7 @@ class InceptionV3AndHistoricalThreshold:
 
         Args:
             imgPath (str): path name for main image
+            imgArray (np.array): decoded data of image at imgPath
             segments (list): List of dictionary containing information on each segment
         """
         if random.random() > self.collectPositivesRatio:
@@ -121,7 +251,6 @@ class InceptionV3AndHistoricalThreshold:
         positiveSegments = 0
         ppath = pathlib.PurePath(imgPath)
         imgNameNoExt = str(os.path.splitext(ppath.name)[0])
-        imgObj = None
         for segmentInfo in segments:
             if segmentInfo['score'] > .5:
                 if settings.positivesDir:
@@ -130,9 +259,8 @@ class InceptionV3AndHistoricalThreshold:
                     postivesDateDir = goog_helper.dateSubDir(postivesModelDir)
                     cropImgName = imgNameNoExt + '_Crop_' + segmentInfo['coordStr'] + '.jpg'
                     cropImgPath = os.path.join(str(ppath.parent), cropImgName)
-                    if not imgObj:
-                        imgObj = Image.open(imgPath)
-                    cropped_img = imgObj.crop(segmentInfo['coords'])
+                    (minX, minY, maxX, maxY) = segmentInfo['coords']
+                    cropped_img = Image.fromarray(imgArray[minY:maxY, minX:maxX])
                     cropped_img.save(cropImgPath, format='JPEG', quality=95)
                     cropped_img.close()
                     goog_helper.copyFile(cropImgPath, postivesDateDir)
@@ -143,8 +271,6 @@ class InceptionV3AndHistoricalThreshold:
 
         if positiveSegments > 0:
             logging.warning('Found %d positives in image %s', positiveSegments, ppath.name)
-        if imgObj:
-            imgObj.close()
 
 
     def _recordScores(self, cameraID, heading, timestamp, segments):
@@ -175,7 +301,7 @@ class InceptionV3AndHistoricalThreshold:
                 'ModelId': self.modelId
             }
             dbRows.append(dbRow)
-        self.dbManager.add_data('scores', dbRows)
+        self.dbManager.addDataDeferred('scores', dbRows)
 
 
     def _postFilter(self, cameraID, heading, timestamp, segments):
@@ -207,45 +333,53 @@ class InceptionV3AndHistoricalThreshold:
         if segments[0]['score'] < .5:
             return None
 
-        sqlTemplate = """SELECT MinX,MinY,MaxX,MaxY,count(*) as cnt, avg(score) as avgs, max(score) as maxs FROM scores
-        WHERE CameraName='%s' and Heading>=%s and Heading<=%s and Timestamp > %s and Timestamp < %s and SecondsInDay > %s and SecondsInDay < %s
-        and ModelId='%s'
-        GROUP BY MinX,MinY,MaxX,MaxY"""
-
-        dt = datetime.datetime.fromtimestamp(timestamp)
-        secondsInDay = (dt.hour * 60 + dt.minute) * 60 + dt.second
-        sqlStr = sqlTemplate % (cameraID, heading-1, heading+1, timestamp - 60*60*int(24*7.5), timestamp - 60*60*12, secondsInDay - 60*60, secondsInDay + 60*60, self.modelId)
-        # print('sql', sqlStr, timestamp)
-        dbResult = self.dbManager.query(sqlStr)
-        # if len(dbResult) > 0:
-        #     print('post filter result', dbResult)
+        # historical scores for same segments at same time of day over last few days
+        positiveCoords = [segmentInfo['coords'] for segmentInfo in segments if segmentInfo['score'] >= .5]
+        history = self.scoreHistory.getHistory(cameraID, heading, timestamp, positiveCoords)
         maxFireSegment = None
         maxFireScore = 0
         for segmentInfo in segments:
             if segmentInfo['score'] < .5: # segments is sorted. we've reached end of segments >= .5
                 break
-            for row in dbResult:
-                if (row['minx'] == segmentInfo['MinX'] and row['miny'] == segmentInfo['MinY'] and
-                    row['maxx'] == segmentInfo['MaxX'] and row['maxy'] == segmentInfo['MaxY']):
-                    threshold = (row['maxs'] + 1)/2 # threshold is halfway between max and 1
-                    # Segments with historical value above 0.8 are too noisy, so discard them by setting
-                    # threshold at least .2 above max.  Also requires .7 to reach .9 vs just .85
-                    threshold = max(threshold, row['maxs'] + 0.2)
-                    # print('thresh', row['minx'], row['miny'], row['maxx'], row['maxy'], row['maxs'], threshold)
-                    if (segmentInfo['score'] > threshold) and (segmentInfo['score'] > maxFireScore):
-                        maxFireScore = segmentInfo['score']
-                        maxFireSegment = segmentInfo
-                        maxFireSegment['HistAvg'] = row['avgs']
-                        maxFireSegment['HistMax'] = row['maxs']
-                        maxFireSegment['HistNumSamples'] = row['cnt']
-                        maxFireSegment['AdjScore'] = (segmentInfo['score'] - threshold) / (1 - threshold)
+            row = history.get(tuple(segmentInfo['coords']))
+            if row:
+                threshold = (row['maxs'] + 1)/2 # threshold is halfway between max and 1
+                # Segments with historical value above 0.8 are too noisy, so discard them by setting
+                # threshold at least .2 above max.  Also requires .7 to reach .9 vs just .85
+                threshold = max(threshold, row['maxs'] + 0.2)
+                if (segmentInfo['score'] > threshold) and (segmentInfo['score'] > maxFireScore):
+                    maxFireScore = segmentInfo['score']
+                    maxFireSegment = segmentInfo
+                    maxFireSegment['HistAvg'] = row['avgs']
+                    maxFireSegment['HistMax'] = row['maxs']
+                    maxFireSegment['HistNumSamples'] = row['cnt']
+                    maxFireSegment['AdjScore'] = (segmentInfo['score'] - threshold) / (1 - threshold)
 
         return maxFireSegment
 
 
-    def detect(self, image_spec, checkShifts=False, silent=False, fetchDiff=None):
-        # This detection policy only uses a single image, so just take the last one
-        last_image_spec = image_spec[-1]
+    def _getRegion(self, last_image_spec):
+        """Return the region of the image to segment (startX, endX, startY, endY) given image_spec entry
+        """
+        startX = last_image_spec['startX'] if 'startX' in last_image_spec else 0
+        endX = last_image_spec['endX'] if 'endX' in last_image_spec else None
+        startY = last_image_spec['startY'] if 'startY' in last_image_spec else 0
+        endY = last_image_spec['endY'] if 'endY' in last_image_spec else None
+        return (startX, endX, startY, endY)
+
+
+    def _processSegments(self, last_image_spec, segments, checkShifts, silent):
+        """Apply the filters and shift checks on the classified segments of an image
+
+        Args:
+            last_image_spec (dict): image_spec entry for the image
+            segments (list): segments with scores sorted by decreasing score
+            checkShifts (bool): if true, verify fire segment by classifying shifted segments
+            silent (bool): if true, don't log highest score
+
+        Returns:
+            Dictionary with detection results
+        """
         imgPath = last_image_spec['path']
         timestamp = last_image_spec['timestamp']
         cameraID = last_image_spec['cameraID']
@@ -254,17 +388,12 @@ class InceptionV3AndHistoricalThreshold:
         detectionResult = {
             'fireSegment': None
         }
-        startX = last_image_spec['startX'] if 'startX' in last_image_spec else 0
-        endX = last_image_spec['endX'] if 'endX' in last_image_spec else None
-        startY = last_image_spec['startY'] if 'startY' in last_image_spec else 0
-        endY = last_image_spec['endY'] if 'endY' in last_image_spec else None
-        segments = self._segmentAndClassify(imgPath, startX, endX, startY, endY)
         detectionResult['segments'] = segments
         detectionResult['timeMid'] = time.time()
         if len(segments) == 0: # happens sometimes when camera is malfunctioning
             return detectionResult
         if getattr(self.args, 'collectPositves', None):
-            self._collectPositves(imgPath, segments)
+            self._collectPositves(imgPath, self._getImageArray(last_image_spec), segments)
         fireSegment = None
         if self.stateless:
             if segments[0]['score'] > 0.5:
@@ -285,7 +414,7 @@ class InceptionV3AndHistoricalThreshold:
             endX = fireSegment['MaxX'] + int(sizeX / 3)
             startY = fireSegment['MinY'] - int(sizeY / 3)
             endY = fireSegment['MaxY'] + int(sizeY / 3)
-            newSegments = self._segmentAndClassify(imgPath, startX, endX, startY, endY)
+            newSegments = self._segmentAndClassify(imgPath, startX, endX, startY, endY, imgArray=self._getImageArray(last_image_spec))
             segments += newSegments
             # intersect fireSegment
             if newSegments[0]['score'] > 0.5:
@@ -302,3 +431,45 @@ class InceptionV3AndHistoricalThreshold:
             logging.warning('Highest score for camera %s: %f' % (cameraID, segments[0]['score']))
 
         return detectionResult
+
+
+    def detect(self, image_spec, checkShifts=False, silent=False, fetchDiff=None):
+        # This detection policy only uses a single image, so just take the last one
+        last_image_spec = image_spec[-1]
+        (startX, endX, startY, endY) = self._getRegion(last_image_spec)
+        crops, segments = self._cutImage(last_image_spec['path'], startX, endX, startY, endY, imgArray=self._getImageArray(last_image_spec))
+        self._classifyImages([last_image_spec], [crops], [segments])
+        return self._processSegments(last_image_spec, segments, checkShifts, silent)
+
+
+    def detect_batch(self, image_specs, checkShifts=False, silent=False, fetchDiffs=None):
+        """Detect fires in multiple images using a single classification call for the segments of all images
+
+        The post classification steps (recording scores, historical threshold filter,
+        and checking shifts) still run separately for each image.
+
+        Args:
+            image_specs (list): list of image_spec values (as passed to detect()), one per image
+            checkShifts (bool): if true, verify fire segments by classifying shifted segments
+            silent (bool): if true, don't log highest scores
+
+        Returns:
+            List of detection results parallel to image_specs
+        """
+        cropsList = []
+        segmentsList = []
+        for image_spec in image_specs:
+            last_image_spec = image_spec[-1]
+            (startX, endX, startY, endY) = self._getRegion(last_image_spec)
+            imgArray = self._getImageArray(last_image_spec)
+            crops, segments = rect_to_squares.cutBoxesArrayUint8(imgArray, startX, endX, startY, endY)
+            cropsList.append(crops)
+            segmentsList.append(segments)
+
+        lastImageSpecs = [image_spec[-1] for image_spec in image_specs]
+        self._classifyImages(lastImageSpecs, cropsList, segmentsList)
+
+        detectionResults = []
+        for (image_spec, segments) in zip(image_specs, segmentsList):
+            detectionResults.append(self._processSegments(image_spec[-1], segments, checkShifts, silent))
+        return detectionResults
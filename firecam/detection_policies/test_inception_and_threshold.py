@@ -0,0 +1,63 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test inception_and_threshold batch classification with the cascade pre-screen
+
+"""
+
+import pytest
+pytest.importorskip('tensorflow')
+from firecam.detection_policies import inception_and_threshold
+from firecam.lib import tile_screen
+from firecam.lib import image_frame
+import numpy as np
+from PIL import Image
+
+
+def getImageSpec(tmp_path, img, timestamp):
+    imgPath = str(tmp_path / ('cam1__%d.png' % timestamp))
+    Image.fromarray(img).save(imgPath)
+    return [{'path': imgPath, 'frame': image_frame.Frame(imgPath), 'cameraID': 'cam1', 'heading': 90, 'timestamp': timestamp}]
+
+
+def testDetectBatchSameView(tmp_path, monkeypatch):
+    monkeypatch.setattr(inception_and_threshold, 'testMode', True)
+    policy = inception_and_threshold.InceptionV3AndHistoricalThreshold(None, None, stateless=True, modelLocation='models/test/model')
+    policy.tileScreen = tile_screen.TileScreen(threshold=8)
+    classified = []
+    def classifySegments(crops, segments):
+        # score depends only on the crop content
+        for (crop, segmentInfo) in zip(crops, segments):
+            segmentInfo['score'] = float(crop.mean())
+        classified.append(len(segments))
+    monkeypatch.setattr(policy, '_classifySegments', classifySegments)
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (600, 900, 3), dtype=np.uint8)
+    policy.detect_batch([getImageSpec(tmp_path, img, 1000)])
+    # two images of same view in one batch, the second changing one more segment than the first
+    img2 = img.copy()
+    img2[0:20, 0:20] = 255
+    img3 = img2.copy()
+    img3[500:520, 800:820] = 255
+    results = policy.detect_batch([getImageSpec(tmp_path, img2, 1060), getImageSpec(tmp_path, img3, 1061)])
+    assert classified == [12, 3]
+    expected = {tuple(x['coords']): x['score'] for x in results[1]['segments']}
+
+    # unchanged image reuses the scores saved for the last image of the batch
+    results = policy.detect_batch([getImageSpec(tmp_path, img3, 1120)])
+    assert classified == [12, 3]
+    assert {tuple(x['coords']): x['score'] for x in results[0]['segments']} == pytest.approx(expected)
@@ -0,0 +1,246 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Index of the images in a local archive directory (e.g. settings.downloadDir),
+with the images of each camera sorted by time so lookups of the closest image
+and of time ranges are binary searches instead of scans of every image.
+
+Parsing the names of a directory with hundreds of thousands of images is slow,
+so the index is persisted to a sqlite sidecar file in a subdirectory of the
+directory (so its journal files don't change the directory mtime).  When the
+directory mtime hasn't changed since the sidecar was written, the directory
+isn't even listed.  Otherwise only the added file names are parsed, and
+removed files are dropped.
+
+The directory (and sidecar) may be shared by several processes.  Failures to
+update the sidecar (e.g. locked by another process for too long) are logged
+and only the in-memory index is updated.  Any file added or removed after
+that changes the directory mtime, so the next load rescans the directory.
+
+"""
+
+import os
+import logging
+import bisect
+import sqlite3
+import threading
+import time
+
+INDEX_DIR_NAME = '.firecam_archive_index'
+INDEX_FILE_NAME = 'index.db'
+SIDECAR_BUSY_TIMEOUT = 10 # seconds to wait for sidecar locks held by other processes
+RACY_MTIME_SECS = 2 # don't trust directory mtimes this close to the time they were recorded
+
+
+def getIndexPath(dirPath):
+    """Return path of the sidecar file for the index of given directory
+    """
+    return os.path.join(dirPath, INDEX_DIR_NAME, INDEX_FILE_NAME)
+
+
+class ArchiveIndex(object):
+    def __init__(self, parseFn, readDir, writeDir=None, indexPath=None):
+        """Index the .jpg images in given directory
+
+        Args:
+            parseFn (function): parses a file name into dict with cameraID and unixTime (or None)
+            readDir (str): path to directory containing images
+            writeDir (str): [optional] directory where new images are downloaded (default readDir)
+            indexPath (str): [optional] sqlite sidecar file to persist the index
+        """
+        self.parseFn = parseFn
+        self.readDir = readDir
+        self.writeDir = writeDir or readDir
+        self.indexPath = indexPath
+        self.entries = {} # cameraID -> sorted list of (unixTime, fileName)
+        self.times = {} # cameraID -> sorted list of unixTime (parallel to entries for bisect)
+        self.fileInfo = {} # fileName -> (cameraID, unixTime), both None if name didn't parse
+        self.conn = None
+        self.lock = threading.Lock()
+        if indexPath:
+            try:
+                self._loadSidecar()
+                return
+            except (sqlite3.Error, OSError) as e:
+                logging.error('Failed to use archive index %s: %s', indexPath, str(e))
+                self.conn = None
+                self.entries = {}
+                self.times = {}
+                self.fileInfo = {}
+        self._addNames(self._listNames())
+
+
+    def _listNames(self):
+        return [fileName for fileName in os.listdir(self.readDir) if fileName[-4:] == '.jpg']
+
+
+    def _parse(self, fileName):
+        nameParsed = self.parseFn(fileName)
+        if nameParsed and nameParsed['cameraID']:
+            return (nameParsed['cameraID'], nameParsed['unixTime'])
+        return (None, None)
+
+
+    def _addEntries(self, rows):
+        """Add given (fileName, cameraID, unixTime) rows, sorting each camera's entries once
+        """
+        changedCameras = set()
+        for (fileName, cameraID, unixTime) in rows:
+            self.fileInfo[fileName] = (cameraID, unixTime)
+            if cameraID:
+                self.entries.setdefault(cameraID, []).append((unixTime, fileName))
+                changedCameras.add(cameraID)
+        for cameraID in changedCameras:
+            self.entries[cameraID].sort()
+            self.times[cameraID] = [x[0] for x in self.entries[cameraID]]
+
+
+    def _addNames(self, fileNames):
+        rows = []
+        for fileName in fileNames:
+            (cameraID, unixTime) = self._parse(fileName)
+            rows.append((fileName, cameraID, unixTime))
+        self._addEntries(rows)
+        return rows
+
+
+    def _loadSidecar(self):
+        # created before the directory mtime is read below
+        os.makedirs(os.path.dirname(self.indexPath), exist_ok=True)
+        self.conn = sqlite3.connect(self.indexPath, timeout=SIDECAR_BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (fileName TEXT PRIMARY KEY, cameraID TEXT, unixTime INT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL)')
+        self.conn.commit()
+        self._addEntries(self.conn.execute('SELECT fileName, cameraID, unixTime FROM files').fetchall())
+        meta = dict(self.conn.execute('SELECT name, value FROM meta').fetchall())
+        dirMtime = os.stat(self.readDir).st_mtime
+        if (meta.get('dirMtime') == dirMtime) and (meta.get('recordTime', 0) - dirMtime > RACY_MTIME_SECS):
+            return # no files added or removed since last time
+
+        fileNames = set(self._listNames())
+        removedNames = [x for x in self.fileInfo if x not in fileNames]
+        for fileName in removedNames:
+            self._removeEntry(fileName)
+        newRows = self._addNames([x for x in fileNames if x not in self.fileInfo])
+        logging.warning('Archive index %s: %d files, %d new, %d removed', self.indexPath,
+                        len(fileNames), len(newRows), len(removedNames))
+        self.conn.executemany('DELETE FROM files WHERE fileName = ?', [(x,) for x in removedNames])
+        self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', newRows)
+        self.conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                              [('dirMtime', dirMtime), ('recordTime', time.time())])
+        self.conn.commit()
+
+
+    def _removeEntry(self, fileName):
+        (cameraID, unixTime) = self.fileInfo.pop(fileName, (None, None))
+        if not cameraID:
+            return
+        cameraEntries = self.entries[cameraID]
+        index = bisect.bisect_left(cameraEntries, (unixTime, fileName))
+        if (index < len(cameraEntries)) and (cameraEntries[index][1] == fileName):
+            del cameraEntries[index]
+            del self.times[cameraID][index]
+
+
+    def _updateSidecar(self, sqlStr, params):
+        # caller holds self.lock
+        try:
+            self.conn.execute(sqlStr, params)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error('Failed to update archive index %s: %s', self.indexPath, str(e))
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                pass
+
+
+    def insert(self, fileName):
+        """Insert given file into the index
+
+        Args:
+            fileName (str): name or path of file to insert
+        """
+        fileName = os.path.basename(fileName)
+        (cameraID, unixTime) = self._parse(fileName)
+        with self.lock:
+            if fileName in self.fileInfo:
+                return
+            self.fileInfo[fileName] = (cameraID, unixTime)
+            if not cameraID:
+                return
+            cameraEntries = self.entries.setdefault(cameraID, [])
+            cameraTimes = self.times.setdefault(cameraID, [])
+            index = bisect.bisect_left(cameraEntries, (unixTime, fileName))
+            cameraEntries.insert(index, (unixTime, fileName))
+            cameraTimes.insert(index, unixTime)
+            if self.conn and (self.readDir == self.writeDir):
+                self._updateSidecar('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (fileName, cameraID, unixTime))
+
+
+    def remove(self, fileName):
+        """Remove given file (e.g. moved out of the directory) from the index
+
+        Args:
+            fileName (str): name or path of file to remove
+        """
+        fileName = os.path.basename(fileName)
+        with self.lock:
+            self._removeEntry(fileName)
+            if self.conn:
+                self._updateSidecar('DELETE FROM files WHERE fileName = ?', (fileName,))
+
+
+    def getCameraIDs(self):
+        return [cameraID for cameraID in self.entries if self.entries[cameraID]]
+
+
+    def getEntries(self, cameraID):
+        """Return sorted list of (unixTime, fileName) of the images from given camera
+        """
+        with self.lock:
+            return list(self.entries.get(cameraID, []))
+
+
+    def getPath(self, fileName):
+        return os.path.join(self.readDir, fileName)
+
+
+    def findClosest(self, cameraID, desiredTime):
+        """Return (unixTime, fileName) of the image from given camera closest to given time (or None)
+        """
+        with self.lock:
+            cameraTimes = self.times.get(cameraID)
+            if not cameraTimes:
+                return None
+            index = bisect.bisect_left(cameraTimes, desiredTime)
+            if index == len(cameraTimes):
+                index -= 1
+            elif (index > 0) and (desiredTime - cameraTimes[index - 1] <= cameraTimes[index] - desiredTime):
+                index -= 1
+            return self.entries[cameraID][index]
+
+
+    def fetchRange(self, cameraID, minTime, maxTime):
+        """Return sorted list of (unixTime, fileName) of the images from given camera strictly between given times
+        """
+        with self.lock:
+            cameraTimes = self.times.get(cameraID)
+            if not cameraTimes:
+                return []
+            start = bisect.bisect_right(cameraTimes, minTime)
+            end = bisect.bisect_left(cameraTimes, maxTime)
+            return self.entries[cameraID][start:end]
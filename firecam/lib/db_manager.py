@@ -28,8 +28,21 @@ backends.
 import logging
 import sqlite3
 import time, datetime
+import threading
+import atexit
 import psycopg2
 import psycopg2.extras
+import numpy as np
+
+POOL_STATS_INTERVAL = 10*60 # minimum time between logging connection pool stats
+SQLITE_BUSY_TIMEOUT = 30 # seconds pooled sqlite connections wait for locks held by other connections
+WRITER_RETRY_SECONDS = 10 # time between write behind thread attempts to connect to DB
+
+# values are passed to DB as bound parameters, so register numpy scalar types
+# (e.g., scores from tf_helper.classifySegments) that DB drivers don't support natively
+for npType, pyType in [(np.float32, float), (np.float64, float), (np.int32, int), (np.int64, int)]:
+    sqlite3.register_adapter(npType, pyType)
+    psycopg2.extensions.register_adapter(npType, lambda val, pyType=pyType: psycopg2.extensions.adapt(pyType(val)))
 
 def _dict_factory(cursor, row):
     """
@@ -45,7 +58,7 @@ def _dict_factory(cursor, row):
 
 
 class DbManager(object):
-    def __init__(self, sqliteFile=None, psqlHost=None, psqlDb=None, psqlUser=None, psqlPasswd=None):
+    def __init__(self, sqliteFile=None, psqlHost=None, psqlDb=None, psqlUser=None, psqlPasswd=None, poolSize=None, createIndexes=True):
         """SQL DB connection class constructor
 
         Connects to the SQL DB (either sqlite or postgres) and creates the
@@ -54,23 +67,40 @@ class DbManager(object):
         in dictionory vs. list format for reliable processing.
         To avoid dangling transactions, the default mode is to immediately commit tx.
 
+        By default all methods use a single connection, so only one thread should
+        use the DbManager at a time.  With poolSize, each thread borrows a connection
+        from a pool for each transaction (sqlite connections use WAL mode so readers
+        don't block the writer), so multiple threads can share the DbManager.
+
         Args:
             sqliteFile (str): file path to SQLite DB (if specified postgres parameters are ignored)
             psqlHost (str): IP address of postgreSQL server
             psqlDb (str): Database name in postgreSQL server
             psqlUser (str): Username for authentication to postgreSQL server
             psqlPasswd (str): Password for authentication to postgreSQL server
+            poolSize (int): [optional] max number of connections in pool shared by threads
+            createIndexes (bool): [default true] - If true, create missing secondary indexes on sqlite
+                                  and on new postgres tables (see bin/db_migrate.py for existing ones)
         """
         self.dbType = None
+        self.conn = None
+        self.pool = None
+        self.threadState = threading.local() # connection borrowed from pool by each thread
+        self.insertSqlCache = {}
+        self.writeBehind = None
+        # saved so write behind thread can open its own connection
+        self.connectArgs = {'sqliteFile': sqliteFile, 'psqlHost': psqlHost, 'psqlDb': psqlDb,
+                            'psqlUser': psqlUser, 'psqlPasswd': psqlPasswd}
         if sqliteFile:
             logging.warning('using sqlite %s', sqliteFile)
             self.dbType = 'sqlite'
-            self.conn = sqlite3.connect(sqliteFile)
-            self.conn.row_factory = _dict_factory
         elif psqlHost:
             logging.warning('using postgres %s', psqlHost)
             self.dbType = 'psql'
-            self.conn = psycopg2.connect(host=psqlHost, database=psqlDb, user=psqlUser, password=psqlPasswd)
+        if poolSize:
+            self.pool = ConnectionPool(self._connect, poolSize)
+        elif self.dbType:
+            self.conn = self._connect()
 
         sources_schema = [
             ('name', 'TEXT'),
@@ -150,6 +180,31 @@ class DbManager(object):
             ('ModelId', 'TEXT'),
             ('Heading', 'REAL'),
         ]
+        # secondary indexes: (index name, columns)
+        scores_indexes = [
+            ('scores_timestamp', ['Timestamp']), # folding into score_history, stats, and deletes
+            ('scores_camera_heading_model_time', ['CameraName', 'Heading', 'ModelId', 'Timestamp']),
+        ]
+
+        # daily rollup of scores per segment and time bucket (see score_history.py)
+        score_history_schema = [
+            ('CameraName', 'TEXT'),
+            ('Heading', 'REAL'),
+            ('ModelId', 'TEXT'),
+            ('MinX', 'INT'),
+            ('MinY', 'INT'),
+            ('MaxX', 'INT'),
+            ('MaxY', 'INT'),
+            ('Timestamp', 'INT'), # start of time bucket
+            ('SecondsInDay', 'INT'), # start of time of day bucket
+            ('Cnt', 'INT'),
+            ('AvgScore', 'REAL'),
+            ('MaxScore', 'REAL'),
+        ]
+        score_history_indexes = [
+            ('score_history_camera_model_heading_time', ['CameraName', 'ModelId', 'Heading', 'Timestamp']), # _postFilter
+            ('score_history_timestamp', ['Timestamp']), # prewarm and deletes
+        ]
 
         multi_poilicy_schema = [
             ('CameraName', 'TEXT'),
@@ -179,6 +234,10 @@ class DbManager(object):
             ('Hostname', 'TEXT'),
             ('ProtoNum', 'INT'),
         ]
+        probables_indexes = [
+            ('probables_camera_heading_time', ['CameraName', 'Heading', 'Timestamp']), # isDuplicateProbable
+            ('probables_timestamp', ['Timestamp']),
+        ]
 
         # detections are subset of probables likely to be new fires
         detections_schema = [
@@ -197,6 +256,10 @@ class DbManager(object):
             ('FireHeading', 'INT'),
             ('AngularWidth', 'INT'),
         ]
+        detections_indexes = [
+            ('detections_timestamp', ['Timestamp']), # isDuplicateDetection, getRecentDetections
+            ('detections_camera_time', ['CameraName', 'Timestamp']),
+        ]
 
         # alerts are notifications sent out via various means
         alerts_schema = [
@@ -262,6 +325,11 @@ class DbManager(object):
             ('FieldOfView', 'INT'),
             ('Processed', 'INT'),
         ]
+        archive_indexes = [
+            ('archive_camera_heading_time', ['CameraId', 'Heading', 'Timestamp']), # fetchCurrentFromDB, getDBImages
+            ('archive_camera_time', ['CameraId', 'Timestamp']), # getRecentArchiveEntries
+            ('archive_timestamp', ['Timestamp']), # deleteOldFiles
+        ]
 
         # ignored_views
         ignored_views_schema = [
@@ -281,6 +349,9 @@ class DbManager(object):
             ('WeatherCamera', 'TEXT'),
             ('SourceCamera', 'TEXT'),
         ]
+        weather_indexes = [
+            ('weather_camera_time', ['CameraId', 'Timestamp']),
+        ]
 
         # rx_burns
         rx_burns_schema = [
@@ -321,6 +392,7 @@ class DbManager(object):
             'cameras': cameras_schema,
             'bbox': bbox_schema,
             'scores': scores_schema,
+            'score_history': score_history_schema,
             'multi_policy': multi_poilicy_schema,
             'probables': probables_schema,
             'detections': detections_schema,
@@ -336,12 +408,75 @@ class DbManager(object):
             'stats': stats_schema,
             'auth': auth_schema,
         }
+        self.indexes = {
+            'scores': scores_indexes,
+            'score_history': score_history_indexes,
+            'probables': probables_indexes,
+            'detections': detections_indexes,
+            'archive': archive_indexes,
+            'weather': weather_indexes,
+        }
 
-        self._check_local_db()
+        self._check_local_db(createIndexes)
 
 
     def __del__(self):
-        self.conn.close()
+        self.close()
+
+
+    def close(self):
+        """Close the DB connection (sqlite connections must be closed by the thread that opened them)
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
+
+    def _connect(self):
+        """Return a new connection to the DB using the constructor arguments
+        """
+        if self.dbType == 'sqlite':
+            if not self.pool:
+                conn = sqlite3.connect(self.connectArgs['sqliteFile'])
+            else:
+                # pooled connections are used by different threads, one at a time
+                conn = sqlite3.connect(self.connectArgs['sqliteFile'], timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+            conn.row_factory = _dict_factory
+            return conn
+        elif self.dbType == 'psql':
+            return psycopg2.connect(host=self.connectArgs['psqlHost'], database=self.connectArgs['psqlDb'],
+                                    user=self.connectArgs['psqlUser'], password=self.connectArgs['psqlPasswd'])
+
+
+    def _getConn(self):
+        """Return the connection to use by the calling thread: either the single
+           connection, or a connection borrowed from the pool.  The borrowed connection
+           stays with the thread until _releaseConn() (called after commits)
+
+        Returns:
+            DB connection
+        """
+        if not self.pool:
+            return self.conn
+        conn = getattr(self.threadState, 'conn', None)
+        if conn is None:
+            conn = self.pool.borrow()
+            self.threadState.conn = conn
+        return conn
+
+
+    def _releaseConn(self):
+        """Give the connection borrowed by the calling thread back to the pool
+           (only call when there's no uncommitted transaction)
+        """
+        conn = getattr(self.threadState, 'conn', None)
+        if self.pool and (conn is not None):
+            self.threadState.conn = None
+            self.pool.giveBack(conn)
 
 
     def _getCursor(self):
@@ -351,9 +486,15 @@ class DbManager(object):
             DB cursor
         """
         if self.dbType == 'sqlite':
-            return self.conn.cursor()
+            return self._getConn().cursor()
         elif self.dbType == 'psql':
-            return self.conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+            return self._getConn().cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+
+
+    def getPoolStats(self):
+        """Return dict with connection pool stats (None without pool)
+        """
+        return self.pool and self.pool.getStats()
 
 
     def create_db(self):
@@ -371,21 +512,55 @@ class DbManager(object):
         cursor = self._getCursor()
         try:
             cursor.execute(sqlCmd)
-            if commit:
-                self.conn.commit()
             cursor.close()
+            if commit:
+                self.commit()
         except Exception as e:
             logging.error('Error in db.execute %s', str(e))
             # cleanup so future db commands will work
-            self.conn.commit()
             cursor.close()
+            if commit:
+                self.commit()
+            # else caller owns the transaction and must rollback()
             # rethrow excpetion after cleanup
             raise e
 
 
+    def _getInsertSql(self, tableName, keys):
+        """Return the parameterized insert statement for given table and columns
+
+        The statements are cached so the same SQL text is reused for every insert
+        into a table, which lets sqlite reuse its compiled statement.
+
+        Args:
+            tableName (str):
+            keys (list): column names
+
+        Returns:
+            SQL insert statement with placeholders for values
+        """
+        cacheKey = (tableName, tuple(keys))
+        if cacheKey not in self.insertSqlCache:
+            if self.dbType == 'sqlite':
+                valuesStr = '(%s)' % ', '.join(['?'] * len(keys))
+            else:
+                valuesStr = '%s' # expanded by execute_values
+            sql_template = 'insert into {table_name} ({fields}) values {values}'
+            self.insertSqlCache[cacheKey] = sql_template.format(
+                table_name = tableName,
+                fields = ", ".join(keys),
+                values = valuesStr
+            )
+        return self.insertSqlCache[cacheKey]
+
+
     def add_data(self, tableName, keyValues, commit=True):
         """Insert given data into given table
 
+        Values are passed as bound parameters (executemany on sqlite,
+        execute_values on postgres), so all rows are inserted with a single
+        statement without formatting the values into SQL text.
+
         Args:
             tableName (str):
             keyValues (dict or list): Dictory of key/value pairs for data to insert
@@ -396,27 +571,97 @@ class DbManager(object):
             kvList = keyValues
         else:
             kvList = [keyValues]
+        if len(kvList) == 0:
+            return
+        firstKeys = list(kvList[0].keys())
         valuesList = []
-        firstKeys = [key for (key,_) in kvList[0].items()]
         for kvEntry in kvList:
             assert type(kvEntry) is dict
-            keys = [key for (key,_) in kvEntry.items()]
-            assert firstKeys == keys
-            rowData = ", ".join(repr(val) for (_, val) in kvEntry.items())
-            valuesList.append('(%s)' % rowData)
-        valuesStr = ', '.join(valuesList)
-
-        sql_template = 'insert into {table_name} ({fields}) values {values}'
-        db_command = sql_template.format(
-            table_name = tableName,
-            fields = ", ".join(firstKeys),
-            values = valuesStr
-        )
-        self.execute(db_command, commit=commit)
+            assert firstKeys == list(kvEntry.keys())
+            valuesList.append(tuple(kvEntry.values()))
+
+        sqlCmd = self._getInsertSql(tableName, firstKeys)
+        cursor = self._getCursor()
+        try:
+            if self.dbType == 'sqlite':
+                cursor.executemany(sqlCmd, valuesList)
+            else:
+                psycopg2.extras.execute_values(cursor, sqlCmd, valuesList, page_size=len(valuesList))
+            cursor.close()
+            if commit:
+                self.commit()
+        except Exception as e:
+            logging.error('Error in db.add_data %s', str(e))
+            # cleanup so future db commands will work
+            cursor.close()
+            if commit:
+                self.commit()
+            # else caller owns the transaction and must rollback()
+            # rethrow excpetion after cleanup
+            raise e
 
 
     def commit(self):
-        self.conn.commit()
+        try:
+            self._getConn().commit()
+        finally:
+            self._releaseConn()
+
+
+    def rollback(self):
+        """Discard the uncommitted writes of the calling thread's transaction
+        """
+        try:
+            self._getConn().rollback()
+        finally:
+            self._releaseConn()
+
+
+    def startWriteBehind(self, maxBatchRows=1000, maxDelaySeconds=1.0, maxPendingRows=20000):
+        """Enable write behind queue for addDataDeferred() and executeDeferred()
+
+        Deferred writes are buffered and committed in batches on a background thread
+        using a separate DB connection, so callers don't wait for DB round trips.
+
+        Args:
+            maxBatchRows (int): write out the buffer once it has this many rows
+            maxDelaySeconds (float): write out the buffer once the oldest entry is this old
+            maxPendingRows (int): callers block when this many rows are waiting to be written
+        """
+        if not self.writeBehind:
+            self.writeBehind = WriteBehindQueue(self.connectArgs, maxBatchRows, maxDelaySeconds, maxPendingRows)
+
+
+    def addDataDeferred(self, tableName, keyValues):
+        """Insert given data into given table via write behind queue (if enabled)
+
+        Args:
+            tableName (str):
+            keyValues (dict or list): same as add_data()
+        """
+        if not self.writeBehind:
+            return self.add_data(tableName, keyValues)
+        kvList = keyValues if type(keyValues) is list else [keyValues]
+        if len(kvList) > 0:
+            self.writeBehind.put(tableName, kvList, len(kvList))
+
+
+    def executeDeferred(self, sqlCmd):
+        """Execute given SQL update/insert/delete statement via write behind queue (if enabled)
+
+        Args:
+            sqlCmd (str): SQL update/insert/delete statement
+        """
+        if not self.writeBehind:
+            return self.execute(sqlCmd)
+        self.writeBehind.put(None, sqlCmd, 1)
+
+
+    def flushWrites(self):
+        """Wait until all deferred writes queued so far are committed
+        """
+        if self.writeBehind:
+            self.writeBehind.flush()
 
 
     def query(self, queryStr):
@@ -435,17 +680,23 @@ class DbManager(object):
         while row:
             result.append(row)
             row = cursor.fetchone()
-        self.conn.commit() # stop idle read transacations
         cursor.close()
+        self.commit() # stop idle read transacations
         return result
 
 
-    def _check_local_db(self):
+    def _check_local_db(self, createIndexes=True):
         """
         This ensures that the database exists and that the specified
-        table exists within it.
+        table exists within it, along with its secondary indexes.
 
         """
+        if self.dbType == 'sqlite':
+            dbResult = self.query("SELECT name FROM sqlite_master WHERE type='table'")
+        else:
+            dbResult = self.query("SELECT tablename as name FROM pg_tables WHERE schemaname = current_schema()")
+        existingTables = set([dbRow['name'].lower() for dbRow in dbResult])
+        newTables = [tableName for tableName in self.tables if tableName.lower() not in existingTables]
         sql_create_template = 'create table if not exists {table_name} ({fields})'
         cursor = self._getCursor()
         for tableName, tableSchema in self.tables.items():
@@ -457,8 +708,113 @@ class DbManager(object):
                 )
             )
             cursor.execute(db_command)
-        self.commit()
         cursor.close()
+        self.commit()
+        if not createIndexes:
+            return
+        # Building indexes on large existing postgres tables takes long and blocks writes, so
+        # every process starting up would stall.  Those are left to bin/db_migrate.py
+        indexTables = list(self.indexes.keys()) if self.dbType == 'sqlite' else newTables
+        try:
+            self.createIndexes(tableNames=indexTables)
+        except Exception as e:
+            # e.g. another process creating the same index at the same time
+            logging.error('Failed to create indexes: %s', str(e))
+        missingIndexes = self.getMissingIndexes()
+        if missingIndexes:
+            logging.warning('Missing DB indexes %s.  Run bin/db_migrate.py -m create', missingIndexes)
+
+
+    def _getIndexNames(self, valid=True):
+        # return set of lowercase names of the valid (or invalid) indexes in the DB.
+        # Failed postgres concurrent builds leave invalid indexes that aren't used by queries
+        if self.dbType == 'sqlite':
+            if not valid:
+                return set()
+            dbResult = self.query("SELECT name FROM sqlite_master WHERE type='index'")
+        else:
+            sqlTemplate = """SELECT c.relname as name FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                               WHERE i.indisvalid = %s"""
+            dbResult = self.query(sqlTemplate % ('true' if valid else 'false'))
+        return set([dbRow['name'].lower() for dbRow in dbResult])
+
+
+    def getMissingIndexes(self):
+        """Return names of the secondary indexes in self.indexes that don't exist (or are invalid) in the DB
+        """
+        existing = self._getIndexNames()
+        return [indexName for tableIndexes in self.indexes.values() for (indexName, columns) in tableIndexes
+                if indexName.lower() not in existing]
+
+
+    def _getIndexCommand(self, tableName, indexName, columns, concurrently=False):
+        sql_index_template = 'create index {concurrently}if not exists {index_name} on {table_name} ({fields})'
+        return sql_index_template.format(
+            concurrently = 'concurrently ' if concurrently else '',
+            index_name = indexName,
+            table_name = tableName,
+            fields = ", ".join(columns)
+        )
+
+
+    def getIndexCommands(self, concurrently=False):
+        """Return the SQL commands to create the secondary indexes in self.indexes
+           (commands do nothing for existing indexes)
+
+        Args:
+            concurrently (bool): postgres only - build without blocking writes to the table
+
+        Returns:
+            list of SQL create index commands
+        """
+        return [self._getIndexCommand(tableName, indexName, columns, concurrently)
+                for tableName, tableIndexes in self.indexes.items() for (indexName, columns) in tableIndexes]
+
+
+    def createIndexes(self, concurrently=False, tableNames=None):
+        """Create any missing secondary indexes in self.indexes, e.g. on an existing DB
+           created before the indexes were added (see bin/db_migrate.py).  Invalid indexes
+           left by failed postgres concurrent builds are dropped and built again
+
+        Args:
+            concurrently (bool): postgres only - build without blocking writes to the table
+            tableNames (list): [optional] only indexes of these tables (default all)
+        """
+        concurrently = concurrently and (self.dbType == 'psql')
+        validIndexes = self._getIndexNames()
+        invalidIndexes = self._getIndexNames(valid=False)
+        sqlCmds = []
+        for tableName, tableIndexes in self.indexes.items():
+            if (tableNames != None) and (tableName not in tableNames):
+                continue
+            for (indexName, columns) in tableIndexes:
+                if indexName.lower() in validIndexes:
+                    continue
+                if indexName.lower() in invalidIndexes:
+                    sqlCmds.append('drop index %sif exists %s' % ('concurrently ' if concurrently else '', indexName))
+                sqlCmds.append(self._getIndexCommand(tableName, indexName, columns, concurrently))
+        if not sqlCmds:
+            return
+        conn = self._getConn()
+        if concurrently:
+            # create index concurrently can't run inside a transaction
+            conn.set_session(autocommit=True)
+        try:
+            for sqlCmd in sqlCmds:
+                logging.warning('%s', sqlCmd)
+                cursor = self._getCursor()
+                cursor.execute(sqlCmd)
+                cursor.close()
+                if not concurrently:
+                    conn.commit()
+        except Exception:
+            if not concurrently:
+                conn.rollback()
+            raise
+        finally:
+            if concurrently:
+                conn.set_session(autocommit=False)
+            self._releaseConn()
 
 
     def restrictTypeClause(self, restrictType=None):
@@ -563,12 +919,13 @@ class DbManager(object):
             (value, updatedRows) = self._incrementCounterInt(cursor, counterName)
             if updatedRows != 1:
                 raise Exception('Conflict')
-            self.conn.commit()
             cursor.close()
+            self.commit()
             # print("Success", value, updatedRows)
         except Exception as e:
-            self.conn.rollback()
             cursor.close()
+            self._getConn().rollback()
+            self._releaseConn()
             logging.error('Error in increment.  Retrying %s: %s', value, e)
             return self.incrementCounter(counterName) # tail-recursive
 
@@ -647,9 +1004,321 @@ class DbManager(object):
     def vacuum(self, tableName):
         # vacuum requires autocommint true, so change connection status temporarily
         # NOTE: any parallel threads using same connection may get confused, so use carefully
-        self.conn.set_session(autocommit=True)
+        conn = self._getConn()
+        conn.set_session(autocommit=True)
         cursor = self._getCursor()
         sqlCmd = "VACUUM(FULL, ANALYZE, VERBOSE) %s" % tableName
         cursor.execute(sqlCmd)
         cursor.close()
-        self.conn.set_session(autocommit=False)
+        conn.set_session(autocommit=False)
+        self._releaseConn()
+
+
+class ConnectionPool(object):
+    def __init__(self, connectFn, maxConnections):
+        """Thread safe pool of DB connections
+
+        Connections are opened on demand up to maxConnections.  When all of them
+        are borrowed, borrowers wait until one is given back, and the waits are
+        counted in the stats.  (psycopg2.pool.ThreadedConnectionPool raises an
+        error instead of waiting, so it isn't used here.)
+
+        Args:
+            connectFn (function): returns a new DB connection
+            maxConnections (int): max number of open connections
+        """
+        self.connectFn = connectFn
+        self.maxConnections = maxConnections
+        self.semaphore = threading.BoundedSemaphore(maxConnections)
+        self.lock = threading.Lock()
+        self.idle = [] # connections ready to be borrowed
+        self.connections = [] # all open connections
+        self.lastStatsTime = time.time()
+        self.stats = {'borrows': 0, 'waits': 0, 'waitSeconds': 0.0, 'maxWaitSeconds': 0.0}
+
+
+    def _logStats(self):
+        timeNow = time.time()
+        if timeNow - self.lastStatsTime < POOL_STATS_INTERVAL:
+            return
+        self.lastStatsTime = timeNow
+        logging.warning('ConnectionPool stats %s, connections %d of %d', self.stats, len(self.connections), self.maxConnections)
+
+
+    def borrow(self):
+        """Return a connection for exclusive use by caller until it's given back
+        """
+        waitSeconds = None
+        if not self.semaphore.acquire(blocking=False):
+            startTime = time.time()
+            self.semaphore.acquire()
+            waitSeconds = time.time() - startTime
+        with self.lock:
+            self.stats['borrows'] += 1
+            if waitSeconds != None:
+                self.stats['waits'] += 1
+                self.stats['waitSeconds'] += waitSeconds
+                self.stats['maxWaitSeconds'] = max(self.stats['maxWaitSeconds'], waitSeconds)
+            self._logStats()
+            if self.idle:
+                return self.idle.pop()
+        try:
+            conn = self.connectFn()
+        except Exception:
+            self.semaphore.release()
+            raise
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+
+    def giveBack(self, conn):
+        """Return given borrowed connection to the pool
+        """
+        with self.lock:
+            self.idle.append(conn)
+        self.semaphore.release()
+
+
+    def getStats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats['connections'] = len(self.connections)
+            stats['idle'] = len(self.idle)
+            return stats
+
+
+    def close(self):
+        """Close all connections (connections borrowed at this time should not be used anymore)
+        """
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.idle = []
+
+
+class WriteBehindQueue(object):
+    def __init__(self, connectArgs, maxBatchRows, maxDelaySeconds, maxPendingRows):
+        """Buffer of DB writes that are committed in batches on a background thread
+
+        Consecutive inserts into the same table are coalesced into a single insert
+        and all writes in a batch are committed in one transaction.  Writes are
+        executed in the order they were queued.  While the DB can't be reached, the
+        writer keeps retrying and callers block once the queue is full.  If the
+        writer thread dies, put() and flush() raise instead of queueing writes that
+        will never be written.
+
+        Args:
+            connectArgs (dict): DbManager constructor arguments for the writer connection
+            maxBatchRows (int): write out the buffer once it has this many rows
+            maxDelaySeconds (float): write out the buffer once the oldest entry is this old
+            maxPendingRows (int): callers block when this many rows are waiting to be written
+        """
+        self.connectArgs = connectArgs
+        self.maxBatchRows = maxBatchRows
+        self.maxDelaySeconds = maxDelaySeconds
+        self.maxPendingRows = maxPendingRows
+        self.cond = threading.Condition()
+        self.pending = [] # list of (tableName, rows) for inserts or (None, sqlCmd)
+        self.pendingRows = 0 # rows queued or being written
+        self.oldestTime = None
+        self.putSeq = 0
+        self.doneSeq = 0
+        self.flushSeq = 0
+        self.stopped = False
+        self.stats = {'batches': 0, 'rows': 0, 'blocked': 0, 'errors': 0, 'connectErrors': 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+
+    def put(self, tableName, item, numRows):
+        """Add given write to the queue, blocking while the queue is full
+
+        Args:
+            tableName (str): table for inserts or None for SQL statements
+            item: list of row dicts for inserts or SQL statement string
+            numRows (int): number of rows to account for in memory limit
+        """
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError('WriteBehindQueue is closed')
+            self._checkAlive()
+            if self.pendingRows >= self.maxPendingRows:
+                self.stats['blocked'] += 1
+                # make writer write out everything queued so far
+                self.flushSeq = max(self.flushSeq, self.putSeq)
+                self.cond.notify_all()
+                while self.pendingRows >= self.maxPendingRows and self.thread.is_alive():
+                    self.cond.wait()
+                self._checkAlive()
+            if not self.pending:
+                self.oldestTime = time.time()
+            self.pending.append((tableName, item))
+            self.pendingRows += numRows
+            self.putSeq += 1
+            if self.pendingRows >= self.maxBatchRows:
+                self.cond.notify_all()
+
+
+    def flush(self):
+        """Wait until all writes queued so far are committed
+        """
+        with self.cond:
+            targetSeq = self.putSeq
+            self.flushSeq = max(self.flushSeq, targetSeq)
+            self.cond.notify_all()
+            while self.doneSeq < targetSeq and self.thread.is_alive():
+                self.cond.wait()
+            if self.doneSeq < targetSeq:
+                self._checkAlive()
+
+
+    def close(self):
+        """Write out all queued writes and stop the background thread
+        """
+        with self.cond:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        logging.warning('WriteBehindQueue closed. stats %s', self.stats)
+
+
+    def _checkAlive(self):
+        # caller holds self.cond
+        if not self.thread.is_alive():
+            raise RuntimeError('WriteBehindQueue writer thread died with %d entries pending' % len(self.pending))
+
+
+    def _isReady(self):
+        if not self.pending:
+            return False
+        return (self.stopped or (self.flushSeq > self.doneSeq) or (self.pendingRows >= self.maxBatchRows) or
+                (time.time() - self.oldestTime >= self.maxDelaySeconds))
+
+
+    def _writeEntries(self, dbManager, batch):
+        # write given entries without committing, coalescing consecutive inserts into same table
+        index = 0
+        while index < len(batch):
+            (tableName, item) = batch[index]
+            index += 1
+            if tableName == None:
+                dbManager.execute(item, commit=False)
+                continue
+            rows = list(item)
+            keys = list(rows[0].keys())
+            while (index < len(batch)) and (batch[index][0] == tableName) and (list(batch[index][1][0].keys()) == keys):
+                rows += batch[index][1]
+                index += 1
+            dbManager.add_data(tableName, rows, commit=False)
+
+
+    def _writeBatch(self, dbManager, batch):
+        """Write the given batch in one transaction.  If that fails, roll it back and
+        replay the entries one at a time, so only the entries that fail by themselves are lost
+
+        Returns:
+            Number of entries that failed
+        """
+        try:
+            self._writeEntries(dbManager, batch)
+            dbManager.commit()
+            return 0
+        except Exception as e:
+            logging.warning('WriteBehindQueue batch of %d entries failed, replaying individually: %s', len(batch), str(e))
+            dbManager.rollback()
+        numFailed = 0
+        for entry in batch:
+            try:
+                self._writeEntries(dbManager, [entry])
+                dbManager.commit()
+            except Exception as e:
+                dbManager.rollback()
+                numFailed += 1
+                logging.error('WriteBehindQueue dropped write to %s: %s', entry[0] or entry[1], str(e))
+        return numFailed
+
+
+    def _connect(self):
+        """Return the writer connection, retrying while the DB can't be reached
+
+        Returns:
+            DbManager or None if the queue was closed before connecting
+        """
+        while True:
+            try:
+                return DbManager(**self.connectArgs)
+            except Exception as e:
+                self.stats['connectErrors'] += 1
+                logging.error('WriteBehindQueue failed to connect to DB, retrying: %s', str(e))
+            with self.cond:
+                if self.stopped:
+                    return None
+                self.cond.wait(WRITER_RETRY_SECONDS)
+
+
+    def _dropPending(self):
+        # queue closed without a DB connection, so give up on the pending writes
+        with self.cond:
+            if self.pending:
+                self.stats['errors'] += len(self.pending)
+                logging.error('WriteBehindQueue closed without DB connection, dropped %d entries', len(self.pending))
+            self.pending = []
+            self.pendingRows = 0
+            self.doneSeq = self.putSeq
+            self.cond.notify_all()
+
+
+    def _run(self):
+        try:
+            self._runWriter()
+        except Exception as e:
+            logging.error('WriteBehindQueue writer thread failed: %s', str(e))
+        finally:
+            # wake up callers waiting on the writer so they see it died
+            with self.cond:
+                self.cond.notify_all()
+
+
+    def _runWriter(self):
+        dbManager = None
+        while True:
+            if not dbManager:
+                dbManager = self._connect()
+                if not dbManager:
+                    self._dropPending()
+                    return
+            with self.cond:
+                while not self._isReady():
+                    if self.stopped and not self.pending:
+                        dbManager.close()
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = max(self.oldestTime + self.maxDelaySeconds - time.time(), 0.01)
+                    self.cond.wait(timeout)
+                batch = self.pending
+                batchSeq = self.putSeq
+                batchRows = self.pendingRows
+                self.pending = []
+            try:
+                self.stats['errors'] += self._writeBatch(dbManager, batch)
+                self.stats['batches'] += 1
+                self.stats['rows'] += batchRows
+            except Exception as e:
+                # e.g. lost DB connection, so reconnect before the next batch
+                self.stats['errors'] += len(batch)
+                logging.error('WriteBehindQueue failed to write %d entries: %s', len(batch), str(e))
+                try:
+                    dbManager.close()
+                except Exception:
+                    pass
+                dbManager = None
+            with self.cond:
+                self.pendingRows -= batchRows
+                self.doneSeq = batchSeq
+                self.cond.notify_all()
@@ -0,0 +1,217 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Scheduler for periodic tasks (e.g. fetching each camera's image) run by a pool
+of worker threads.
+
+Tasks are kept in one shared queue ordered by the time each is next due.  Idle
+workers take the most overdue task as soon as it's due, so there is no barrier
+where every worker waits for the slowest task of a sweep, and each task can
+have its own interval.  The function running a task returns the number of
+seconds until the task is due again.
+
+Stats track lateness (time between when a task was due and when it started)
+per task and the utilization (fraction of time busy) of the workers.
+
+"""
+
+import logging
+import threading
+import time
+import heapq
+import itertools
+
+STATS_INTERVAL = 10*60 # minimum time between logging stats
+ERROR_RETRY_SECONDS = 60
+MAX_BACKOFF_FACTOR = 4
+
+
+class AdaptiveInterval(object):
+    def __init__(self, maxFactor=MAX_BACKOFF_FACTOR, alpha=0.3):
+        """Interval between fetches of a source that is lengthened when fetches find no change
+
+        Args:
+            maxFactor (float): max multiple of base interval
+            alpha (float): weight of latest observation in the moving average of the change rate
+        """
+        self.maxFactor = maxFactor
+        self.alpha = alpha
+        self.changeRate = 1.0
+
+
+    def update(self, changed):
+        """Record whether the latest fetch found a change
+        """
+        self.changeRate = (1 - self.alpha) * self.changeRate + self.alpha * (1 if changed else 0)
+
+
+    def getInterval(self, baseInterval):
+        """Return the interval for the observed change rate, between baseInterval and maxFactor * baseInterval
+        """
+        return baseInterval / max(self.changeRate, 1 / self.maxFactor)
+
+
+class FetchScheduler(object):
+    def __init__(self, taskFn, numWorkers):
+        """Scheduler running due tasks on given number of worker threads
+
+        Args:
+            taskFn (function): runs task for given key and returns seconds until it's due again (None to drop it)
+            numWorkers (int): number of worker threads
+        """
+        self.taskFn = taskFn
+        self.numWorkers = numWorkers
+        self.queue = [] # heap of (dueTime, seq, key)
+        self.seq = itertools.count() # tie breaker so keys are never compared
+        self.cond = threading.Condition()
+        self.paused = False
+        self.stopped = False
+        self.numRunning = 0
+        self.resumeTime = time.time()
+        self.workers = []
+        self._resetStats()
+
+
+    def _resetStats(self):
+        self.statsStartTime = time.time()
+        self.lastStatsTime = self.statsStartTime
+        self.lateness = {} # key -> [count, total seconds, max seconds]
+        self.busySeconds = [0] * self.numWorkers
+        self.numTasks = 0
+        self.numErrors = 0
+
+
+    def _getStats(self):
+        # caller holds self.cond
+        elapsed = max(time.time() - self.statsStartTime, 1e-6)
+        count = sum([x[0] for x in self.lateness.values()])
+        total = sum([x[1] for x in self.lateness.values()])
+        worstKeys = sorted(self.lateness.items(), key=lambda x: -x[1][2])[:5]
+        return {
+            'tasks': self.numTasks,
+            'errors': self.numErrors,
+            'queued': len(self.queue),
+            'meanLateness': round(total / count, 2) if count else 0,
+            'maxLateness': round(worstKeys[0][1][2], 2) if worstKeys else 0,
+            'latestKeys': [(key, round(x[2], 2)) for (key, x) in worstKeys],
+            'utilization': [round(min(x / elapsed, 1), 2) for x in self.busySeconds],
+        }
+
+
+    def getStats(self):
+        """Return dict with task counts, lateness (overall and the 5 latest keys), and worker utilization
+        since stats were last logged
+        """
+        with self.cond:
+            return self._getStats()
+
+
+    def _logStats(self):
+        # caller holds self.cond
+        if time.time() - self.lastStatsTime < STATS_INTERVAL:
+            return
+        logging.warning('FetchScheduler stats %s', self._getStats())
+        self._resetStats()
+
+
+    def add(self, key, dueTime=None):
+        """Schedule task for given key at given time (default now)
+        """
+        with self.cond:
+            heapq.heappush(self.queue, (dueTime or time.time(), next(self.seq), key))
+            self.cond.notify()
+
+
+    def start(self):
+        """Start the worker threads
+        """
+        for workerNum in range(self.numWorkers):
+            thread = threading.Thread(target=self._workerFn, args=(workerNum,), daemon=True)
+            self.workers.append(thread)
+            thread.start()
+
+
+    def stop(self):
+        """Stop the workers after their current tasks
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for thread in self.workers:
+            thread.join()
+
+
+    def setPaused(self, paused):
+        """Pause or resume running tasks.  Pausing waits for running tasks to finish
+        """
+        with self.cond:
+            if paused == self.paused:
+                return
+            self.paused = paused
+            if paused:
+                while self.numRunning > 0:
+                    self.cond.wait()
+            else:
+                self.resumeTime = time.time()
+                self.cond.notify_all()
+
+
+    def _nextTask(self):
+        # wait for the earliest due task, or return None when stopped
+        with self.cond:
+            while not self.stopped:
+                if self.paused or not self.queue:
+                    self.cond.wait()
+                    continue
+                timeNow = time.time()
+                if self.queue[0][0] > timeNow:
+                    self.cond.wait(self.queue[0][0] - timeNow)
+                    continue
+                (dueTime, seq, key) = heapq.heappop(self.queue)
+                # tasks aren't late while paused
+                lateness = timeNow - max(dueTime, self.resumeTime)
+                keyLateness = self.lateness.setdefault(key, [0, 0, 0])
+                keyLateness[0] += 1
+                keyLateness[1] += lateness
+                keyLateness[2] = max(keyLateness[2], lateness)
+                self.numRunning += 1
+                return key
+            return None
+
+
+    def _workerFn(self, workerNum):
+        while True:
+            key = self._nextTask()
+            if key == None:
+                return
+            startTime = time.time()
+            try:
+                delay = self.taskFn(key)
+                failed = False
+            except Exception as e:
+                logging.error('Scheduled task %s failed: %s', key, str(e))
+                delay = ERROR_RETRY_SECONDS
+                failed = True
+            endTime = time.time()
+            with self.cond:
+                self.numRunning -= 1
+                self.numTasks += 1
+                self.numErrors += failed
+                self.busySeconds[workerNum] += endTime - max(startTime, self.statsStartTime)
+                if delay != None:
+                    heapq.heappush(self.queue, (endTime + delay, next(self.seq), key))
+                self.cond.notify_all()
+                self._logStats()
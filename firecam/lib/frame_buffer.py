@@ -0,0 +1,143 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+In memory ring buffer of the most recent frames of each camera and heading,
+so the diff detection can compare with the prior frame without fetching it
+from the archive and decoding it again.  Frames are stored as the dicts from
+img_archive.getDiffInput, which hold the smoothed data once it's been used.
+
+The total memory is capped, evicting frames of the least recently used
+camera and heading first.  The buffer is only used by the diff policy when
+settings.diffBufferMB is set, since its size depends on how many detection
+processes share the machine.
+
+"""
+
+import logging
+import threading
+import time
+import collections
+
+DEFAULT_MAX_MB = 0 # disabled unless configured
+DEFAULT_FRAMES_PER_VIEW = 4
+DEFAULT_MAX_AGE = 5*60 # drop frames older than this many seconds before the newest frame of the same view
+STATS_INTERVAL = 10*60 # minimum time between logging stats
+
+
+def getInputBytes(diffInput):
+    """Return number of bytes of image data held by given getDiffInput result
+    """
+    return sum([diffInput[x].nbytes for x in ['array', 'smoothed'] if diffInput[x] is not None])
+
+
+class PriorFrameBuffer(object):
+    def __init__(self, maxBytes, framesPerView=DEFAULT_FRAMES_PER_VIEW, maxAge=DEFAULT_MAX_AGE):
+        """Buffer of recent frames per (cameraID, heading) with LRU memory cap
+
+        Args:
+            maxBytes (int): max bytes of image data in buffer
+            framesPerView (int): max frames per camera and heading
+            maxAge (int): max seconds between oldest and newest frames of a camera and heading
+        """
+        self.maxBytes = maxBytes
+        self.framesPerView = framesPerView
+        self.maxAge = maxAge
+        self.views = collections.OrderedDict() # (cameraID, heading) -> list of (timestamp, diffInput, numBytes)
+        self.totalBytes = 0
+        self.lock = threading.Lock()
+        self.lastStatsTime = time.time()
+        self.stats = {'hits': 0, 'misses': 0, 'unaligned': 0, 'evicted': 0}
+
+
+    def _removeOldest(self, key):
+        frames = self.views[key]
+        (timestamp, diffInput, numBytes) = frames.pop(0)
+        self.totalBytes -= numBytes
+        if not frames:
+            del self.views[key]
+
+
+    def _logStats(self):
+        timeNow = time.time()
+        if timeNow - self.lastStatsTime < STATS_INTERVAL:
+            return
+        self.lastStatsTime = timeNow
+        logging.warning('PriorFrameBuffer stats %s, hit rate %.3f, views %d, MB %d', self.stats,
+                        self.getHitRate(), len(self.views), self.totalBytes // (1024*1024))
+
+
+    def getHitRate(self):
+        return self.stats['hits'] / max(self.stats['hits'] + self.stats['misses'], 1)
+
+
+    def add(self, cameraID, heading, timestamp, diffInput):
+        """Add frame to buffer
+
+        Args:
+            cameraID (str): camera ID
+            heading (int): direction camera is facing
+            timestamp (int): time of image
+            diffInput (dict): img_archive.getDiffInput result for image (not modified after adding)
+        """
+        key = (cameraID, heading)
+        numBytes = getInputBytes(diffInput)
+        with self.lock:
+            frames = self.views.setdefault(key, [])
+            self.views.move_to_end(key)
+            frames.append((timestamp, diffInput, numBytes))
+            frames.sort(key=lambda x: x[0])
+            self.totalBytes += numBytes
+            while (len(frames) > self.framesPerView) or (frames[-1][0] - frames[0][0] > self.maxAge):
+                self._removeOldest(key)
+            while self.totalBytes > self.maxBytes:
+                self._removeOldest(next(iter(self.views)))
+                self.stats['evicted'] += 1
+            self._logStats()
+
+
+    def find(self, cameraID, heading, minTime, maxTime):
+        """Find frames of given camera and heading within given time range
+
+        Args:
+            cameraID (str): camera ID
+            heading (int): direction camera is facing
+            minTime (int): earliest timestamp
+            maxTime (int): latest timestamp
+
+        Returns:
+            List of (timestamp, diffInput) sorted most recent first.  The diffInput
+            dicts are copies, so callers can add the smoothed data to them
+        """
+        key = (cameraID, heading)
+        with self.lock:
+            frames = self.views.get(key, [])
+            matches = [(timestamp, diffInput.copy()) for (timestamp, diffInput, numBytes) in reversed(frames)
+                        if (timestamp >= minTime) and (timestamp <= maxTime)]
+            if matches:
+                self.views.move_to_end(key)
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+        return matches
+
+
+    def recordUnaligned(self):
+        """Record that none of the frames returned by last find() could be aligned
+        """
+        with self.lock:
+            self.stats['hits'] -= 1
+            self.stats['misses'] += 1
+            self.stats['unaligned'] += 1
@@ -0,0 +1,177 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+HTTP fetcher shared by the threads downloading camera images.
+
+urllib.request.urlretrieve opens a new TCP (and TLS) connection for every
+image.  The fetcher keeps a requests.Session per host, so its connections are
+kept alive and reused by all threads, and limits the number of concurrent
+requests to each host.  It remembers the ETag and Last-Modified headers of each
+URL and makes conditional requests, so unchanged images aren't transferred
+again.  Responses are streamed to a temporary file that is renamed into place
+when complete, so readers never see partial images.  The md5 of the content is
+computed while streaming it, so callers can reject duplicate content before
+the temporary file is renamed into place.
+
+The shared fetcher used by img_archive is configured with
+settings.httpTimeout and settings.httpConnectionsPerHost.
+
+"""
+
+from firecam.lib import settings
+
+import os
+import logging
+import threading
+import time
+import urllib.parse
+import hashlib
+import requests
+
+DEFAULT_TIMEOUT = 30 # seconds
+DEFAULT_CONNECTIONS_PER_HOST = 8
+CHUNK_BYTES = 64*1024
+STATS_INTERVAL = 10*60 # minimum time between logging stats
+
+
+class HttpFetcher(object):
+    def __init__(self, connectionsPerHost=DEFAULT_CONNECTIONS_PER_HOST, timeout=DEFAULT_TIMEOUT):
+        """Fetcher with pooled keep-alive connections and per host concurrency limits
+
+        Args:
+            connectionsPerHost (int): max concurrent requests (and pooled connections) per host
+            timeout (float): seconds to wait for connecting and for each read
+        """
+        self.connectionsPerHost = connectionsPerHost
+        self.timeout = timeout
+        self.hosts = {} # host -> (requests.Session, threading.BoundedSemaphore)
+        self.validators = {} # url -> (ETag, Last-Modified) of last response
+        self.lock = threading.Lock()
+        self.lastStatsTime = time.time()
+        self.stats = {'fetches': 0, 'notModified': 0, 'rejected': 0, 'errors': 0, 'bytes': 0, 'waits': 0}
+
+
+    def _logStats(self):
+        timeNow = time.time()
+        if timeNow - self.lastStatsTime < STATS_INTERVAL:
+            return
+        self.lastStatsTime = timeNow
+        logging.warning('HttpFetcher stats %s, hosts %d', self.stats, len(self.hosts))
+
+
+    def _addStats(self, **counts):
+        with self.lock:
+            for (name, count) in counts.items():
+                self.stats[name] += count
+            self._logStats()
+
+
+    def _getHost(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.connectionsPerHost)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.hosts[host] = (session, threading.BoundedSemaphore(self.connectionsPerHost))
+            return self.hosts[host]
+
+
+    def _writeFile(self, filePath, chunks, acceptFn):
+        # write to temporary file and rename so readers never see partial files
+        md5 = hashlib.md5()
+        numBytes = 0
+        tmpPath = filePath + '.tmp'
+        try:
+            with open(tmpPath, 'wb') as tmpFile:
+                for chunk in chunks:
+                    md5.update(chunk)
+                    numBytes += len(chunk)
+                    tmpFile.write(chunk)
+            digest = md5.hexdigest()
+            if acceptFn and not acceptFn(digest):
+                return (None, numBytes)
+            os.replace(tmpPath, filePath)
+            return (digest, numBytes)
+        finally:
+            if os.path.exists(tmpPath): # rejected or failed
+                os.remove(tmpPath)
+
+
+    def fetch(self, url, filePath, acceptFn=None):
+        """Download given URL to given file, unless it hasn't changed since the last fetch
+
+        Args:
+            url (str): URL to fetch
+            filePath (str): path of file to write
+            acceptFn (function): [optional] called with md5 hex digest of the content once it's
+                                 received, before the file is renamed into place.  If it returns False,
+                                 the file isn't written
+
+        Returns:
+            md5 hex digest of the content if file was written, None if URL content is unchanged (HTTP 304)
+            or rejected by acceptFn
+        """
+        (session, semaphore) = self._getHost(url)
+        headers = {}
+        with self.lock:
+            (etag, lastModified) = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if lastModified:
+            headers['If-Modified-Since'] = lastModified
+
+        if not semaphore.acquire(blocking=False):
+            self._addStats(waits=1)
+            semaphore.acquire()
+        try:
+            with session.get(url, headers=headers, timeout=self.timeout, stream=True) as resp:
+                if resp.status_code == 304:
+                    resp.content # consume (empty) body, so connection is returned to the pool instead of closed
+                    self._addStats(notModified=1)
+                    return None
+                resp.raise_for_status()
+                (digest, numBytes) = self._writeFile(filePath, resp.iter_content(CHUNK_BYTES), acceptFn)
+                etag = resp.headers.get('ETag')
+                lastModified = resp.headers.get('Last-Modified')
+        except Exception:
+            self._addStats(errors=1)
+            raise
+        finally:
+            semaphore.release()
+
+        with self.lock:
+            if etag or lastModified:
+                self.validators[url] = (etag, lastModified)
+            else:
+                self.validators.pop(url, None)
+        self._addStats(fetches=1, bytes=numBytes, rejected=(0 if digest else 1))
+        return digest
+
+
+def getHttpFetcher():
+    """Return the process wide fetcher configured by settings
+    """
+    # lock so threads calling this concurrently the first time don't create separate fetchers
+    with getHttpFetcher.lock:
+        if not getHttpFetcher.fetcher:
+            timeout = getattr(settings, 'httpTimeout', None) or DEFAULT_TIMEOUT
+            connectionsPerHost = getattr(settings, 'httpConnectionsPerHost', None) or DEFAULT_CONNECTIONS_PER_HOST
+            getHttpFetcher.fetcher = HttpFetcher(connectionsPerHost, timeout)
+        return getHttpFetcher.fetcher
+getHttpFetcher.fetcher = None
+getHttpFetcher.lock = threading.Lock()
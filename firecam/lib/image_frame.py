@@ -0,0 +1,151 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Frame holds one image file along with lazily computed views of it (raw
+bytes, PIL image, uint8 numpy array) and metadata (size, md5, EXIF
+timestamp), so the detection and alerting steps handling the same image
+read and decode it at most once.
+
+"""
+
+import io
+import re
+import hashlib
+import dateutil.parser
+import numpy as np
+import cv2
+from PIL import Image
+
+
+def asFrame(imgPathOrFrame):
+    """Return a Frame for the given image path, or the given Frame itself
+    """
+    if isinstance(imgPathOrFrame, Frame):
+        return imgPathOrFrame
+    return Frame(imgPathOrFrame)
+
+
+def parseExifTimestamp(imgExif):
+    """Parse the image timestamp from given EXIF data
+
+    Args:
+        imgExif (bytes): EXIF data from image header
+
+    Returns:
+        unix timestamp (int) or None if not found
+    """
+    imgExifStr = imgExif.decode('utf-8','ignore')
+    utcMatch = imgExifStr and re.findall(r'(\d+) UTC', imgExifStr)
+    dateStrMatch = imgExifStr and re.findall(r'(20\d\d):(\d\d):(\d\d) (\d\d:\d\d:\d\d)', imgExifStr)
+    if utcMatch and len(utcMatch):
+        return int(utcMatch[0])
+    elif dateStrMatch and len(dateStrMatch):
+        dateStrUtc = '%s-%s-%s %sZ' % (dateStrMatch[0][0], dateStrMatch[0][1], dateStrMatch[0][2], dateStrMatch[0][3])
+        return int(dateutil.parser.parse(dateStrUtc).timestamp())
+    return None
+
+
+class Frame(object):
+    def __init__(self, path, data=None):
+        """Image file with lazily read and decoded data
+
+        Args:
+            path (str): filepath of the image
+            data (bytes): [optional] contents of the file if already in memory
+        """
+        self.path = path
+        self.data = data
+        self.img = None
+        self.imgArray = None
+        self.grayArray = None
+        self.size = None
+        self.md5 = None
+
+
+    def getBytes(self):
+        """Return the contents of the image file (read on first use)
+        """
+        if self.data is None:
+            with open(self.path, 'rb') as imgFile:
+                self.data = imgFile.read()
+        return self.data
+
+
+    def getMd5(self):
+        if self.md5 is None:
+            self.md5 = hashlib.md5(self.getBytes()).hexdigest()
+        return self.md5
+
+
+    def getImage(self):
+        """Return PIL image of the frame.  Only the header is parsed until the pixels are used.
+           The image is shared by all users of the frame, so copy it before drawing on it
+        """
+        if self.img is None:
+            if self.imgArray is not None:
+                self.img = Image.fromarray(self.imgArray)
+            else:
+                self.img = Image.open(io.BytesIO(self.getBytes()))
+        return self.img
+
+
+    def getArray(self):
+        """Return the decoded uint8 RGB data (HxWx3 np.array) of the frame
+        """
+        if self.imgArray is None:
+            img = self.getImage()
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            self.imgArray = np.asarray(img, dtype=np.uint8)
+            self.size = (self.imgArray.shape[1], self.imgArray.shape[0])
+            # decoded pixels now live in imgArray, so don't keep a second copy in PIL image
+            self.img = None
+        return self.imgArray
+
+
+    def getGray(self):
+        """Return the grayscale uint8 data (HxW np.array) of the frame, e.g., for alignment
+        """
+        if self.grayArray is None:
+            self.grayArray = cv2.cvtColor(self.getArray(), cv2.COLOR_RGB2GRAY)
+        return self.grayArray
+
+
+    def getSize(self):
+        """Return (width, height) of the frame without decoding the pixels
+        """
+        if self.size is None:
+            self.size = self.getImage().size
+        return self.size
+
+
+    def getExifTimestamp(self):
+        """Return the timestamp in the EXIF header of the frame (or None if missing)
+        """
+        img = Image.open(io.BytesIO(self.getBytes())) # header only
+        imgExif = ('exif' in img.info) and img.info['exif']
+        img.close()
+        if not imgExif:
+            return None
+        return parseExifTimestamp(imgExif)
+
+
+    def release(self):
+        """Release the decoded data (keeps raw bytes and metadata)
+        """
+        self.img = None
+        self.imgArray = None
+        self.grayArray = None
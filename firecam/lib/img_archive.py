@@ -18,7 +18,11 @@ Library code to manage image archives
 
 """
 
+from firecam.lib import archive_index
 from firecam.lib import goog_helper
+from firecam.lib import http_fetcher
+from firecam.lib import image_frame
+from firecam.lib import smooth_cache
 
 import os
 import logging
@@ -29,11 +33,19 @@ import requests
 import re
 import pathlib
 import math
-from PIL import Image, ImageMath, ImageStat
+from PIL import Image
 import numpy as np
 import cv2
 import shutil
 import json
+import functools
+import collections
+import threading
+import errno
+try:
+    import fcntl
+except ImportError: # not available on windows
+    fcntl = None
 
 def isPTZ(cameraID):
     return cameraID[0:5] == 'Axis-'
@@ -51,23 +63,71 @@ def getApproxCameraSizeX(cameraID):
     return 2048 if isPTZ(cameraID) else 3072
 
 
+RECENT_HASHES_PER_CAMERA = 10
+def isNewImage(cameraID, md5):
+    """Check whether image content with given md5 is new, i.e. not among the recent images from given camera
+    recorded by recordImage.  Counts the duplicates of each camera (see getDuplicateCounts)
+
+    Args:
+        cameraID (str): ID of camera
+        md5 (str): md5 hex digest of image file contents
+
+    Returns:
+        True if image is new
+    """
+    with isNewImage.lock:
+        recentHashes = isNewImage.recentHashes.setdefault(cameraID, collections.OrderedDict())
+        if md5 in recentHashes:
+            isNewImage.duplicates[cameraID] = isNewImage.duplicates.get(cameraID, 0) + 1
+            return False
+        return True
+isNewImage.lock = threading.Lock()
+isNewImage.recentHashes = {} # cameraID -> OrderedDict of md5 (oldest first)
+isNewImage.duplicates = {} # cameraID -> number of duplicate images skipped
+
+
+def recordImage(cameraID, md5):
+    """Remember the md5 of an image from given camera that was written successfully, so isNewImage
+    rejects later copies
+
+    Args:
+        cameraID (str): ID of camera
+        md5 (str): md5 hex digest of image file contents
+    """
+    with isNewImage.lock:
+        recentHashes = isNewImage.recentHashes.setdefault(cameraID, collections.OrderedDict())
+        recentHashes[md5] = True
+        recentHashes.move_to_end(md5)
+        if len(recentHashes) > RECENT_HASHES_PER_CAMERA:
+            recentHashes.popitem(last=False)
+
+
+def getDuplicateCounts():
+    """Return dict of cameraID -> number of duplicate images skipped by fetches
+    """
+    with isNewImage.lock:
+        return dict(isNewImage.duplicates)
+
+
+def fetchNewImage(cameraID, cameraUrl, imgPath):
+    # download image unless it's the same as the last fetch (HTTP 304) or a recent image from camera
+    md5 = http_fetcher.getHttpFetcher().fetch(cameraUrl, imgPath, acceptFn=lambda md5: isNewImage(cameraID, md5))
+    if not md5:
+        return False
+    recordImage(cameraID, md5) # only once written, so failed fetches don't block the retry
+    return True
+
+
 def fetchUrlHPWren(cameraID, cameraUrl, imgDir, timestamp, imgPath):
-    urllib.request.urlretrieve(cameraUrl, imgPath)
     heading = getHeading(cameraID)
+    if not fetchNewImage(cameraID, cameraUrl, imgPath):
+        return (None, heading, timestamp) # image unchanged
     # read EXIF header for original timestamp and rename file
     img = Image.open(imgPath)
     imgExif = ('exif' in img.info) and img.info['exif']
     img.close()
     if imgExif:
-        imgExifStr = imgExif.decode('utf-8','ignore')
-        utcMatch = imgExifStr and re.findall('(\d+) UTC', imgExifStr)
-        dateStrMatch = imgExifStr and re.findall('(20\d\d):(\d\d):(\d\d) (\d\d:\d\d:\d\d)', imgExifStr)
-        newTimestamp = None
-        if utcMatch and len(utcMatch):
-            newTimestamp = int(utcMatch[0])
-        elif dateStrMatch and len(dateStrMatch):
-            dateStrUtc = '%s-%s-%s %sZ' % (dateStrMatch[0][0], dateStrMatch[0][1], dateStrMatch[0][2], dateStrMatch[0][3])
-            newTimestamp = int(dateutil.parser.parse(dateStrUtc).timestamp())
+        newTimestamp = image_frame.parseExifTimestamp(imgExif)
         if newTimestamp and (newTimestamp > timestamp - 5*60) and (newTimestamp < timestamp + 5*60):
             newImgPath = getImgPath(imgDir, cameraID, newTimestamp)
             timestamp = newTimestamp
@@ -93,7 +153,8 @@ def fetchAlertCamsInfo(alertUrl, alertApiKey):
 MAX_VALID_OLD_IMAGE_SECS = 60
 def fetchPTZ(cameraID, latestCamInfo, imgDir, timestamp, imgPath):
     cameraUrl = latestCamInfo['image']['url']
-    urllib.request.urlretrieve(cameraUrl, imgPath)
+    if not fetchNewImage(cameraID, cameraUrl, imgPath):
+        return (None, None, None, None) # image unchanged
     fov = latestCamInfo['view']['field_angle']
     if fov < 30:
         logging.error('Bad fov value %s: %s', cameraID, fov)
@@ -116,6 +177,42 @@ def fetchPTZ(cameraID, latestCamInfo, imgDir, timestamp, imgPath):
     return (imgPath, heading, timestamp, fov)
 
 
+FICLONE = 0x40049409 # linux ioctl to reflink a file
+def linkOrCopy(srcPath, destPath):
+    """Make archived image file available at given path without copying the data if possible.
+    Uses a hard link, or a reflink (copy-on-write clone) where hard links aren't allowed,
+    and falls back to copying.  Callers can delete destPath when done as with a copy, but
+    must not modify it in place (remove it first and write a new file, as alignImage does)
+
+    Args:
+        srcPath (str): path of existing file
+        destPath (str): path of new file (replaced if it exists)
+
+    Returns:
+        'link', 'reflink', or 'copy'
+    """
+    if os.path.exists(destPath):
+        if os.path.samefile(srcPath, destPath):
+            return 'link'
+        os.remove(destPath)
+    try:
+        os.link(srcPath, destPath)
+        return 'link'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        linkErrno = e.errno
+    if fcntl and (linkErrno != errno.EXDEV): # reflinks don't cross filesystems either
+        try:
+            with open(srcPath, 'rb') as srcFile, open(destPath, 'wb') as destFile:
+                fcntl.ioctl(destFile.fileno(), FICLONE, srcFile.fileno())
+            return 'reflink'
+        except OSError:
+            pass # e.g., filesystem without reflinks
+    shutil.copy(srcPath, destPath)
+    return 'copy'
+
+
 def fetchCurrentFromDB(dbManager, cameraID, imgDir, timestamp):
     sqlTemplate = """SELECT i.heading as heading, i.maxts as maxts, o.fieldofview as fov, o.imagepath as maxpath, o.processed as processed
                        FROM archive o
@@ -134,7 +231,7 @@ def fetchCurrentFromDB(dbManager, cameraID, imgDir, timestamp):
             continue
         srcFilePP = pathlib.PurePath(imgInfo['maxpath'])
         destPath = os.path.join(imgDir, srcFilePP.name)
-        shutil.copy(imgInfo['maxpath'], destPath)
+        linkOrCopy(imgInfo['maxpath'], destPath)
         result.append((destPath, imgInfo['heading'], imgInfo['maxts'], imgInfo['fov']))
     if len(result) > 0:
         return result
@@ -151,7 +248,8 @@ def fetchImageAndMeta(dbManager, cameraID, cameraUrl, imgDir, newOnly=False, lat
         imgDir (str): Output directory to store iamge
 
     Returns:
-        Tuple containing filepath of the image, current heading and timestamp
+        Tuple containing filepath of the image, current heading, timestamp, and fov.
+        With newOnly, filepath is None if the image is unchanged (nothing is written)
     """
     timestamp = int(time.time())
     imgPath = getImgPath(imgDir, cameraID, timestamp)
@@ -173,6 +271,54 @@ def fetchImageAndMeta(dbManager, cameraID, cameraUrl, imgDir, newOnly=False, lat
         return fetchImageAndMeta(dbManager, cameraID, cameraUrl, imgDir, newOnly=True)
 
 
+SPIN_CHECK_ENTRIES = 3
+def getRecentArchiveEntries(dbManager, minTimestamp, numEntries=SPIN_CHECK_ENTRIES):
+    """Get the most recent archive entries of every camera with a single query
+
+    Args:
+        dbManager (DbManager):
+        minTimestamp (int): only entries after this time
+        numEntries (int): max entries per camera
+
+    Returns:
+        Dict of cameraID -> list of (heading, timestamp), most recent first
+    """
+    sqlTemplate = """SELECT cameraid, heading, timestamp FROM
+                       (SELECT CameraID as cameraid, heading, timestamp,
+                               ROW_NUMBER() OVER (PARTITION BY CameraID ORDER BY timestamp desc) as rownum
+                          FROM archive WHERE timestamp > %s) recent
+                       WHERE rownum <= %s ORDER BY cameraid, timestamp desc"""
+    sqlStr = sqlTemplate % (minTimestamp, numEntries)
+    dbResult = dbManager.query(sqlStr)
+    result = {}
+    for dbRow in dbResult:
+        result.setdefault(dbRow['cameraid'], []).append((dbRow['heading'], dbRow['timestamp']))
+    return result
+
+
+def getSpinFetchInfo(recentEntries, minTimestamp):
+    """Determine whether camera is rotating and when it was last fetched from its recent archive entries
+    If all the last 3 entries have the same heading, camera is not rotating
+
+    Args:
+        recentEntries (list): list of (heading, timestamp), most recent first
+        minTimestamp (int): ignore entries before this time
+
+    Returns:
+        Tuple of (isRotating, last fetch time or 0)
+    """
+    recentEntries = [entry for entry in recentEntries[:SPIN_CHECK_ENTRIES] if entry[1] > minTimestamp]
+    if len(recentEntries) == 0:
+        return (False, 0)
+    rot = False
+    topHeading = recentEntries[0][0]
+    for (heading, timestamp) in recentEntries:
+        if abs(heading - topHeading) % 360 > 1: # allow 1 degree difference
+            rot = True
+            break
+    return (rot, recentEntries[0][1])
+
+
 def getDBImages(dbManager, outputDir, cameraID, heading, startTimeDT, endTimeDT, gapMinutes):
     # heading is approximate, so we get images within 1 degree of heading
     sqlTemplate = """SELECT timestamp, imagepath FROM archive
@@ -188,7 +334,7 @@ def getDBImages(dbManager, outputDir, cameraID, heading, startTimeDT, endTimeDT,
         srcPath = imgInfo['imagepath']
         srcFilePP = pathlib.PurePath(srcPath)
         destPath = os.path.join(outputDir, srcFilePP.name)
-        shutil.copy(srcPath, destPath)
+        linkOrCopy(srcPath, destPath)
         result.append(destPath)
     return result
 
@@ -197,7 +343,7 @@ def markImageProcessed(dbManager, cameraID, heading, timestamp):
     sqlTemplate = """UPDATE archive SET processed = 1
                         WHERE CameraID='%s' and heading=%s and timestamp = %s"""
     sqlStr = sqlTemplate % (cameraID, heading, timestamp)
-    dbManager.execute(sqlStr)
+    dbManager.executeDeferred(sqlStr)
 
 
 def getImgPath(outputDir, cameraID, timestamp, cropCoords=None, diffMinutes=0):
@@ -245,46 +391,51 @@ def repackFileName(parsedName):
                       diffMinutes=parsedName['diffMinutes'])
 
 
-def parseFilename(fileName):
-    """Parse the image source attributes given the properly formatted image filename
+# regex to match names like Axis-BaldCA_2018-05-29T16_02_30_129496.jpg
+# and bm-n-mobo-c__2017-06-25z11;53;33.jpg
+regexExpanded = r'([A-Za-z0-9-_]+[^_])_+(\d{4})-(\d\d)-(\d\d)T(\d\d)[_;](\d\d)[_;](\d\d)'
+# regex to match diff minutes spec for subtracted images
+regexDiff = r'(_Diff(\d+))?'
+# regex to match optional crop information e.g., Axis-Cowles_2019-02-19T16;23;49_Crop_270x521x569x820.jpg
+regexOptionalCrop = r'(_Crop_(-?\d+)x(-?\d+)x(\d+)x(\d+))?'
+# regex to match names like 1499546263.jpg
+regexUnixTime = r'(1\d{9})'
+patternExpanded = re.compile(regexExpanded + regexDiff + regexOptionalCrop)
+patternUnixTime = re.compile(regexUnixTime + regexDiff + regexOptionalCrop)
 
-    Args:
-        fileName (str):
 
-    Returns:
-        Dictionary with parsed out attributes
+@functools.lru_cache(maxsize=100000)
+def _getLocalHourStart(year, month, day, hour):
+    """Return unix time of the start of given hour in local time (all names are in local time)
     """
-    # regex to match names like Axis-BaldCA_2018-05-29T16_02_30_129496.jpg
-    # and bm-n-mobo-c__2017-06-25z11;53;33.jpg
-    regexExpanded = '([A-Za-z0-9-_]+[^_])_+(\d{4}-\d\d-\d\d)T(\d\d)[_;](\d\d)[_;](\d\d)'
-    # regex to match diff minutes spec for subtracted images
-    regexDiff = '(_Diff(\d+))?'
-    # regex to match optional crop information e.g., Axis-Cowles_2019-02-19T16;23;49_Crop_270x521x569x820.jpg
-    regexOptionalCrop = '(_Crop_(-?\d+)x(-?\d+)x(\d+)x(\d+))?'
-    matchesExp = re.findall(regexExpanded + regexDiff + regexOptionalCrop, fileName)
-    # regex to match names like 1499546263.jpg
-    regexUnixTime = '(1\d{9})'
-    matchesUnix = re.findall(regexUnixTime + regexDiff + regexOptionalCrop, fileName)
+    return int(datetime.datetime(year, month, day, hour).timestamp())
+
+
+@functools.lru_cache(maxsize=100000)
+def _parseFilenameCached(fileName):
+    matchesExp = patternExpanded.findall(fileName)
     cropInfo = None
     if len(matchesExp) == 1:
         match = matchesExp[0]
         parsed = {
             'cameraID': match[0],
-            'date': match[1],
-            'hours': match[2],
-            'minutes': match[3],
-            'seconds': match[4]
+            'date': '%s-%s-%s' % (match[1], match[2], match[3]),
+            'hours': match[4],
+            'minutes': match[5],
+            'seconds': match[6]
         }
         isoStr = '{date}T{hour}:{min}:{sec}'.format(date=parsed['date'],hour=parsed['hours'],min=parsed['minutes'],sec=parsed['seconds'])
-        dt = dateutil.parser.parse(isoStr)
-        unixTime = int(dt.timestamp())
-        parsed['diffMinutes'] = int(match[6] or 0)
+        unixTime = _getLocalHourStart(int(match[1]), int(match[2]), int(match[3]), int(match[4])) + int(match[5])*60 + int(match[6])
+        parsed['diffMinutes'] = int(match[8] or 0)
         cropInfo = match[-4:]
-    elif len(matchesUnix) == 1:
+    else:
+        matchesUnix = patternUnixTime.findall(fileName)
+        if len(matchesUnix) != 1:
+            return None
         match = matchesUnix[0]
         unixTime = int(match[0])
         dt = datetime.datetime.fromtimestamp(unixTime)
-        isoStr = datetime.datetime.fromtimestamp(unixTime).isoformat()
+        isoStr = dt.isoformat()
         parsed = {
             'cameraID': 'UNKNOWN_' + fileName,
             'date': dt.date().isoformat(),
@@ -294,9 +445,6 @@ def parseFilename(fileName):
         }
         parsed['diffMinutes'] = int(match[2] or 0)
         cropInfo = match[-4:]
-    else:
-        logging.error('Failed to parse name %s', fileName)
-        return None
     if cropInfo[0]:
         parsed['minX'] = int(cropInfo[0])
         parsed['minY'] = int(cropInfo[1])
@@ -307,6 +455,51 @@ def parseFilename(fileName):
     return parsed
 
 
+def parseFilename(fileName):
+    """Parse the image source attributes given the properly formatted image filename.
+       Results are memoized, so parsing the same names again is cheap
+
+    Args:
+        fileName (str):
+
+    Returns:
+        Dictionary with parsed out attributes
+    """
+    parsed = _parseFilenameCached(fileName)
+    if not parsed:
+        logging.error('Failed to parse name %s', fileName)
+        return None
+    return parsed.copy() # callers may modify the result
+
+
+def parseFilenames(fileNames):
+    """Parse the camera IDs and timestamps of given list of filenames into numpy arrays
+
+    Args:
+        fileNames (list): list of names (or paths) of image files
+
+    Returns:
+        Tuple (cameraIDs, cameraCodes, unixTimes) where cameraCodes (np.int32) is the index
+        into cameraIDs list of the camera of each file (or -1 for names that don't parse),
+        and unixTimes (np.int64) is the timestamp of each file (0 if not parsed)
+    """
+    cameraIDs = []
+    cameraIndexes = {}
+    cameraCodes = np.full(len(fileNames), -1, dtype=np.int32)
+    unixTimes = np.zeros(len(fileNames), dtype=np.int64)
+    for (index, fileName) in enumerate(fileNames):
+        parsed = _parseFilenameCached(fileName)
+        if not parsed:
+            continue
+        cameraID = parsed['cameraID']
+        if cameraID not in cameraIndexes:
+            cameraIndexes[cameraID] = len(cameraIDs)
+            cameraIDs.append(cameraID)
+        cameraCodes[index] = cameraIndexes[cameraID]
+        unixTimes[index] = parsed['unixTime']
+    return (cameraIDs, cameraCodes, unixTimes)
+
+
 def getHeading(cameraID):
     """Return the heading (direction in degrees where 0 = North) of the given camera
 
@@ -790,9 +983,9 @@ def getHpwrenImages(googleServices, settings, outputDir, camArchives, cameraID,
     """
     # If outputDir is a cache object, fetch the real outputDir and set 'cache' variable
     cache = None
-    if (not isinstance(outputDir, str)) and ('writeDir' in outputDir):
+    if isinstance(outputDir, archive_index.ArchiveIndex):
         cache = outputDir
-        outputDir = cache['writeDir']
+        outputDir = cache.writeDir
 
     # In cache mode, check local cache for existing files before checking remote archive
     if cache:
@@ -826,7 +1019,7 @@ def getHpwrenImages(googleServices, settings, outputDir, camArchives, cameraID,
         if found:
             break
     # If new files were added to cache directory, update cache object
-    if cache and found and (cache['readDir'] == cache['writeDir']):
+    if cache and found and (cache.readDir == cache.writeDir):
         for filePath in found:
             cacheInsert(cache, filePath)
     return found
@@ -848,104 +1041,175 @@ def cacheInsert(cache, fileName):
     """Insert given file into given cache object
 
     Args:
-        cache (dict): Cache object created by cacheDir()
+        cache (ArchiveIndex): Cache object created by cacheDir()
         fileName (str): name or path of file to insert
     """
-    nameParsed = parseFilename(fileName)
-    if nameParsed and nameParsed['cameraID']:
-        cameraID = nameParsed['cameraID']
-        unixTime = nameParsed['unixTime']
-        if not cameraID in cache:
-            cache[cameraID] = []
-        cameraTimes = cache[cameraID]
-        ppath = pathlib.PurePath(fileName)
-        cameraTimes.append({'time': unixTime, 'fileName': str(ppath.name)})
+    cache.insert(fileName)
 
 
 def cacheFindEntry(cache, cameraID, desiredTime):
     """Search given cache for image from given camera at given timestamp (within 30 seconds)
 
     Args:
-        cache (dict): Cache object created by cacheDir()
+        cache (ArchiveIndex): Cache object created by cacheDir()
         cameraID (str): ID of camera to fetch images from
         desiredTime (int): unix time of desired image
 
     Returns:
         File path of image or None
     """
-    if not cameraID in cache:
-        return None
-    cameraTimes = cache[cameraID]
-    closestEntry = min(cameraTimes, key=lambda x: abs(x['time'] - desiredTime))
-    if abs(closestEntry['time'] - desiredTime) < 30:
-        # logging.warning('close: %s', str(closestEntry))
-        return os.path.join(cache['readDir'], closestEntry['fileName'])
-    else:
-        # logging.warning('far: %s, %s', str(desiredTime), str(closestEntry))
-        return None
+    closestEntry = cache.findClosest(cameraID, desiredTime)
+    if closestEntry and (abs(closestEntry[0] - desiredTime) < 30):
+        return cache.getPath(closestEntry[1])
+    return None
 
 
 def cacheFetchRange(cache, cameraID, maxTime, desiredOffset, minOffset):
-    if not cameraID in cache:
-        return None
-    cameraTimes = cache[cameraID]
-    minTime = maxTime + minOffset
+    """Return paths of images from given camera in the time range (maxTime + minOffset, maxTime)
+       sorted by distance from maxTime + desiredOffset (None if no images in range)
+    """
     desiredTime = maxTime + desiredOffset
-    allowedEntries = list(filter(lambda x: (x['time'] > minTime) and (x['time'] < maxTime), cameraTimes))
+    allowedEntries = cache.fetchRange(cameraID, maxTime + minOffset, maxTime)
     if len(allowedEntries) == 0:
         return None
-    sortedEntries = sorted(allowedEntries, key=lambda x: abs(x['time'] - desiredTime))
-    return list(map(lambda x: os.path.join(cache['readDir'], x['fileName']), sortedEntries))
+    sortedEntries = sorted(allowedEntries, key=lambda x: abs(x[0] - desiredTime))
+    return [cache.getPath(x[1]) for x in sortedEntries]
 
 
 def cacheDir(readDirPath, writeDirPath=None):
-    """Create a cache of iamges in given directory and return the cache object
+    """Create a cache of iamges in given directory and return the cache object.
+       The cache is persisted in a sidecar file under the directory (if writable),
+       so later calls only need to parse the names of new files
 
     Args:
         readDirPath (str): path to directory containing images
+        writeDirPath (str): [optional] directory where new images are downloaded (default readDirPath)
 
     Returns:
-        Cache object
+        Cache object (ArchiveIndex)
     """
-    imageFileNames = sorted(os.listdir(readDirPath))
-    cache = {
-        'readDir': readDirPath,
-        'writeDir': writeDirPath or readDirPath
-    }
-    for fileName in imageFileNames:
-        if fileName[-4:] != '.jpg':
-            continue
-        cacheInsert(cache, fileName)
-    return cache
+    indexPath = None
+    if os.access(readDirPath, os.W_OK|os.X_OK):
+        indexPath = archive_index.getIndexPath(readDirPath)
+    return archive_index.ArchiveIndex(parseFilename, readDirPath, writeDirPath, indexPath)
 
 
-def findTranslationOffset(cvImgA, cvImgB, maxIterations, eps):
-    if cvImgA.shape[0] > 1000:
+def getAlignmentMargins(imgHeight):
+    """Return heights of header and footer of images excluded from alignment
+    """
+    if imgHeight > 1000:
         headerHeight = 250 # clouds, metadata, and watermark
         footerHeight = 250 # nearby trees moving with wind and shadows, metadata, and watermark
-    elif cvImgA.shape[0] > 300:
+    elif imgHeight > 300:
         headerHeight = 100 # clouds, metadata, and watermark
         footerHeight = 100 # nearby trees moving with wind and shadows, metadata, and watermark
     else:
         headerHeight = 0 # too small for headers and footers
         footerHeight = 0
-    footerPos = cvImgA.shape[0] - footerHeight
-    grayA = cv2.cvtColor(cvImgA[headerHeight:footerPos], cv2.COLOR_BGR2GRAY)
-    grayB = cv2.cvtColor(cvImgB[headerHeight:footerPos], cv2.COLOR_BGR2GRAY)
+    return (headerHeight, footerHeight)
+
+
+COARSE_ALIGN_WIDTH = 800 # downsample to at most this width for initial estimate of the shift
+COARSE_ALIGN_MIN_RESPONSE = 0.05 # ignore weaker phase correlation peaks
+CONFIDENT_ECC_ITERATIONS = 1 # full resolution ECC iterations after a confident estimate is refined at half resolution
+
+def estimateTranslation(grayA, grayB):
+    """Estimate the translation between the given grayscale images by phase
+       correlation of downsampled copies (gaussian pyramid)
+
+    Returns:
+        (dx, dy) estimate in pixels of full resolution images, or None if no clear peak
+    """
+    scale = 1
+    while grayA.shape[1] / scale > COARSE_ALIGN_WIDTH:
+        scale *= 2
+    coarseA = grayA
+    coarseB = grayB
+    for i in range(int(math.log2(scale))):
+        coarseA = cv2.pyrDown(coarseA)
+        coarseB = cv2.pyrDown(coarseB)
+    shape = (coarseA.shape[1], coarseA.shape[0])
+    if getattr(estimateTranslation, 'windowShape', None) != shape:
+        estimateTranslation.window = cv2.createHanningWindow(shape, cv2.CV_32F)
+        estimateTranslation.windowShape = shape
+    ((dx, dy), response) = cv2.phaseCorrelate(np.float32(coarseA), np.float32(coarseB), estimateTranslation.window)
+    if response < COARSE_ALIGN_MIN_RESPONSE:
+        return None
+    return (dx * scale, dy * scale)
+
+
+def refineTranslationHalf(grayA, grayB, warp_matrix, maxIterations, eps):
+    """Refine the translation estimate with ECC on half resolution copies of the images,
+       where each iteration costs about a quarter of a full resolution iteration
+
+    Returns:
+        warp matrix for full resolution images, or None if ECC failed or the shift is implausible
+    """
+    halfWarp = warp_matrix.copy()
+    halfWarp[:, 2] /= 2
+    try:
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, maxIterations, eps)
+        (cc, halfWarp) = cv2.findTransformECC(cv2.pyrDown(grayA), cv2.pyrDown(grayB), halfWarp, cv2.MOTION_TRANSLATION, criteria)
+    except Exception as e:
+        return None
+    fullWarp = halfWarp.copy()
+    fullWarp[:, 2] *= 2
+    if (abs(fullWarp[0][2]) > 20) or (abs(fullWarp[1][2]) > 10):
+        return None
+    return fullWarp
+
+
+def findTranslationOffsetGray(grayA, grayB, maxIterations, eps, coarseToFine=True):
+    """Find the translation of grayB relative to grayA (both full frame grayscale images)
+
+    Args:
+        grayA (np.array): base grayscale image
+        grayB (np.array): grayscale image to align with base image
+        maxIterations (int): max iterations of ECC refinement
+        eps (float): ECC termination epsilon
+        coarseToFine (bool): start ECC refinement from phase correlation estimate at low resolution
+                             and refine it at half resolution, so full resolution ECC only needs
+                             CONFIDENT_ECC_ITERATIONS before the convergence check
+
+    Returns:
+        (alignable, dx, dy) tuple
+    """
+    (headerHeight, footerHeight) = getAlignmentMargins(grayA.shape[0])
+    footerPos = grayA.shape[0] - footerHeight
+    grayA = grayA[headerHeight:footerPos]
+    grayB = grayB[headerHeight:footerPos]
     warp_matrix = np.eye(2, 3, dtype=np.float32)
+    fullIterations = maxIterations
+    if coarseToFine:
+        estimate = estimateTranslation(grayA, grayB)
+        # only use plausible estimates, otherwise start from zero shift like the full resolution search
+        if estimate and (abs(estimate[0]) <= 20) and (abs(estimate[1]) <= 10):
+            warp_matrix[0][2] = estimate[0]
+            warp_matrix[1][2] = estimate[1]
+            refined = refineTranslationHalf(grayA, grayB, warp_matrix, maxIterations, eps)
+            if refined is not None:
+                warp_matrix = refined
+                fullIterations = CONFIDENT_ECC_ITERATIONS
 
+    epsAllowance = 10 * eps # allow up 10 eps change to mean convergence (truly unaligned images are > 1000*eps)
     try:
         # find optimal shifts limited to given maxIterations
-        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, maxIterations, eps)
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, fullIterations, eps)
         (cc0, warp_matrix0) = cv2.findTransformECC(grayA, grayB, warp_matrix, cv2.MOTION_TRANSLATION, criteria)
 
         # check another 10 iterations to determine if findTransformECC has converged
         criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, eps)
         (cc1, warp_matrix1) = cv2.findTransformECC(grayA, grayB, warp_matrix0, cv2.MOTION_TRANSLATION, criteria)
+
+        if (fullIterations < maxIterations) and (cc0 < cc1 - epsAllowance):
+            # half resolution refinement wasn't close enough, so continue with all maxIterations
+            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, maxIterations, eps)
+            (cc0, warp_matrix0) = cv2.findTransformECC(grayA, grayB, warp_matrix1, cv2.MOTION_TRANSLATION, criteria)
+            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, eps)
+            (cc1, warp_matrix1) = cv2.findTransformECC(grayA, grayB, warp_matrix0, cv2.MOTION_TRANSLATION, criteria)
     except Exception as e:
         return (False, None, None) # alignment failed
 
-    epsAllowance = 10 * eps # allow up 10 eps change to mean convergence (truly unaligned images are > 1000*eps)
     dx = warp_matrix1[0][2]
     dy = warp_matrix1[1][2]
     logging.warning('Translation: %s: %s, %s, %s , %s', cc0 >= cc1 - epsAllowance, round((cc1-cc0)/eps,1), round(cc1, 4), round(dx, 1), round(dy, 1))
@@ -954,12 +1218,28 @@ def findTranslationOffset(cvImgA, cvImgB, maxIterations, eps):
     return (True, dx, dy)
 
 
-def alignImageObj(imgFileName, baseImgFileName, noShift=False):
+def findTranslationOffset(cvImgA, cvImgB, maxIterations, eps, coarseToFine=True):
+    grayA = cv2.cvtColor(cvImgA, cv2.COLOR_BGR2GRAY)
+    grayB = cv2.cvtColor(cvImgB, cv2.COLOR_BGR2GRAY)
+    return findTranslationOffsetGray(grayA, grayB, maxIterations, eps, coarseToFine)
+
+
+def alignImageObj(imgFileName, baseImg, noShift=False):
+    """Align the given image to the base image
+
+    Args:
+        imgFileName (str): filepath of image to align
+        baseImg (str or Frame): filepath or Frame of the base image.  Passing a Frame
+                                avoids decoding and converting the base image again for each aligned image
+
+    Returns:
+        Pillow image object aligned to base image, or None if alignment failed
+    """
     maxIterations = 40
     terminationEps = 1e-6
-    imgCv = cv2.imread(imgFileName)
-    baseImgCv = cv2.imread(baseImgFileName)
-    (alignable, dx, dy) = findTranslationOffset(baseImgCv, imgCv, maxIterations, terminationEps)
+    grayImg = cv2.cvtColor(cv2.imread(imgFileName), cv2.COLOR_BGR2GRAY)
+    grayBase = image_frame.asFrame(baseImg).getGray()
+    (alignable, dx, dy) = findTranslationOffsetGray(grayBase, grayImg, maxIterations, terminationEps)
     if alignable:
         if round(dx) == 0 and round(dy) == 0: # optimization for sub-pixel shifts
             return Image.open(imgFileName)
@@ -973,8 +1253,32 @@ def alignImageObj(imgFileName, baseImgFileName, noShift=False):
     return None
 
 
-def alignImage(imgFileName, baseImgFileName):
-    shiftedImg = alignImageObj(imgFileName, baseImgFileName)
+def alignArray(imgArray, baseImg):
+    """Align the given decoded image to the base image (same as alignImageObj for decoded images)
+
+    Args:
+        imgArray (np.array): uint8 RGB data (HxWx3) of image to align
+        baseImg (str or Frame): filepath or Frame of the base image
+
+    Returns:
+        np.array of image aligned to base image, or None if alignment failed
+    """
+    maxIterations = 40
+    terminationEps = 1e-6
+    grayImg = cv2.cvtColor(imgArray, cv2.COLOR_RGB2GRAY)
+    grayBase = image_frame.asFrame(baseImg).getGray()
+    (alignable, dx, dy) = findTranslationOffsetGray(grayBase, grayImg, maxIterations, terminationEps)
+    if not alignable:
+        return None
+    if round(dx) == 0 and round(dy) == 0: # optimization for sub-pixel shifts
+        return imgArray
+    logging.warning('shifting image dx, dy: %s, %s', round(dx), round(dy))
+    img = Image.fromarray(imgArray)
+    return np.asarray(img.transform(img.size, Image.AFFINE, (1, 0, dx, 0, 1, dy)))
+
+
+def alignImage(imgFileName, baseImg):
+    shiftedImg = alignImageObj(imgFileName, baseImg)
     if shiftedImg:
         shiftedImg.load() # ensure file read before remove
         os.remove(imgFileName)
@@ -984,10 +1288,34 @@ def alignImage(imgFileName, baseImgFileName):
     return False
 
 
+def diffArrays(arrA, arrB):
+    """Subtract two images (r-r, g-g, b-b), and add the sum of the absolute values of the differences
+       in the red band while removing from green and blue to maintain same brightness level.
+       Uses saturating uint8 arithmetic, so out of range values (<0 and > 255) are moved to 0 and 255
+
+    Args:
+        arrA (np.array): HxWx3 uint8 RGB data of image to subtract from
+        arrB (np.array): HxWx3 uint8 RGB data of image to subtract
+
+    Returns:
+        np.array with uint8 RGB data of the results of the subtraction
+    """
+    # saturating adds of non-negative values give same result as clipping the full sum
+    (absDiff, absDiff1, absDiff2) = cv2.split(cv2.absdiff(arrA, arrB))
+    cv2.add(absDiff, absDiff1, dst=absDiff)
+    cv2.add(absDiff, absDiff2, dst=absDiff)
+    (red, green, blue) = cv2.split(arrA)
+    cv2.add(red, absDiff, dst=red)
+    cv2.add(red, absDiff, dst=red)
+    cv2.subtract(green, absDiff, dst=green)
+    cv2.subtract(blue, absDiff, dst=blue)
+    return cv2.merge([red, green, blue])
+
+
 def diffImages(imgA, imgB):
     """Subtract two images (r-r, g-g, b-b), and add the absolute value of that difference
        in the red band while removing from green and blue to maintain same brightness level
-       Out of range values (<0 and > 255) are moved to 0 and 255 by the convert('L') function
+       Out of range values (<0 and > 255) are moved to 0 and 255 (see diffArrays)
 
     Args:
         imgA: Pillow image object to subtract from
@@ -996,43 +1324,43 @@ def diffImages(imgA, imgB):
     Returns:
         Pillow image object containing the results of the subtraction with 128 mean
     """
-    bandsImgA = imgA.split()
-    bandsImgB = imgB.split()
+    return Image.fromarray(diffArrays(np.asarray(imgA), np.asarray(imgB)))
 
-    absDiff = ImageMath.eval("convert(abs(a0-b0) + abs(a1-b1) + abs(a2-b2), 'L')",
-        a0 = bandsImgA[0], b0 = bandsImgB[0],
-        a1 = bandsImgA[1], b1 = bandsImgB[1],
-        a2 = bandsImgA[2], b2 = bandsImgB[2])
-    bandsImgOut = [
-        ImageMath.eval("convert(a + 2*diff, 'L')", a = bandsImgA[0], diff = absDiff),
-        ImageMath.eval("convert(a - diff, 'L')", a = bandsImgA[1], diff = absDiff),
-        ImageMath.eval("convert(a - diff, 'L')", a = bandsImgA[2], diff = absDiff),
-    ]
 
-    return Image.merge('RGB', bandsImgOut)
+def diffSmoothImageFiles(imgAFile, imgBFile, cachedSmoothDir=None):
+    """Subtract two image files after smoothing them first (same smoothing as diffWithChecks).
+       Smoothed data is cached by smooth_cache, so each image is only smoothed once
 
+    Args:
+        imgAFile (str): filepath of image to subtract from
+        imgBFile (str): filepath of image to subtract
+        cachedSmoothDir (str): [optional] directory to cache smoothed data on disk (default settings.smoothCacheDir)
 
-def smoothAndCache(imgPath, outputDir):
-    ppath = pathlib.PurePath(imgPath)
-    # add 's_' prefix to denote smoothed images
-    smoothImgPath = os.path.join(outputDir, 's_' + str(ppath.name))
-    if os.path.isfile(smoothImgPath): # smooth image already generated
-        return smoothImgPath
+    Returns:
+        Pillow image object containing the results of the subtraction with 128 mean
+    """
+    smoothCache = smooth_cache.getSmoothCache()
+    if cachedSmoothDir and (cachedSmoothDir != smoothCache.cacheDir):
+        smoothCache = smooth_cache.SmoothCache(smoothCache.maxBytes, cachedSmoothDir, smoothCache.maxDiskBytes)
+    smoothA = getSmoothed(getDiffInput(imgAFile), smoothCache)
+    smoothB = getSmoothed(getDiffInput(imgBFile), smoothCache)
+    return Image.fromarray(diffArrays(smoothA, smoothB))
 
-    img = cv2.imread(imgPath)
-    smoothImg = cv2.fastNlMeansDenoisingColored(img, None, 10,10,7,21)
-    cv2.imwrite(smoothImgPath, smoothImg)
-    return smoothImgPath
 
+SMOOTH_PARAMS = ('bilateral', 9, 75, 75) # smoothArray filter, part of smooth_cache keys
 
-def diffSmoothImageFiles(imgAFile, imgBFile, cachedSmoothDir='.'):
-    smoothImgAPath = smoothAndCache(imgAFile, cachedSmoothDir)
-    smoothImgAPillow = Image.open(smoothImgAPath)
+def smoothArray(arr):
+    """Smooth the given image data
 
-    smoothImgBPath = smoothAndCache(imgBFile, cachedSmoothDir)
-    smoothImgBPillow = Image.open(smoothImgBPath)
+    Args:
+        arr (np.array): HxWx3 uint8 image data
 
-    return diffImages(smoothImgAPillow, smoothImgBPillow)
+    Returns:
+        np.array with smoothed image data
+    """
+    # bilateral filter treats all channels the same way, so no need to convert between RGB and BGR
+    # smoothArr = cv2.fastNlMeansDenoisingColored(arr, None, 10,10,7,21)
+    return cv2.bilateralFilter(arr, SMOOTH_PARAMS[1], SMOOTH_PARAMS[2], SMOOTH_PARAMS[3])
 
 
 def smoothImage(img):
@@ -1044,12 +1372,7 @@ def smoothImage(img):
     Returns:
         Pillow image object after smoothing
     """
-    # Pillow uses RGB and cv2 uses GBR, so have to convert before and after smoothing
-    imgBGR = cv2.cvtColor(np.asarray(img), cv2.COLOR_BGR2RGB)
-    # smoothImgBGR = cv2.fastNlMeansDenoisingColored(imgBGR, None, 10,10,7,21)
-    smoothImgBGR = cv2.bilateralFilter(imgBGR, 9, 75, 75)
-    smoothImgRGB = cv2.cvtColor(smoothImgBGR, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(smoothImgRGB)
+    return Image.fromarray(smoothArray(np.asarray(img)))
 
 
 def diffSmoothImages(imgA, imgB):
@@ -1062,45 +1385,108 @@ def diffSmoothImages(imgA, imgB):
     Returns:
         Pillow image object containing the results of the subtraction with 128 mean
     """
-
-    smoothImgA = smoothImage(imgA)
-    smoothImgB = smoothImage(imgB)
-
-    return diffImages(smoothImgA, smoothImgB)
+    return Image.fromarray(diffArrays(smoothArray(np.asarray(imgA)), smoothArray(np.asarray(imgB))))
 
 
 def rescaleValues(img, ratios):
-    bandsImg = img.split()
-    evalCmds = [
-        "convert(float(a)*%s, 'L')" % ratios[0],
-        "convert(float(a)*%s, 'L')" % ratios[1],
-        "convert(float(a)*%s, 'L')" % ratios[2],
-    ]
-    bandsImgOut = [
-        ImageMath.eval(evalCmds[0], a = bandsImg[0]),
-        ImageMath.eval(evalCmds[1], a = bandsImg[1]),
-        ImageMath.eval(evalCmds[2], a = bandsImg[2]),
-    ]
-    return Image.merge('RGB', bandsImgOut)
+    # same as converting float(band)*ratio to 'L' in Pillow (truncate and clip)
+    scaled = np.asarray(img).astype(np.float32) * np.array(ratios, dtype=np.float32)
+    return Image.fromarray(np.clip(scaled, 0, 255).astype(np.uint8))
 
 
-def brightness(img):
-    medians = ImageStat.Stat(img).median
+def brightnessArray(arr):
+    """Return average of the per band medians of given image data (same as Pillow ImageStat median)
+    """
+    halfCount = (arr.shape[0] * arr.shape[1]) // 2
+    medians = []
+    for band in range(3):
+        histogram = cv2.calcHist([arr], [band], None, [256], [0, 256]).ravel().astype(np.int64)
+        medians.append(int(np.searchsorted(np.cumsum(histogram), halfCount, side='right')))
     brightness = (medians[0] + medians[1] + medians[2]) / 3
     return max(brightness, .01) # to avoid div by 0
 
 
-def diffWithChecks(baseImg, earlierImg):
-    brightnessRatio = brightness(baseImg)/brightness(earlierImg)
+def brightness(img):
+    return brightnessArray(np.asarray(img))
+
+
+def getDiffInput(img):
+    """Return dict with the data of given image used by diffInputsWithChecks.  The
+       smoothed data is added on first use, so it can be computed once and reused
+       when the same image is compared with several others.  For image files and
+       Frames, the smoothed data is also cached across calls by smooth_cache
+
+    Args:
+        img (Pillow image, np.array, str, or Frame): image (np.array is HxWx3 uint8 RGB data, str is filepath)
+
+    Returns:
+        dict with array, brightness, smoothed (None until used), and key (for smooth_cache) entries
+    """
+    key = None
+    if isinstance(img, (str, image_frame.Frame)):
+        frame = image_frame.asFrame(img)
+        key = frame.getMd5()
+        arr = frame.getArray()
+    else:
+        arr = img if isinstance(img, np.ndarray) else np.asarray(img)
+    return {'array': arr, 'brightness': brightnessArray(arr), 'smoothed': None, 'key': key}
+
+
+def getSmoothed(diffInput, smoothCache=None):
+    """Return the smoothed data of given result of getDiffInput (computed on first use)
+
+    Args:
+        diffInput (dict): getDiffInput result
+        smoothCache (SmoothCache): [optional] cache to use instead of shared smooth_cache.getSmoothCache()
+    """
+    if diffInput['smoothed'] is None:
+        smoothFn = lambda: smoothArray(diffInput['array'])
+        if diffInput.get('key'):
+            smoothCache = smoothCache or smooth_cache.getSmoothCache()
+            diffInput['smoothed'] = smoothCache.get((diffInput['key'],) + SMOOTH_PARAMS, smoothFn)
+        else:
+            diffInput['smoothed'] = smoothFn()
+    return diffInput['smoothed']
+
+
+def diffInputsWithChecks(baseInput, earlierInput):
+    """Subtract the smoothed earlier image from the smoothed base image unless
+       the images are too different in brightness or not different at all
+
+    Args:
+        baseInput (dict): getDiffInput result for base image
+        earlierInput (dict): getDiffInput result for earlier image aligned with base image
+
+    Returns:
+        Pillow image object with the difference or None
+    """
+    brightnessRatio = baseInput['brightness']/earlierInput['brightness']
     if (brightnessRatio < 0.92) or (brightnessRatio > 1.08): # large diffs hide the smoke
         logging.warning('Skipping extreme brigthness diff %s', brightnessRatio)
         return None
-    diffImg = diffSmoothImages(baseImg, earlierImg)
-    extremas = diffImg.getextrema()
+    diffArr = diffArrays(getSmoothed(baseInput), getSmoothed(earlierInput))
+    pixels = diffArr.reshape(-1, 3)
+    minimums = pixels.min(axis=0)
+    maximums = pixels.max(axis=0)
+    extremas = list(zip(minimums.tolist(), maximums.tolist()))
     if (extremas[0][0] == 128 and extremas[0][1] == 128) or (extremas[1][0] == 128 and extremas[1][1] == 128) or (extremas[2][0] == 128 and extremas[2][1] == 128):
         logging.warning('Skipping no diffs %s', str(extremas))
         return None
-    return diffImg
+    return Image.fromarray(diffArr)
+
+
+def diffWithChecks(baseImg, earlierImg):
+    """Subtract the smoothed earlier image from the smoothed base image unless
+       the images are too different in brightness or not different at all
+
+    Args:
+        baseImg (Pillow image, np.array, str, or Frame): base image (see getDiffInput)
+        earlierImg (Pillow image, np.array, str, or Frame): earlier image aligned with base image
+
+    Returns:
+        Pillow image object with the difference or None
+    """
+    return diffInputsWithChecks(getDiffInput(baseImg), getDiffInput(earlierImg))
 
 
 def getHeadingRange(centralHeading, fov, minX, maxX, imgSizeX):
@@ -0,0 +1,301 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Local inference service shared by multiple detection processes on a VM.
+
+The server (bin/inference_server.py) holds a single copy of each model and
+listens on a Unix socket.  Clients (InferenceClient, returned by
+tf_helper.loadInferenceModel when settings.inferenceSocket is set) write the
+normalized crops into a shared memory segment and send a small request
+message over the socket.  The server batches requests for the same model
+from multiple clients until it has maxBatch crops or the oldest request has
+waited maxLatencyMs, runs the model once, and returns the scores to each
+client over the socket.
+
+Message format: 8 byte header with lengths of JSON header and binary payload,
+followed by JSON header and payload.
+
+"""
+
+from firecam.lib import tf_helper
+
+import os
+import logging
+import json
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+import atexit
+import numpy as np
+
+
+def _sendMessage(sock, header, payload=b''):
+    headerBytes = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('!II', len(headerBytes), len(payload)) + headerBytes)
+    if len(payload) > 0:
+        sock.sendall(payload)
+
+
+def _recvExact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        numBytes = sock.recv_into(view[received:], size - received)
+        if numBytes == 0:
+            return None
+        received += numBytes
+    return data
+
+
+def _recvMessage(sock):
+    """Receive a message from given socket
+
+    Returns:
+        Tuple (header dict, payload bytes) or None if connection was closed
+    """
+    lengths = _recvExact(sock, 8)
+    if lengths == None:
+        return None
+    (headerLen, payloadLen) = struct.unpack('!II', lengths)
+    headerBytes = _recvExact(sock, headerLen)
+    payload = _recvExact(sock, payloadLen) if payloadLen else b''
+    if (headerBytes == None) or (payload == None):
+        return None
+    return (json.loads(headerBytes.decode('utf-8')), payload)
+
+
+def _attachSharedMemory(name):
+    """Attach to the shared memory segment created by a client without taking
+       ownership (otherwise the resource tracker would unlink it when server exits)
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class ModelBatcher(object):
+    def __init__(self, model, maxBatch, maxLatencyMs):
+        """Dynamic batching of requests for given model
+
+        Args:
+            model: model object from tf_helper.loadInferenceModel
+            maxBatch (int): max crops in a batch (individual larger requests are run alone)
+            maxLatencyMs (float): max time to wait for more requests after the first one
+        """
+        self.model = model
+        self.maxBatch = maxBatch
+        self.maxLatency = maxLatencyMs / 1000
+        self.requests = queue.Queue()
+        self.stats = {'batches': 0, 'requests': 0, 'crops': 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def predict(self, crops):
+        """Predict the given crops as part of the next batch (blocks until done)
+        """
+        request = {'crops': crops, 'done': threading.Event(), 'result': None, 'error': None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error']:
+            raise request['error']
+        return request['result']
+
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            numCrops = len(batch[0]['crops'])
+            deadline = time.time() + self.maxLatency
+            while numCrops < self.maxBatch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                numCrops += len(request['crops'])
+            try:
+                if len(batch) == 1:
+                    crops = batch[0]['crops']
+                else:
+                    crops = np.concatenate([request['crops'] for request in batch])
+                results = tf_helper.predictCrops(self.model, crops)
+                crops = None
+                offset = 0
+                for request in batch:
+                    request['result'] = np.asarray(results[offset:offset+len(request['crops'])])
+                    offset += len(request['crops'])
+            except Exception as e:
+                logging.error('ModelBatcher failed %s', str(e))
+                for request in batch:
+                    request['error'] = e
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(batch)
+            self.stats['crops'] += numCrops
+            for request in batch:
+                request['crops'] = None # release reference to client's shared memory buffer
+                request['done'].set()
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, maxBatch=256, maxLatencyMs=20, numThreads=None):
+        """Unix socket server running inference on behalf of multiple detection processes
+
+        Args:
+            socketPath (str): path of Unix socket to listen on
+            maxBatch (int): max crops in a batch
+            maxLatencyMs (float): max time to wait for more requests to batch together
+            numThreads (int): [optional] number of threads for tflite and onnx backends
+        """
+        if os.path.exists(socketPath):
+            os.remove(socketPath) # stale socket from previous run
+        self.maxBatch = maxBatch
+        self.maxLatencyMs = maxLatencyMs
+        self.numThreads = numThreads
+        self.batchers = {}
+        self.batchersLock = threading.Lock()
+        super().__init__(socketPath, InferenceRequestHandler)
+
+
+    def getBatcher(self, modelPath, backend):
+        """Return the batcher for given model, loading the model on first use
+        """
+        key = (modelPath, backend)
+        with self.batchersLock:
+            if key not in self.batchers:
+                model = tf_helper.loadInferenceModel(modelPath, backend=backend, numThreads=self.numThreads, useServer=False)
+                self.batchers[key] = ModelBatcher(model, self.maxBatch, self.maxLatencyMs)
+            return self.batchers[key]
+
+
+    def logStats(self):
+        with self.batchersLock:
+            for (key, batcher) in self.batchers.items():
+                stats = batcher.stats
+                logging.warning('Model %s: batches=%d, requests/batch=%.2f, crops/batch=%.1f', key[0], stats['batches'],
+                                stats['requests'] / max(stats['batches'], 1), stats['crops'] / max(stats['batches'], 1))
+
+
+class InferenceRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        shm = None
+        try:
+            while True:
+                message = _recvMessage(self.request)
+                if message == None:
+                    return
+                (header, payload) = message
+                try:
+                    if (shm == None) or (shm.name != header['shm']):
+                        if shm:
+                            shm.close()
+                        shm = _attachSharedMemory(header['shm'])
+                    crops = np.ndarray(header['shape'], dtype=header['dtype'], buffer=shm.buf)
+                    batcher = self.server.getBatcher(header['model'], header.get('backend'))
+                    results = batcher.predict(crops)
+                    crops = None # release reference to shared memory buffer
+                    results = np.ascontiguousarray(results, dtype=np.float32)
+                    _sendMessage(self.request, {'shape': list(results.shape), 'dtype': 'float32'}, results.tobytes())
+                except Exception as e:
+                    logging.error('Inference request failed %s', str(e))
+                    crops = None
+                    _sendMessage(self.request, {'error': str(e)})
+        finally:
+            if shm:
+                shm.close()
+
+
+class InferenceClient(object):
+    def __init__(self, socketPath, modelPath, backend=None):
+        """Client for InferenceServer usable by tf_helper.classifySegments like a local model
+
+        Args:
+            socketPath (str): path of server's Unix socket
+            modelPath (str): model path (as accessible by server)
+            backend (str): [optional] inference backend server should use for the model
+        """
+        self.socketPath = socketPath
+        self.modelPath = modelPath
+        self.backend = backend
+        self.sock = None
+        self.shm = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+
+    def _getBuffer(self, numBytes):
+        """Return shared memory segment of at least given size, growing it as needed
+        """
+        if self.shm and (self.shm.size >= numBytes):
+            return self.shm
+        from multiprocessing import shared_memory
+        if self.shm:
+            self.shm.close()
+            self.shm.unlink()
+        self.shm = shared_memory.SharedMemory(create=True, size=numBytes)
+        return self.shm
+
+
+    def predict(self, cropsNormalized):
+        with self.lock:
+            crops = np.asarray(cropsNormalized, dtype=np.float32)
+            shm = self._getBuffer(max(crops.nbytes, 1))
+            shmCrops = np.ndarray(crops.shape, dtype=np.float32, buffer=shm.buf)
+            shmCrops[...] = crops
+            shmCrops = None
+            header = {'model': self.modelPath, 'backend': self.backend, 'shm': shm.name,
+                      'shape': list(crops.shape), 'dtype': 'float32'}
+            try:
+                if not self.sock:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.connect(self.socketPath)
+                _sendMessage(self.sock, header)
+                message = _recvMessage(self.sock)
+            except OSError:
+                self._closeSocket()
+                raise
+            if message == None:
+                self._closeSocket()
+                raise Exception('Inference server closed connection')
+            (header, payload) = message
+            if 'error' in header:
+                raise Exception('Inference server error: %s' % header['error'])
+            return np.frombuffer(payload, dtype=header['dtype']).reshape(header['shape'])
+
+
+    def _closeSocket(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+    def close(self):
+        with self.lock:
+            self._closeSocket()
+            if self.shm:
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = None
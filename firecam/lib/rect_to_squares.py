@@ -143,39 +143,75 @@ def cutBoxesFiles(imgOrig, outputDirectory, imageFileName, callBackFn=None):
     return segments
 
 
-def cutBoxesArray(imgOrig, startX=0, endX=None, startY=0, endY=None):
-    """Cut the given image into fixed size boxes, normalize data, and return as np arrays
+def getSegmentRangesXY(imgSize, startX=0, endX=None, startY=0, endY=None):
+    """Get the X and Y segment ranges covering the given region of an image
 
-    Divide the given image into square segments of 299x299 (segmentSize below)
-    to match the size of images used by InceptionV3 image classification
-    machine learning model.  This function uses the getSegmentRanges() function
-    above to calculate the exact start and end of each square
+    Negative endX/endY values are relative to the right/bottom edges, and
+    the region is clipped to the image boundaries
 
     Args:
-        imgOrig (Image): Image object of the original image
+        imgSize (tuple): (width, height) of the image
+        startX, endX, startY, endY (int): region of the image to segment
 
     Returns:
-        (list, list): pair of lists (cropped numpy arrays) and (metadata on boundaries)
+        (list, list): pair of lists of (start, end) ranges for X and Y
     """
     segmentSize = 299
 
     if endX == None:
-        endX = imgOrig.size[0]
+        endX = imgSize[0]
     elif endX < 0:
-        endX = imgOrig.size[0] + endX
+        endX = imgSize[0] + endX
     startX = max(0, startX)
-    endX = min(endX, imgOrig.size[0])
+    endX = min(endX, imgSize[0])
     xRanges = getSegmentRanges(endX - startX, segmentSize)
     xRanges = list(map(lambda x: (x[0] + startX, x[1] + startX), xRanges))
 
     if endY == None:
-        endY = imgOrig.size[1]
+        endY = imgSize[1]
     elif endY < 0:
-        endY = imgOrig.size[1] + endY
+        endY = imgSize[1] + endY
     startY = max(0, startY)
-    endY = min(endY, imgOrig.size[1])
+    endY = min(endY, imgSize[1])
     yRanges = getSegmentRanges(endY - startY, segmentSize)
     yRanges = list(map(lambda x: (x[0] + startY, x[1] + startY), yRanges))
+    return (xRanges, yRanges)
+
+
+def segmentInfo(coords):
+    """Return the metadata dictionary for segment with given coordinates
+
+    Args:
+        coords (tuple): (MinX, MinY, MaxX, MaxY)
+
+    Returns:
+        (dict): segment metadata
+    """
+    return {
+        'coords': coords,
+        'coordStr': 'x'.join(list(map(lambda x: str(x), coords))),
+        'MinX': coords[0],
+        'MinY': coords[1],
+        'MaxX': coords[2],
+        'MaxY': coords[3]
+    }
+
+
+def cutBoxesArray(imgOrig, startX=0, endX=None, startY=0, endY=None):
+    """Cut the given image into fixed size boxes, normalize data, and return as np arrays
+
+    Divide the given image into square segments of 299x299 (segmentSize below)
+    to match the size of images used by InceptionV3 image classification
+    machine learning model.  This function uses the getSegmentRanges() function
+    above to calculate the exact start and end of each square
+
+    Args:
+        imgOrig (Image): Image object of the original image
+
+    Returns:
+        (list, list): pair of lists (cropped numpy arrays) and (metadata on boundaries)
+    """
+    (xRanges, yRanges) = getSegmentRangesXY(imgOrig.size, startX, endX, startY, endY)
 
     crops = []
     segments = []
@@ -186,15 +222,74 @@ def cutBoxesArray(imgOrig, startX=0, endX=None, startY=0, endY=None):
         for xRange in xRanges:
             crops.append(imgNormalized[yRange[0]:yRange[1], xRange[0]:xRange[1]])
             coords = (xRange[0], yRange[0], xRange[1], yRange[1])
-            coordStr = 'x'.join(list(map(lambda x: str(x), coords)))
-            segments.append({
-                'coords': coords,
-                'coordStr': coordStr,
-                'MinX': coords[0],
-                'MinY': coords[1],
-                'MaxX': coords[2],
-                'MaxY': coords[3]
-            })
+            segments.append(segmentInfo(coords))
     crops = np.array(crops)
 
     return crops, segments
+
+
+def getBatchBuffer(batchBuffer, shape, dtype):
+    """Return array of given shape and dtype backed by given buffer if it is large enough
+
+    Args:
+        batchBuffer (np.array): previously allocated buffer (or None)
+        shape (tuple): desired shape with number of items in first dimension
+        dtype: desired numpy dtype
+
+    Returns:
+        (np.array): view into batchBuffer or newly allocated array
+    """
+    if ((batchBuffer is not None) and (batchBuffer.dtype == dtype) and
+        (batchBuffer.shape[1:] == shape[1:]) and (batchBuffer.shape[0] >= shape[0])):
+        return batchBuffer[:shape[0]]
+    return np.empty(shape, dtype=dtype)
+
+
+def cutBoxesArrayUint8(imgOrig, startX=0, endX=None, startY=0, endY=None, batchBuffer=None):
+    """Cut the given image into fixed size boxes without normalizing the data
+
+    Same segmentation as cutBoxesArray(), but the crops are gathered straight from
+    the uint8 image data into a single batch array, avoiding the full frame float32
+    temporaries.  Use normalizeCrops() to normalize the batch before classification.
+
+    Args:
+        imgOrig (Image or np.array): Image object or HxWx3 uint8 array of the original image
+        batchBuffer (np.array): [optional] reusable uint8 buffer from earlier call.
+                                The returned crops are a view into this buffer when it is large enough
+
+    Returns:
+        (np.array, list): pair of uint8 crops (Nx299x299x3) and list of metadata on boundaries
+    """
+    segmentSize = 299
+    imgNpArray = np.asarray(imgOrig, dtype=np.uint8)
+    imgSize = (imgNpArray.shape[1], imgNpArray.shape[0])
+    (xRanges, yRanges) = getSegmentRangesXY(imgSize, startX, endX, startY, endY)
+
+    numCrops = len(xRanges) * len(yRanges)
+    crops = getBatchBuffer(batchBuffer, (numCrops, segmentSize, segmentSize, imgNpArray.shape[2]), np.uint8)
+    segments = []
+    for yRange in yRanges:
+        for xRange in xRanges:
+            crops[len(segments)] = imgNpArray[yRange[0]:yRange[1], xRange[0]:xRange[1]]
+            coords = (xRange[0], yRange[0], xRange[1], yRange[1])
+            segments.append(segmentInfo(coords))
+
+    return crops, segments
+
+
+def normalizeCrops(crops, out=None):
+    """Normalize the uint8 crops from cutBoxesArrayUint8() to the [-1, 1) range expected by the model
+
+    Single pass over the crops that produces identical values to cutBoxesArray()
+
+    Args:
+        crops (np.array): uint8 crops
+        out (np.array): [optional] reusable float32 buffer from earlier call
+
+    Returns:
+        (np.array): float32 normalized crops (view into out when it is large enough)
+    """
+    normalized = getBatchBuffer(out, crops.shape, np.float32)
+    np.subtract(crops, 128, out=normalized, dtype=np.float32)
+    normalized *= 1/128 # exact because 128 is power of 2
+    return normalized
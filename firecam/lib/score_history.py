@@ -0,0 +1,317 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Historical smoke scores used by the historical threshold filter
+(InceptionV3AndHistoricalThreshold._postFilter).
+
+The filter needs the count, average, and max score of each segment at the
+same time of day (+/- 1 hour) over the last 7.5 days, excluding the most
+recent 12 hours.
+
+Raw per image scores are rolled up into the score_history table with count,
+average, and max per camera, heading, model, segment, and time bucket
+(BUCKET_SECONDS).  foldScores() is called once a day by the archiver after
+detection ends to incrementally add the day's scores to the rollup.
+
+ScoreHistoryCache keeps in-process per (camera, heading) aggregates from the
+rollup table for each segment and each time bucket.  Buckets that haven't been
+folded yet (e.g. before the archiver's first daily fold, or without an
+archiver) are aggregated from the raw scores table instead.  Entries are
+loaded on first use (or by prewarm()), then extended incrementally as time
+moves on, and dropped after not being used for a while.  Each entry holds
+RING_SIZE slots per segment, so the entries are also kept in an LRU capped by
+bytes (settings.scoreHistoryCacheMB).
+
+"""
+
+import logging
+import time
+import collections
+import numpy as np
+
+BUCKET_SECONDS = 15*60 # resolution of time buckets
+HISTORY_SECONDS = int(60*60*24*7.5) # oldest scores considered by filter
+SETTLE_SECONDS = 60*60*12 # most recent scores ignored by filter
+WINDOW_SECONDS = 60*60 # +/- time of day window
+RING_SIZE = int(8*24*60*60 / BUCKET_SECONDS) # 8 days of buckets (> HISTORY_SECONDS - SETTLE_SECONDS)
+SYNC_INTERVAL = 5*60 # minimum time between checks for newly folded scores
+IDLE_EXPIRE_SECONDS = 4*60*60 # drop entries unused for this long
+FOLDED_COUNTER = 'scoreHistoryFoldedUntil' # counters table entry with time up to which scores are folded
+DEFAULT_MAX_MB = 256
+
+
+def getFoldedUntil(dbManager):
+    """Return the time up to which scores have been folded into score_history table (or None)
+    """
+    sqlTemplate = "SELECT counter FROM counters WHERE name='%s'"
+    dbResult = dbManager.query(sqlTemplate % FOLDED_COUNTER)
+    if len(dbResult) == 0:
+        return None
+    return dbResult[0]['counter']
+
+
+def foldScores(dbManager, endTime):
+    """Incrementally fold the scores recorded since last fold up to endTime into score_history table
+
+    The first fold picks up the last HISTORY_SECONDS of existing scores.
+
+    Args:
+        dbManager (DbManager):
+        endTime (int): fold scores with timestamp up to (and including) this time
+    """
+    startTime = getFoldedUntil(dbManager)
+    if startTime == None:
+        startTime = endTime - HISTORY_SECONDS
+        dbManager.add_data('counters', {'name': FOLDED_COUNTER, 'counter': startTime})
+    if endTime <= startTime:
+        return
+    sqlTemplate = """INSERT INTO score_history (CameraName,Heading,ModelId,MinX,MinY,MaxX,MaxY,Timestamp,SecondsInDay,Cnt,AvgScore,MaxScore)
+    SELECT CameraName,Heading,ModelId,MinX,MinY,MaxX,MaxY,(Timestamp/%s)*%s,(SecondsInDay/%s)*%s,count(*),avg(Score),max(Score) FROM scores
+    WHERE Timestamp > %s and Timestamp <= %s
+    GROUP BY 1,2,3,4,5,6,7,8,9"""
+    sqlStr = sqlTemplate % (BUCKET_SECONDS, BUCKET_SECONDS, BUCKET_SECONDS, BUCKET_SECONDS, startTime, endTime)
+    try:
+        dbManager.execute(sqlStr, commit=False)
+    except Exception:
+        dbManager.rollback()
+        raise
+    sqlTemplate = "UPDATE counters SET counter=%s WHERE name='%s'"
+    dbManager.execute(sqlTemplate % (endTime, FOLDED_COUNTER))
+    logging.warning('Folded scores from %s to %s into score_history', startTime, endTime)
+
+
+def getWindowBuckets(timestamp):
+    """Return the time buckets with scores at same time of day (+/- WINDOW_SECONDS)
+       over the previous days within HISTORY_SECONDS and before SETTLE_SECONDS
+
+    Args:
+        timestamp (int): time of current image
+
+    Returns:
+        np.array of bucket numbers
+    """
+    buckets = []
+    daysBack = 1
+    while (daysBack*24*60*60 - WINDOW_SECONDS) < HISTORY_SECONDS:
+        center = timestamp - daysBack*24*60*60
+        startTime = max(center - WINDOW_SECONDS, timestamp - HISTORY_SECONDS)
+        endTime = min(center + WINDOW_SECONDS, timestamp - SETTLE_SECONDS)
+        buckets += list(range((startTime + 1) // BUCKET_SECONDS, (endTime - 1) // BUCKET_SECONDS + 1))
+        daysBack += 1
+    return np.array(buckets, dtype=np.int64)
+
+
+class ScoreHistoryCache(object):
+    def __init__(self, dbManager, modelId, maxBytes=DEFAULT_MAX_MB*1024*1024):
+        """Cache of historical scores for the given model
+
+        Args:
+            dbManager (DbManager):
+            modelId (str): ID of the model whose scores are cached
+            maxBytes (int): max bytes of score arrays in memory (least recently used entries are evicted)
+        """
+        self.dbManager = dbManager
+        self.modelId = modelId
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict() # (cameraID, heading) -> entry (least recently used first)
+        self.totalBytes = 0
+        self.lastExpireTime = time.time()
+        self.foldedUntil = None
+        self.foldedCheckTime = 0
+        self.stats = {'lookups': 0, 'loads': 0, 'syncs': 0, 'rawQueries': 0, 'expired': 0, 'evicted': 0}
+
+
+    def _newEntry(self, startTime, endTime):
+        return {
+            'coordsIndex': {},
+            'cnt': np.zeros((0, RING_SIZE), dtype=np.uint16),
+            'sums': np.zeros((0, RING_SIZE), dtype=np.float32),
+            'maxs': np.zeros((0, RING_SIZE), dtype=np.float32),
+            'slotBucket': np.full(RING_SIZE, -1, dtype=np.int64),
+            'loadedFrom': startTime,
+            'syncedUntil': endTime,
+            'lastUsed': time.time(),
+            'numBytes': 0,
+        }
+
+
+    def _updateBytes(self, key, entry):
+        """Account for the current size of given entry and evict least recently used entries over maxBytes
+        """
+        numBytes = sum([entry[name].nbytes for name in ['cnt', 'sums', 'maxs', 'slotBucket']])
+        self.totalBytes += numBytes - entry['numBytes']
+        entry['numBytes'] = numBytes
+        self.entries.move_to_end(key)
+        # always keep the entry in use
+        while (self.totalBytes > self.maxBytes) and (len(self.entries) > 1):
+            (oldKey, oldEntry) = self.entries.popitem(last=False)
+            self.totalBytes -= oldEntry['numBytes']
+            self.stats['evicted'] += 1
+
+
+    def _getRow(self, entry, coords):
+        """Return the row number for given segment coordinates, growing the arrays if needed
+        """
+        row = entry['coordsIndex'].get(coords)
+        if row != None:
+            return row
+        row = len(entry['coordsIndex'])
+        entry['coordsIndex'][coords] = row
+        if row >= len(entry['cnt']):
+            newRows = max(row, 16)
+            for name in ['cnt', 'sums', 'maxs']:
+                entry[name] = np.concatenate([entry[name], np.zeros((newRows, RING_SIZE), dtype=entry[name].dtype)])
+        return row
+
+
+    def _addRows(self, entry, dbRows):
+        """Fold the given aggregated rows (per segment and bucket) into given entry
+        """
+        for dbRow in dbRows:
+            bucket = int(dbRow['bucket'])
+            slot = bucket % RING_SIZE
+            if entry['slotBucket'][slot] != bucket: # slot holds old data, so clear it
+                entry['slotBucket'][slot] = bucket
+                entry['cnt'][:, slot] = 0
+                entry['sums'][:, slot] = 0
+                entry['maxs'][:, slot] = 0
+            row = self._getRow(entry, (dbRow['minx'], dbRow['miny'], dbRow['maxx'], dbRow['maxy']))
+            entry['cnt'][row, slot] += dbRow['cnt']
+            entry['sums'][row, slot] += dbRow['sums']
+            entry['maxs'][row, slot] = max(entry['maxs'][row, slot], dbRow['maxs'])
+
+
+    def _queryScores(self, cameraID, heading, startTime, endTime):
+        """Aggregate the scores for buckets starting in given time range [startTime, endTime) by segment and bucket.
+           Buckets completely folded into score_history are read from it, and later buckets from the scores table
+        """
+        # bucket containing foldedUntil is only partially folded, so it's read from scores
+        foldedEnd = self.foldedUntil // BUCKET_SECONDS * BUCKET_SECONDS
+        dbRows = []
+        if startTime < min(endTime, foldedEnd):
+            sqlTemplate = """SELECT MinX,MinY,MaxX,MaxY,Timestamp/%s as bucket,sum(Cnt) as cnt, sum(Cnt*AvgScore) as sums, max(MaxScore) as maxs FROM score_history
+            WHERE CameraName='%s' and Heading>=%s and Heading<=%s and Timestamp >= %s and Timestamp < %s and ModelId='%s'
+            GROUP BY MinX,MinY,MaxX,MaxY,bucket"""
+            sqlStr = sqlTemplate % (BUCKET_SECONDS, cameraID, heading-1, heading+1, startTime, min(endTime, foldedEnd), self.modelId)
+            dbRows += self.dbManager.query(sqlStr)
+        if max(startTime, foldedEnd) < endTime:
+            sqlTemplate = """SELECT MinX,MinY,MaxX,MaxY,Timestamp/%s as bucket,count(*) as cnt, sum(Score) as sums, max(Score) as maxs FROM scores
+            WHERE CameraName='%s' and Heading>=%s and Heading<=%s and Timestamp >= %s and Timestamp < %s and ModelId='%s'
+            GROUP BY MinX,MinY,MaxX,MaxY,bucket"""
+            sqlStr = sqlTemplate % (BUCKET_SECONDS, cameraID, heading-1, heading+1, max(startTime, foldedEnd), endTime, self.modelId)
+            dbRows += self.dbManager.query(sqlStr)
+            self.stats['rawQueries'] += 1
+        return dbRows
+
+
+    def _getEntry(self, cameraID, heading, timestamp):
+        """Return the cache entry for given camera and heading, loading or updating it as needed
+           to cover the history needed for given timestamp
+        """
+        key = (cameraID, heading)
+        entry = self.entries.get(key)
+        timeNow = time.time()
+        if timeNow - self.foldedCheckTime > SYNC_INTERVAL:
+            self.foldedUntil = getFoldedUntil(self.dbManager) or 0
+            self.foldedCheckTime = timeNow
+        startTime = (timestamp - HISTORY_SECONDS) // BUCKET_SECONDS * BUCKET_SECONDS
+        # only complete buckets, which get no more scores
+        endTime = (timestamp - SETTLE_SECONDS) // BUCKET_SECONDS * BUCKET_SECONDS
+        if (not entry) or (startTime < entry['loadedFrom']) or (endTime - entry['syncedUntil'] > HISTORY_SECONDS):
+            if entry:
+                self.totalBytes -= entry['numBytes']
+            entry = self._newEntry(startTime, endTime)
+            self._addRows(entry, self._queryScores(cameraID, heading, startTime, endTime))
+            self.entries[key] = entry
+            self.stats['loads'] += 1
+        elif endTime > entry['syncedUntil']:
+            self._addRows(entry, self._queryScores(cameraID, heading, entry['syncedUntil'], endTime))
+            entry['syncedUntil'] = endTime
+            self.stats['syncs'] += 1
+        entry['lastUsed'] = timeNow
+        self._updateBytes(key, entry)
+        return entry
+
+
+    def _expire(self):
+        """Drop entries that have not been used recently to limit memory usage
+        """
+        timeNow = time.time()
+        if timeNow - self.lastExpireTime < SYNC_INTERVAL:
+            return
+        self.lastExpireTime = timeNow
+        for key in list(self.entries.keys()):
+            if timeNow - self.entries[key]['lastUsed'] > IDLE_EXPIRE_SECONDS:
+                self.totalBytes -= self.entries.pop(key)['numBytes']
+                self.stats['expired'] += 1
+        logging.warning('ScoreHistoryCache stats %s, entries %d, MB %d', self.stats, len(self.entries),
+                        self.totalBytes // (1024*1024))
+
+
+    def getHistory(self, cameraID, heading, timestamp, coordsList):
+        """Get the historical scores of the given segments at same time of day over previous days
+
+        Equivalent to GROUP BY segment query over scores table in time range
+        (timestamp - 7.5 days, timestamp - 12 hours) and time of day +/- 1 hour,
+        except time of day range is rounded out to BUCKET_SECONDS boundaries.
+
+        Args:
+            cameraID (str): camera ID
+            heading (int): direction camera is facing (matches scores +/- 1 degree)
+            timestamp (int): time of current image
+            coordsList (list): list of segment coordinates (MinX, MinY, MaxX, MaxY)
+
+        Returns:
+            Dictionary mapping segment coordinates to dict with cnt, avgs, maxs.
+            Segments without history are not included
+        """
+        self._expire()
+        self.stats['lookups'] += 1
+        entry = self._getEntry(cameraID, heading, timestamp)
+        buckets = getWindowBuckets(timestamp)
+        slots = buckets % RING_SIZE
+        slots = slots[entry['slotBucket'][slots] == buckets]
+        result = {}
+        for coords in coordsList:
+            row = entry['coordsIndex'].get(tuple(coords))
+            if row == None:
+                continue
+            cnt = int(entry['cnt'][row, slots].sum())
+            if cnt == 0:
+                continue
+            result[tuple(coords)] = {
+                'cnt': cnt,
+                'avgs': float(entry['sums'][row, slots].sum()) / cnt,
+                'maxs': float(entry['maxs'][row, slots].max()),
+            }
+        return result
+
+
+    def prewarm(self, timestamp):
+        """Load the cache entries for all camera headings that had positive (> 0.5) scores
+           over the history range relevant for given timestamp
+
+        Args:
+            timestamp (int): current time
+        """
+        sqlTemplate = """SELECT CameraName, Heading FROM score_history
+        WHERE Timestamp > %s and Timestamp <= %s and ModelId='%s' and MaxScore > 0.5
+        GROUP BY CameraName, Heading"""
+        sqlStr = sqlTemplate % (timestamp - HISTORY_SECONDS, timestamp - SETTLE_SECONDS, self.modelId)
+        dbResult = self.dbManager.query(sqlStr)
+        for dbRow in dbResult:
+            self._getEntry(dbRow['cameraname'], dbRow['heading'], timestamp)
+        logging.warning('ScoreHistoryCache prewarmed %d entries for model %s', len(self.entries), self.modelId)
@@ -0,0 +1,188 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Cache of smoothed image data, so each image is smoothed only once even when
+it's diffed twice (first as the newer image, and later as the earlier image).
+
+Entries are keyed by the md5 of the image file contents (so copies of the
+same archived image in different directories share the entry) and by the
+smoothing filter parameters.  The memory tier is an LRU capped by bytes.  The
+optional disk tier stores .npy files in a directory that can be shared by
+processes and survives restarts, and is capped by removing the oldest files.
+
+The shared cache used by img_archive is configured with settings.smoothCacheMB,
+settings.smoothCacheDir, and settings.smoothCacheDiskMB.  The default memory
+tier holds about one smoothed 3 MP frame for each of 25 camera views, which
+covers a detection process's views between a frame's two diffs (set
+settings.smoothCacheMB higher for processes handling more views, or 0 to
+disable).  The disk tier is off unless settings.smoothCacheDir is set.
+
+"""
+
+from firecam.lib import settings
+
+import os
+import logging
+import threading
+import time
+import collections
+import tempfile
+import numpy as np
+
+DEFAULT_MAX_MB = 256
+DEFAULT_MAX_DISK_MB = 4096
+STATS_INTERVAL = 10*60 # minimum time between logging stats
+
+
+class SmoothCache(object):
+    def __init__(self, maxBytes, cacheDir=None, maxDiskBytes=None):
+        """Smoothed image cache with memory and optional disk tiers
+
+        Args:
+            maxBytes (int): max bytes of data in memory
+            cacheDir (str): [optional] directory for disk tier
+            maxDiskBytes (int): [optional] max bytes of files in cacheDir
+        """
+        self.maxBytes = maxBytes
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes or (DEFAULT_MAX_DISK_MB * 1024 * 1024)
+        self.entries = collections.OrderedDict() # key -> np.array
+        self.totalBytes = 0
+        self.diskFiles = collections.OrderedDict() # file name -> bytes (oldest first)
+        self.diskBytes = 0
+        self.lock = threading.Lock()
+        self.lastStatsTime = time.time()
+        self.stats = {'memoryHits': 0, 'diskHits': 0, 'misses': 0}
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+            diskFiles = []
+            for fileName in os.listdir(cacheDir):
+                if fileName.endswith('.npy'):
+                    stat = os.stat(os.path.join(cacheDir, fileName))
+                    diskFiles.append((stat.st_mtime, fileName, stat.st_size))
+            for (mtime, fileName, size) in sorted(diskFiles):
+                self.diskFiles[fileName] = size
+                self.diskBytes += size
+
+
+    def _logStats(self):
+        timeNow = time.time()
+        if timeNow - self.lastStatsTime < STATS_INTERVAL:
+            return
+        self.lastStatsTime = timeNow
+        logging.warning('SmoothCache stats %s, memory MB %d, disk MB %d', self.stats,
+                        self.totalBytes // (1024*1024), self.diskBytes // (1024*1024))
+
+
+    def _addMemory(self, key, arr):
+        if (key in self.entries) or (arr.nbytes > self.maxBytes):
+            return
+        self.entries[key] = arr
+        self.totalBytes += arr.nbytes
+        while self.totalBytes > self.maxBytes:
+            (oldKey, oldArr) = self.entries.popitem(last=False)
+            self.totalBytes -= oldArr.nbytes
+
+
+    def _getDiskName(self, key):
+        return '_'.join([str(x) for x in key]) + '.npy'
+
+
+    def _readDisk(self, key):
+        if not self.cacheDir:
+            return None
+        filePath = os.path.join(self.cacheDir, self._getDiskName(key))
+        if not os.path.isfile(filePath):
+            return None
+        try:
+            return np.load(filePath)
+        except Exception as e:
+            logging.warning('Failed to read smoothed image %s: %s', filePath, str(e))
+            return None
+
+
+    def _writeDisk(self, key, arr):
+        if not self.cacheDir:
+            return
+        fileName = self._getDiskName(key)
+        # write to temporary file and rename so other processes never see partial files
+        (tmpFd, tmpPath) = tempfile.mkstemp(suffix='.tmp', dir=self.cacheDir)
+        with os.fdopen(tmpFd, 'wb') as tmpFile:
+            np.save(tmpFile, arr)
+        filePath = os.path.join(self.cacheDir, fileName)
+        os.replace(tmpPath, filePath)
+        fileBytes = os.path.getsize(filePath)
+        with self.lock:
+            self.diskBytes -= self.diskFiles.pop(fileName, 0)
+            self.diskFiles[fileName] = fileBytes
+            self.diskBytes += fileBytes
+            removeNames = []
+            while (self.diskBytes > self.maxDiskBytes) and (len(self.diskFiles) > 1):
+                (oldName, oldBytes) = self.diskFiles.popitem(last=False)
+                self.diskBytes -= oldBytes
+                removeNames.append(oldName)
+        for oldName in removeNames:
+            try:
+                os.remove(os.path.join(self.cacheDir, oldName))
+            except FileNotFoundError:
+                pass # already removed by another process
+
+
+    def get(self, key, smoothFn):
+        """Return the smoothed data for given key, calling smoothFn to compute it if not cached
+
+        Args:
+            key (tuple): identity of the image and filter, e.g. (md5, filter name, params...)
+            smoothFn (function): function returning the smoothed np.array
+
+        Returns:
+            np.array with smoothed data (shared, so don't modify it)
+        """
+        with self.lock:
+            arr = self.entries.get(key)
+            if arr is not None:
+                self.entries.move_to_end(key)
+                self.stats['memoryHits'] += 1
+                self._logStats()
+                return arr
+        arr = self._readDisk(key)
+        statName = 'diskHits'
+        if arr is None:
+            arr = smoothFn()
+            self._writeDisk(key, arr)
+            statName = 'misses'
+        with self.lock:
+            self._addMemory(key, arr)
+            self.stats[statName] += 1
+            self._logStats()
+        return arr
+
+
+def getSmoothCache():
+    """Return the process wide cache configured by settings
+    """
+    # lock so threads calling this concurrently the first time don't create separate caches
+    with getSmoothCache.lock:
+        if not getSmoothCache.cache:
+            maxMB = getattr(settings, 'smoothCacheMB', None)
+            if maxMB == None:
+                maxMB = DEFAULT_MAX_MB
+            maxDiskMB = getattr(settings, 'smoothCacheDiskMB', None) or DEFAULT_MAX_DISK_MB
+            getSmoothCache.cache = SmoothCache(maxMB * 1024 * 1024, getattr(settings, 'smoothCacheDir', None),
+                                               maxDiskMB * 1024 * 1024)
+        return getSmoothCache.cache
+getSmoothCache.cache = None
+getSmoothCache.lock = threading.Lock()
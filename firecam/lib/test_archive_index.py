@@ -0,0 +1,112 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test archive_index
+
+"""
+
+from firecam.lib import archive_index
+import os
+import time
+import sqlite3
+
+
+def getParseFn(parsedNames):
+    # parses names like cam1__1000.jpg
+    def parseFn(fileName):
+        parsedNames.append(fileName)
+        parts = fileName[:-4].split('__')
+        if len(parts) != 2:
+            return None
+        return {'cameraID': parts[0], 'unixTime': int(parts[1])}
+    return parseFn
+
+
+def addFiles(dirPath, fileNames):
+    for fileName in fileNames:
+        open(os.path.join(dirPath, fileName), 'w').close()
+
+
+def testLookups(tmp_path):
+    dirPath = str(tmp_path)
+    addFiles(dirPath, ['cam1__1060.jpg', 'cam1__1000.jpg', 'cam1__1120.jpg', 'cam2__1000.jpg', 'bad.jpg', 'cam1__1030.txt'])
+    index = archive_index.ArchiveIndex(getParseFn([]), dirPath)
+    assert sorted(index.getCameraIDs()) == ['cam1', 'cam2']
+    assert index.getEntries('cam1') == [(1000, 'cam1__1000.jpg'), (1060, 'cam1__1060.jpg'), (1120, 'cam1__1120.jpg')]
+    assert index.findClosest('cam1', 1080) == (1060, 'cam1__1060.jpg')
+    assert index.findClosest('cam1', 1030) == (1000, 'cam1__1000.jpg') # ties go to earlier image
+    assert index.findClosest('cam1', 5000) == (1120, 'cam1__1120.jpg')
+    assert index.findClosest('cam3', 1000) == None
+    assert index.fetchRange('cam1', 1000, 1120) == [(1060, 'cam1__1060.jpg')]
+    assert index.fetchRange('cam1', 999, 1121) == index.getEntries('cam1')
+
+    index.insert(os.path.join(dirPath, 'cam1__1090.jpg'))
+    assert index.findClosest('cam1', 1095) == (1090, 'cam1__1090.jpg')
+    index.remove('cam1__1090.jpg')
+    assert index.findClosest('cam1', 1095) == (1120, 'cam1__1120.jpg')
+
+
+def testSidecar(tmp_path):
+    dirPath = str(tmp_path)
+    indexPath = archive_index.getIndexPath(dirPath)
+    addFiles(dirPath, ['cam1__1000.jpg', 'cam1__1060.jpg'])
+    parsedNames = []
+    archive_index.ArchiveIndex(getParseFn(parsedNames), dirPath, indexPath=indexPath)
+    assert sorted(parsedNames) == ['cam1__1000.jpg', 'cam1__1060.jpg']
+
+    # directory changed since sidecar was written, but only new names are parsed
+    addFiles(dirPath, ['cam1__1120.jpg'])
+    os.remove(os.path.join(dirPath, 'cam1__1000.jpg'))
+    oldTime = time.time() - 100
+    os.utime(dirPath, (oldTime, oldTime))
+    parsedNames = []
+    index = archive_index.ArchiveIndex(getParseFn(parsedNames), dirPath, indexPath=indexPath)
+    assert parsedNames == ['cam1__1120.jpg']
+    assert index.getEntries('cam1') == [(1060, 'cam1__1060.jpg'), (1120, 'cam1__1120.jpg')]
+
+    # unchanged directory isn't listed again
+    os.utime(dirPath, (oldTime, oldTime))
+    os.rename(os.path.join(dirPath, 'cam1__1060.jpg'), os.path.join(dirPath, 'cam1__1061.jpg'))
+    os.utime(dirPath, (oldTime, oldTime)) # hide the rename
+    index = archive_index.ArchiveIndex(getParseFn(parsedNames), dirPath, indexPath=indexPath)
+    assert parsedNames == ['cam1__1120.jpg']
+    assert index.getEntries('cam1') == [(1060, 'cam1__1060.jpg'), (1120, 'cam1__1120.jpg')]
+
+
+def testSidecarLocked(tmp_path, monkeypatch):
+    dirPath = str(tmp_path)
+    indexPath = archive_index.getIndexPath(dirPath)
+    addFiles(dirPath, ['cam1__1000.jpg'])
+    monkeypatch.setattr(archive_index, 'SIDECAR_BUSY_TIMEOUT', 0.1)
+    index = archive_index.ArchiveIndex(getParseFn([]), dirPath, indexPath=indexPath)
+    assert sorted(os.listdir(dirPath)) == sorted(['cam1__1000.jpg', archive_index.INDEX_DIR_NAME])
+
+    # another process holds the sidecar lock
+    otherConn = sqlite3.connect(indexPath)
+    otherConn.execute('BEGIN EXCLUSIVE')
+    addFiles(dirPath, ['cam1__1060.jpg'])
+    index.insert('cam1__1060.jpg')
+    index.remove('cam1__1000.jpg')
+    os.remove(os.path.join(dirPath, 'cam1__1000.jpg'))
+    assert index.getEntries('cam1') == [(1060, 'cam1__1060.jpg')]
+    otherConn.rollback()
+    otherConn.close()
+
+    # missed updates are picked up by the next load
+    oldTime = time.time() - 100
+    os.utime(dirPath, (oldTime, oldTime))
+    index = archive_index.ArchiveIndex(getParseFn([]), dirPath, indexPath=indexPath)
+    assert index.getEntries('cam1') == [(1060, 'cam1__1060.jpg')]
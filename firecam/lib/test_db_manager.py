@@ -0,0 +1,152 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test db_manager
+
+"""
+
+from firecam.lib import db_manager
+import numpy as np
+import pytest
+import threading
+
+def scoreRows(timestamp, numRows):
+    return [{'CameraName': 'cam1', 'Timestamp': timestamp, 'MinX': i, 'Score': np.float32(0.5)} for i in range(numRows)]
+
+
+def testAddData(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    dbManager.add_data('sources', {'name': "it's", 'url': 'http://a/b'})
+    dbManager.add_data('scores', scoreRows(100, 60))
+    assert dbManager.query("SELECT name FROM sources") == [{'name': "it's"}]
+    dbResult = dbManager.query("SELECT count(*) as ct, sum(score) as total FROM scores")
+    assert dbResult == [{'ct': 60, 'total': 30}]
+
+
+def testWriteBehind(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    dbManager.add_data('archive', {'CameraId': 'cam1', 'Heading': 0, 'Timestamp': 100, 'Processed': 0})
+    # long delay so writes only happen on flush or when batch is full
+    dbManager.startWriteBehind(maxBatchRows=1000, maxDelaySeconds=60, maxPendingRows=100)
+    for timestamp in range(10):
+        dbManager.addDataDeferred('scores', scoreRows(timestamp, 5))
+    dbManager.executeDeferred("UPDATE archive SET processed = 1 WHERE CameraId='cam1'")
+    dbManager.flushWrites()
+    assert dbManager.query("SELECT count(*) as ct FROM scores") == [{'ct': 50}]
+    assert dbManager.query("SELECT processed FROM archive") == [{'processed': 1}]
+    assert dbManager.writeBehind.stats['batches'] == 1 # coalesced into single batch
+
+    # more rows than maxPendingRows requires writing while queueing
+    for timestamp in range(100):
+        dbManager.addDataDeferred('scores', scoreRows(timestamp, 5))
+    dbManager.writeBehind.close()
+    assert dbManager.query("SELECT count(*) as ct FROM scores") == [{'ct': 550}]
+    assert dbManager.writeBehind.stats['blocked'] > 0
+    assert dbManager.writeBehind.stats['errors'] == 0
+
+
+def testWriteBehindBadRow(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    dbManager.add_data('archive', {'CameraId': 'cam1', 'Heading': 0, 'Timestamp': 100, 'Processed': 0})
+    dbManager.startWriteBehind(maxBatchRows=1000, maxDelaySeconds=60, maxPendingRows=1000)
+    dbManager.addDataDeferred('scores', scoreRows(1, 5))
+    badRows = scoreRows(2, 5)
+    badRows[3]['Score'] = {'not': 'bindable'}
+    dbManager.addDataDeferred('scores', badRows) # coalesced with the good rows around it
+    dbManager.addDataDeferred('scores', scoreRows(3, 5))
+    dbManager.executeDeferred("UPDATE archive SET processed = 1 WHERE CameraId='cam1'")
+    dbManager.executeDeferred("UPDATE no_such_table SET x = 1")
+    dbManager.flushWrites()
+    dbResult = dbManager.query("SELECT timestamp, count(*) as ct FROM scores GROUP BY timestamp ORDER BY timestamp")
+    assert dbResult == [{'timestamp': 1, 'ct': 5}, {'timestamp': 3, 'ct': 5}] # none of the bad entry's rows
+    assert dbManager.query("SELECT processed FROM archive") == [{'processed': 1}]
+    assert dbManager.writeBehind.stats['errors'] == 2
+    dbManager.writeBehind.close()
+
+
+def testWriteBehindConnectFailure(tmp_path, monkeypatch):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    # writer connection fails twice (e.g. DB unreachable at startup) before it succeeds
+    monkeypatch.setattr(db_manager, 'WRITER_RETRY_SECONDS', 0.01)
+    RealDbManager = db_manager.DbManager
+    attempts = []
+    def connectFn(**connectArgs):
+        attempts.append(1)
+        if len(attempts) <= 2:
+            raise IOError('DB unreachable')
+        return RealDbManager(**connectArgs)
+    monkeypatch.setattr(db_manager, 'DbManager', connectFn)
+    dbManager.startWriteBehind(maxBatchRows=1000, maxDelaySeconds=60, maxPendingRows=1000)
+    dbManager.addDataDeferred('scores', scoreRows(1, 5))
+    dbManager.flushWrites()
+    assert dbManager.query("SELECT count(*) as ct FROM scores") == [{'ct': 5}]
+    assert dbManager.writeBehind.stats['connectErrors'] == 2
+    dbManager.writeBehind.close()
+
+
+def testWriteBehindWriterDied(tmp_path, monkeypatch):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    def failFn(self):
+        raise RuntimeError('writer bug')
+    monkeypatch.setattr(db_manager.WriteBehindQueue, '_isReady', failFn)
+    dbManager.startWriteBehind(maxBatchRows=1000, maxDelaySeconds=60, maxPendingRows=1000)
+    dbManager.writeBehind.thread.join()
+    # writes aren't silently queued forever
+    with pytest.raises(RuntimeError):
+        dbManager.addDataDeferred('scores', scoreRows(1, 5))
+    assert dbManager.writeBehind.pending == []
+
+
+def testConnectionPool(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'), poolSize=2)
+    def insertFn(cameraName):
+        for timestamp in range(20):
+            dbManager.add_data('scores', {'CameraName': cameraName, 'Timestamp': timestamp})
+    threads = [threading.Thread(target=insertFn, args=('cam%d' % i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert dbManager.query("SELECT count(*) as ct FROM scores") == [{'ct': 80}]
+    stats = dbManager.getPoolStats()
+    assert stats['connections'] <= 2
+    assert stats['connections'] == stats['idle'] # all given back
+
+
+def testConnectionPoolWait(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'), poolSize=1)
+    # uncommitted transaction keeps the connection borrowed until commit
+    dbManager.add_data('sources', {'name': 'cam1'}, commit=False)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(dbManager.query("SELECT name FROM sources")))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive() # waiting for connection
+    dbManager.commit()
+    thread.join()
+    assert result == [[{'name': 'cam1'}]]
+    assert dbManager.getPoolStats()['waits'] == 1
+
+
+def testIndexes(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'), createIndexes=False)
+    assert 'archive_camera_time' in dbManager.getMissingIndexes()
+    dbManager.close()
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    assert dbManager.getMissingIndexes() == []
+    dbManager.createIndexes() # idempotent
+    plan = dbManager.query("EXPLAIN QUERY PLAN SELECT * FROM archive WHERE CameraId='cam1' and Timestamp > 100")
+    assert 'archive_camera_time' in plan[0]['detail']
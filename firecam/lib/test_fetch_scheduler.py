@@ -0,0 +1,83 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test fetch_scheduler
+
+"""
+
+from firecam.lib import fetch_scheduler
+import threading
+import time
+
+
+def testAdaptiveInterval():
+    interval = fetch_scheduler.AdaptiveInterval(maxFactor=4)
+    assert interval.getInterval(60) == 60
+    for i in range(20):
+        interval.update(False)
+    assert 200 < interval.getInterval(60) <= 240
+    for i in range(20):
+        interval.update(True)
+    assert 60 <= interval.getInterval(60) < 61
+
+
+def testNoBarrier():
+    # slow task doesn't delay the fast tasks sharing the workers
+    runs = []
+    lock = threading.Lock()
+    def taskFn(key):
+        with lock:
+            runs.append(key)
+        if key == 'slow':
+            time.sleep(0.5)
+            return None
+        return 0.05
+
+    scheduler = fetch_scheduler.FetchScheduler(taskFn, 2)
+    scheduler.add('slow')
+    scheduler.add('fast1')
+    scheduler.add('fast2')
+    scheduler.start()
+    time.sleep(0.4)
+    scheduler.setPaused(True)
+    numRuns = len(runs)
+    time.sleep(0.2)
+    assert len(runs) == numRuns # no tasks while paused
+    scheduler.stop()
+    assert runs.count('slow') == 1
+    assert runs.count('fast1') >= 3
+    assert runs.count('fast2') >= 3
+
+    stats = scheduler.getStats()
+    assert stats['tasks'] == len(runs)
+    assert stats['queued'] == 2 # slow was dropped
+    assert stats['maxLateness'] < 0.2
+    assert max(stats['utilization']) > 0.5 # worker running slow task was busy most of the time
+
+
+def testErrorRetry():
+    calls = []
+    def taskFn(key):
+        calls.append(key)
+        raise ValueError('bad camera')
+    scheduler = fetch_scheduler.FetchScheduler(taskFn, 1)
+    scheduler.add('cam1')
+    scheduler.start()
+    time.sleep(0.1)
+    scheduler.stop()
+    assert calls == ['cam1']
+    assert scheduler.getStats()['errors'] == 1
+    assert scheduler.queue[0][0] > time.time() + fetch_scheduler.ERROR_RETRY_SECONDS - 1
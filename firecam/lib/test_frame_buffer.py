@@ -0,0 +1,57 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test frame_buffer
+
+"""
+
+from firecam.lib import frame_buffer
+import numpy as np
+
+
+def getInput(value):
+    return {'array': np.full((10, 10, 3), value, dtype=np.uint8), 'brightness': value, 'smoothed': None}
+
+
+def testFind():
+    buffer = frame_buffer.PriorFrameBuffer(10000, framesPerView=3)
+    for timestamp in [1000, 1030, 1060, 1090]:
+        buffer.add('cam1', 0, timestamp, getInput(timestamp % 256))
+    assert [x[0] for x in buffer.find('cam1', 0, 1000, 1100)] == [1090, 1060, 1030] # oldest dropped
+    assert [x[0] for x in buffer.find('cam1', 0, 1030, 1065)] == [1060, 1030]
+    assert buffer.find('cam1', 90, 1000, 1100) == []
+    assert buffer.find('cam2', 0, 1000, 1100) == []
+    assert buffer.stats['hits'] == 2
+    assert buffer.stats['misses'] == 2
+
+    # returned inputs are copies
+    (timestamp, diffInput) = buffer.find('cam1', 0, 1090, 1090)[0]
+    diffInput['smoothed'] = diffInput['array']
+    assert buffer.find('cam1', 0, 1090, 1090)[0][1]['smoothed'] is None
+
+
+def testEvictLeastRecentlyUsed():
+    buffer = frame_buffer.PriorFrameBuffer(3 * 300)
+    buffer.add('cam1', 0, 1000, getInput(1))
+    buffer.add('cam2', 0, 1000, getInput(2))
+    buffer.add('cam3', 0, 1000, getInput(3))
+    assert buffer.find('cam1', 0, 1000, 1000) # cam1 now more recently used than cam2
+    buffer.add('cam4', 0, 1000, getInput(4))
+    assert buffer.find('cam2', 0, 1000, 1000) == []
+    assert buffer.find('cam1', 0, 1000, 1000)
+    assert buffer.find('cam4', 0, 1000, 1000)
+    assert buffer.totalBytes == 3 * 300
+    assert buffer.stats['evicted'] == 1
@@ -0,0 +1,146 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test http_fetcher against a local server standing in for the cameras
+
+"""
+
+from firecam.lib import http_fetcher
+import os
+import threading
+import hashlib
+import time
+import http.server
+import pytest
+
+
+class CameraHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup(self):
+        super().setup()
+        self.server.numConnections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.maxActive = max(self.server.maxActive, self.server.active)
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.active -= 1
+        if self.path not in self.server.images:
+            self.send_error(404)
+            return
+        (etag, body) = self.server.images[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), CameraHandler)
+    server.images = {'/cam1.jpg': ('"v1"', b'\xff\xd8' + os.urandom(200000))}
+    server.numConnections = 0
+    server.active = 0
+    server.maxActive = 0
+    server.delay = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def getUrl(server, path):
+    return 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+
+
+def testConditionalFetch(server, tmp_path):
+    fetcher = http_fetcher.HttpFetcher()
+    url = getUrl(server, '/cam1.jpg')
+    path1 = str(tmp_path / 'a.jpg')
+    assert fetcher.fetch(url, path1)
+    with open(path1, 'rb') as imgFile:
+        assert imgFile.read() == server.images['/cam1.jpg'][1]
+
+    # unchanged image isn't written
+    path2 = str(tmp_path / 'b.jpg')
+    assert not fetcher.fetch(url, path2)
+    assert not os.path.exists(path2)
+
+    server.images['/cam1.jpg'] = ('"v2"', b'\xff\xd8new')
+    assert fetcher.fetch(url, path2)
+    assert sorted(os.listdir(str(tmp_path))) == ['a.jpg', 'b.jpg']
+    assert fetcher.stats['fetches'] == 2
+    assert fetcher.stats['notModified'] == 1
+    assert server.numConnections == 1 # connection kept alive
+
+
+def testHostLimit(server, tmp_path):
+    fetcher = http_fetcher.HttpFetcher(connectionsPerHost=2)
+    server.delay = 0.1
+    url = getUrl(server, '/cam1.jpg')
+    threads = [threading.Thread(target=fetcher.fetch, args=(url, str(tmp_path / ('%d.jpg' % i)))) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.maxActive == 2
+    assert server.numConnections == 2
+    assert fetcher.stats['waits'] > 0
+    with pytest.raises(Exception):
+        fetcher.fetch(getUrl(server, '/missing.jpg'), str(tmp_path / 'missing.jpg'))
+    assert fetcher.stats['errors'] == 1
+    assert not os.path.exists(str(tmp_path / 'missing.jpg'))
+
+
+def testAcceptFn(server, tmp_path):
+    fetcher = http_fetcher.HttpFetcher()
+    url = getUrl(server, '/cam1.jpg')
+    seen = set()
+    def acceptFn(md5):
+        isNew = md5 not in seen
+        seen.add(md5)
+        return isNew
+    path1 = str(tmp_path / 'a.jpg')
+    assert fetcher.fetch(url, path1, acceptFn=acceptFn) == hashlib.md5(server.images['/cam1.jpg'][1]).hexdigest()
+    # same content with new ETag is rejected before it's renamed into place
+    server.images['/cam1.jpg'] = ('"v2"', server.images['/cam1.jpg'][1])
+    path2 = str(tmp_path / 'b.jpg')
+    assert fetcher.fetch(url, path2, acceptFn=acceptFn) == None
+    assert os.listdir(str(tmp_path)) == ['a.jpg']
+    assert fetcher.stats['rejected'] == 1
+
+    # failure after content is received leaves no files
+    def failFn(md5):
+        raise IOError('failed')
+    server.images['/cam1.jpg'] = ('"v3"', b'\xff\xd8new')
+    with pytest.raises(IOError):
+        fetcher.fetch(url, path2, acceptFn=failFn)
+    assert os.listdir(str(tmp_path)) == ['a.jpg']
@@ -0,0 +1,54 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test image_frame
+
+"""
+
+from firecam.lib import image_frame
+import hashlib
+import numpy as np
+from PIL import Image
+
+
+def testFrame(tmp_path):
+    imgPath = str(tmp_path / 'test.jpg')
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (200, 300, 3), dtype=np.uint8)).save(imgPath, format='JPEG', quality=95)
+
+    frame = image_frame.Frame(imgPath)
+    assert frame.getSize() == (300, 200)
+    assert frame.getMd5() == hashlib.md5(open(imgPath, 'rb').read()).hexdigest()
+
+    img = Image.open(imgPath)
+    expected = np.asarray(img)
+    img.close()
+    imgArray = frame.getArray()
+    assert imgArray.shape == (200, 300, 3)
+    assert np.array_equal(imgArray, expected)
+    assert frame.getArray() is imgArray # decoded once
+    assert np.array_equal(np.asarray(frame.getImage()), expected)
+    assert image_frame.asFrame(frame) is frame
+
+    frame.release()
+    assert frame.imgArray is None
+    assert np.array_equal(frame.getArray(), expected)
+
+
+def testParseExifTimestamp():
+    assert image_frame.parseExifTimestamp(b'xx 1600000000 UTC xx') == 1600000000
+    assert image_frame.parseExifTimestamp(b'xx 2020:09:13 12:26:40 xx') == 1600000000
+    assert image_frame.parseExifTimestamp(b'nothing') == None
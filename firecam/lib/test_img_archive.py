@@ -0,0 +1,197 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test img_archive image diff functions against Pillow based reference implementations,
+image alignment, filename parsing, and archive queries
+
+"""
+
+from firecam.lib import settings
+from firecam.lib import img_archive
+from firecam.lib import db_manager
+import os
+import errno
+import numpy as np
+import cv2
+import datetime
+from PIL import Image, ImageMath, ImageStat
+
+# ImageMath.eval was renamed to unsafe_eval in newer Pillow versions
+imageMathEval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+
+def diffImagesPillow(imgA, imgB):
+    bandsImgA = imgA.split()
+    bandsImgB = imgB.split()
+    absDiff = imageMathEval("convert(abs(a0-b0) + abs(a1-b1) + abs(a2-b2), 'L')",
+        a0 = bandsImgA[0], b0 = bandsImgB[0],
+        a1 = bandsImgA[1], b1 = bandsImgB[1],
+        a2 = bandsImgA[2], b2 = bandsImgB[2])
+    bandsImgOut = [
+        imageMathEval("convert(a + 2*diff, 'L')", a = bandsImgA[0], diff = absDiff),
+        imageMathEval("convert(a - diff, 'L')", a = bandsImgA[1], diff = absDiff),
+        imageMathEval("convert(a - diff, 'L')", a = bandsImgA[2], diff = absDiff),
+    ]
+    return Image.merge('RGB', bandsImgOut)
+
+
+def smoothImagePillow(img):
+    imgBGR = cv2.cvtColor(np.asarray(img), cv2.COLOR_BGR2RGB)
+    smoothImgBGR = cv2.bilateralFilter(imgBGR, 9, 75, 75)
+    smoothImgRGB = cv2.cvtColor(smoothImgBGR, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(smoothImgRGB)
+
+
+def getTestImages():
+    rng = np.random.default_rng(0)
+    arrA = rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    arrB = arrA.copy()
+    arrB[100:180, 50:250] = rng.integers(0, 256, (80, 200, 3), dtype=np.uint8)
+    arrB[0:50] = np.clip(arrB[0:50].astype(int) + 40, 0, 255) # saturated values
+    return (Image.fromarray(arrA), Image.fromarray(arrB))
+
+
+def testDiffImages():
+    (imgA, imgB) = getTestImages()
+    expected = np.asarray(diffImagesPillow(imgA, imgB))
+    assert np.array_equal(np.asarray(img_archive.diffImages(imgA, imgB)), expected)
+    assert np.array_equal(np.asarray(img_archive.diffImages(imgB, imgA)), np.asarray(diffImagesPillow(imgB, imgA)))
+
+
+def testSmoothAndDiff():
+    (imgA, imgB) = getTestImages()
+    assert np.array_equal(np.asarray(img_archive.smoothImage(imgA)), np.asarray(smoothImagePillow(imgA)))
+    expected = np.asarray(diffImagesPillow(smoothImagePillow(imgA), smoothImagePillow(imgB)))
+    assert np.array_equal(np.asarray(img_archive.diffSmoothImages(imgA, imgB)), expected)
+    assert np.array_equal(np.asarray(img_archive.diffWithChecks(imgA, imgB)), expected)
+    assert np.array_equal(np.asarray(img_archive.diffWithChecks(np.asarray(imgA), imgB)), expected)
+
+
+def testBrightness():
+    (imgA, imgB) = getTestImages()
+    for img in [imgA, imgB, Image.new('RGB', (10, 10))]:
+        medians = ImageStat.Stat(img).median
+        expected = max((medians[0] + medians[1] + medians[2]) / 3, .01)
+        assert img_archive.brightness(img) == expected
+
+
+def testRescaleValues():
+    (imgA, imgB) = getTestImages()
+    ratios = (0.93, 1.07, 1.5)
+    bands = imgA.split()
+    expected = Image.merge('RGB', [imageMathEval("convert(float(a)*%s, 'L')" % ratio, a = band)
+                                    for (band, ratio) in zip(bands, ratios)])
+    assert np.array_equal(np.asarray(img_archive.rescaleValues(imgA, ratios)), np.asarray(expected))
+
+
+def testFindTranslationOffset():
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0, 1, (460, 760)).astype(np.float32)
+    scene = cv2.normalize(cv2.GaussianBlur(noise, (0, 0), 3) + cv2.GaussianBlur(noise, (0, 0), 12) * 4, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    base = scene[30:430, 30:730]
+    shifted = scene[34:434, 23:723] # scene content moved right by 7 and up by 4 pixels
+    for coarseToFine in [False, True]:
+        (alignable, dx, dy) = img_archive.findTranslationOffsetGray(base, shifted, 40, 1e-6, coarseToFine)
+        assert alignable
+        assert (round(dx), round(dy)) == (7, -4)
+    (alignable, dx, dy) = img_archive.findTranslationOffsetGray(base, np.flipud(base).copy(), 40, 1e-6)
+    assert not alignable
+
+
+def testParseFilename():
+    parsed = img_archive.parseFilename('lo-s-mobo-c__2018-06-06T11;12;23_Diff1_Crop_627x632x1279x931.jpg')
+    assert parsed['cameraID'] == 'lo-s-mobo-c'
+    assert parsed['isoStr'] == '2018-06-06T11:12:23'
+    assert parsed['unixTime'] == int(datetime.datetime(2018, 6, 6, 11, 12, 23).timestamp())
+    assert parsed['diffMinutes'] == 1
+    assert (parsed['minX'], parsed['minY'], parsed['maxX'], parsed['maxY']) == (627, 632, 1279, 931)
+    parsed['cameraID'] = 'modified'
+    assert img_archive.parseFilename('lo-s-mobo-c__2018-06-06T11;12;23_Diff1_Crop_627x632x1279x931.jpg')['cameraID'] == 'lo-s-mobo-c'
+
+    parsed = img_archive.parseFilename('Axis-BaldCA_2018-05-29T16_02_30_129496.jpg')
+    assert (parsed['cameraID'], parsed['diffMinutes']) == ('Axis-BaldCA', 0)
+    assert 'minX' not in parsed
+    assert img_archive.parseFilename('1499546263.jpg')['unixTime'] == 1499546263
+    assert img_archive.parseFilename('notAnImage.txt') == None
+
+    # round trip with getImgPath
+    for timestamp in [1528308743, 1572769800, 1552210200]:
+        assert img_archive.parseFilename(img_archive.getImgPath('', 'cam-1', timestamp))['unixTime'] == timestamp
+
+
+def testParseFilenames():
+    names = ['cam-1__2018-06-06T11;12;23.jpg', 'cam-2__2018-06-06T11;12;23.jpg', 'bad.jpg', 'cam-1__2018-06-06T11;13;23.jpg']
+    (cameraIDs, cameraCodes, unixTimes) = img_archive.parseFilenames(names)
+    assert cameraIDs == ['cam-1', 'cam-2']
+    assert cameraCodes.tolist() == [0, 1, -1, 0]
+    expected = int(datetime.datetime(2018, 6, 6, 11, 12, 23).timestamp())
+    assert unixTimes.tolist() == [expected, expected, 0, expected + 60]
+
+
+def testRecentArchiveEntries(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    rows = []
+    for (cameraID, headings) in [('fixed', [90, 90, 91, 90]), ('rotate', [0, 90, 180, 270, 0]), ('old', [10])]:
+        for (i, heading) in enumerate(headings):
+            timestamp = (500 if cameraID == 'old' else 1000) + i * 20
+            rows.append({'CameraId': cameraID, 'Heading': heading, 'Timestamp': timestamp, 'ImagePath': '/x.jpg',
+                         'FieldOfView': 110, 'Processed': 0})
+    dbManager.add_data('archive', rows)
+    recentEntries = img_archive.getRecentArchiveEntries(dbManager, 900)
+    assert recentEntries == {
+        'fixed': [(90, 1060), (91, 1040), (90, 1020)],
+        'rotate': [(0, 1080), (270, 1060), (180, 1040)],
+    }
+    assert img_archive.getSpinFetchInfo(recentEntries['fixed'], 900) == (False, 1060)
+    assert img_archive.getSpinFetchInfo(recentEntries['rotate'], 900) == (True, 1080)
+    assert img_archive.getSpinFetchInfo(recentEntries['rotate'], 1070) == (False, 1080)
+    assert img_archive.getSpinFetchInfo([], 900) == (False, 0)
+
+
+def testIsNewImage():
+    img_archive.isNewImage.recentHashes = {}
+    img_archive.isNewImage.duplicates = {}
+    assert img_archive.isNewImage('cam1', 'a')
+    assert img_archive.isNewImage('cam1', 'a') # not recorded, e.g. write failed
+    img_archive.recordImage('cam1', 'a')
+    assert img_archive.isNewImage('cam2', 'a')
+    assert not img_archive.isNewImage('cam1', 'a')
+    for i in range(img_archive.RECENT_HASHES_PER_CAMERA):
+        assert img_archive.isNewImage('cam1', str(i))
+        img_archive.recordImage('cam1', str(i))
+    assert img_archive.isNewImage('cam1', 'a') # forgotten
+    assert img_archive.getDuplicateCounts() == {'cam1': 1}
+
+
+def testLinkOrCopy(tmp_path, monkeypatch):
+    srcPath = str(tmp_path / 'src.jpg')
+    with open(srcPath, 'wb') as srcFile:
+        srcFile.write(b'image')
+    destPath = str(tmp_path / 'dest.jpg')
+    assert img_archive.linkOrCopy(srcPath, destPath) == 'link'
+    assert os.path.samefile(srcPath, destPath)
+    assert img_archive.linkOrCopy(srcPath, destPath) == 'link' # already there
+    os.remove(destPath) # caller cleanup leaves the archived file
+    assert os.path.exists(srcPath)
+
+    # hard links not possible (e.g. different filesystem)
+    def crossDeviceLink(src, dest):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', crossDeviceLink)
+    assert img_archive.linkOrCopy(srcPath, destPath) == 'copy'
+    assert not os.path.samefile(srcPath, destPath)
+    with open(destPath, 'rb') as destFile:
+        assert destFile.read() == b'image'
@@ -0,0 +1,60 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test rect_to_squares
+
+"""
+
+from firecam.lib import rect_to_squares
+import numpy as np
+from PIL import Image
+import pytest
+
+def randomImage(sizeX, sizeY):
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, size=(sizeY, sizeX, 3), dtype=np.uint8))
+
+
+def testSegmentRanges():
+    assert rect_to_squares.getSegmentRanges(200, 299) == []
+    assert rect_to_squares.getSegmentRanges(299, 299) == [(0, 299)]
+    ranges = rect_to_squares.getSegmentRanges(1000, 299)
+    assert ranges[0] == (0, 299)
+    assert ranges[-1] == (701, 1000)
+
+
+def testUint8MatchesFloat():
+    img = randomImage(1100, 700)
+    for (startX, endX, startY, endY) in [(0, None, 0, None), (50, -50, 50, -50), (200, 600, 100, 450)]:
+        (crops, segments) = rect_to_squares.cutBoxesArray(img, startX, endX, startY, endY)
+        (cropsUint8, segmentsUint8) = rect_to_squares.cutBoxesArrayUint8(img, startX, endX, startY, endY)
+        assert cropsUint8.dtype == np.uint8
+        assert segments == segmentsUint8
+        assert np.array_equal(crops, rect_to_squares.normalizeCrops(cropsUint8))
+
+
+def testReuseBuffers():
+    img = randomImage(1100, 700)
+    (crops, segments) = rect_to_squares.cutBoxesArrayUint8(img)
+    normalized = rect_to_squares.normalizeCrops(crops)
+    # smaller region should reuse the existing buffers
+    (crops2, segments2) = rect_to_squares.cutBoxesArrayUint8(img, 200, 600, 100, 450, batchBuffer=crops)
+    assert len(crops2) < len(crops)
+    assert np.shares_memory(crops2, crops)
+    normalized2 = rect_to_squares.normalizeCrops(crops2, out=normalized)
+    assert np.shares_memory(normalized2, normalized)
+    (expected, x) = rect_to_squares.cutBoxesArray(img, 200, 600, 100, 450)
+    assert np.array_equal(expected, normalized2)
@@ -0,0 +1,147 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test score_history
+
+"""
+
+from firecam.lib import db_manager
+from firecam.lib import score_history
+import datetime
+import random
+import pytest
+
+MODEL_ID = 'test/model'
+COORDS = [(0, 0, 299, 299), (250, 0, 549, 299), (0, 250, 299, 549)]
+
+def addScores(dbManager, cameraID, heading, startTime, endTime):
+    rng = random.Random(startTime)
+    dbRows = []
+    # offset by 7 seconds so no scores fall exactly on time bucket boundaries
+    for timestamp in range(startTime + 7, endTime, 5*60):
+        dt = datetime.datetime.fromtimestamp(timestamp)
+        for (minX, minY, maxX, maxY) in COORDS:
+            dbRows.append({
+                'CameraName': cameraID,
+                'Heading': heading,
+                'Timestamp': timestamp,
+                'MinX': minX,
+                'MinY': minY,
+                'MaxX': maxX,
+                'MaxY': maxY,
+                'Score': rng.random(),
+                'MinusMinutes': 0,
+                'SecondsInDay': (dt.hour * 60 + dt.minute) * 60 + dt.second,
+                'ModelId': MODEL_ID
+            })
+    dbManager.add_data('scores', dbRows)
+
+
+def queryHistory(dbManager, cameraID, heading, timestamp):
+    # reference implementation: direct aggregation over scores table
+    sqlTemplate = """SELECT MinX,MinY,MaxX,MaxY,count(*) as cnt, avg(score) as avgs, max(score) as maxs FROM scores
+    WHERE CameraName='%s' and Heading>=%s and Heading<=%s and Timestamp > %s and Timestamp < %s and SecondsInDay > %s and SecondsInDay < %s
+    and ModelId='%s'
+    GROUP BY MinX,MinY,MaxX,MaxY"""
+    dt = datetime.datetime.fromtimestamp(timestamp)
+    secondsInDay = (dt.hour * 60 + dt.minute) * 60 + dt.second
+    sqlStr = sqlTemplate % (cameraID, heading-1, heading+1, timestamp - 60*60*int(24*7.5), timestamp - 60*60*12, secondsInDay - 60*60, secondsInDay + 60*60, MODEL_ID)
+    result = {}
+    for row in dbManager.query(sqlStr):
+        result[(row['minx'], row['miny'], row['maxx'], row['maxy'])] = row
+    return result
+
+
+def checkMatches(cache, dbManager, cameraID, heading, timestamp):
+    expected = queryHistory(dbManager, cameraID, heading, timestamp)
+    history = cache.getHistory(cameraID, heading, timestamp, COORDS)
+    assert len(expected) > 0
+    assert set(history.keys()) == set(expected.keys())
+    for coords in expected:
+        assert history[coords]['cnt'] == expected[coords]['cnt']
+        assert history[coords]['avgs'] == pytest.approx(expected[coords]['avgs'], abs=1e-5)
+        assert history[coords]['maxs'] == pytest.approx(expected[coords]['maxs'], abs=1e-6)
+
+
+def testMatchesQuery(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    # midday UTC avoids time of day windows wrapping around midnight
+    timestamp = int(datetime.datetime(2020, 7, 20, 12, 0, tzinfo=datetime.timezone.utc).timestamp())
+    addScores(dbManager, 'cam1', 90, timestamp - 9*24*60*60, timestamp)
+    addScores(dbManager, 'cam1', 180, timestamp - 9*24*60*60, timestamp)
+    # split the fold mid bucket to check partial buckets are combined
+    score_history.foldScores(dbManager, timestamp - 24*60*60 - 100)
+    score_history.foldScores(dbManager, timestamp)
+    assert score_history.getFoldedUntil(dbManager) == timestamp
+    cache = score_history.ScoreHistoryCache(dbManager, MODEL_ID)
+    cache.prewarm(timestamp)
+    assert cache.stats['loads'] == 2
+    checkMatches(cache, dbManager, 'cam1', 90, timestamp)
+    checkMatches(cache, dbManager, 'cam1', 180, timestamp)
+    assert cache.stats['loads'] == 2
+
+    # next day's images are handled by incrementally adding newly folded scores
+    laterTimestamp = timestamp + 24*60*60
+    addScores(dbManager, 'cam1', 90, timestamp, laterTimestamp)
+    score_history.foldScores(dbManager, laterTimestamp)
+    cache.foldedCheckTime = 0
+    checkMatches(cache, dbManager, 'cam1', 90, laterTimestamp)
+    assert cache.stats['loads'] == 2
+    assert cache.stats['syncs'] == 1
+
+    # unknown segments have no history
+    assert cache.getHistory('cam1', 90, laterTimestamp, [(1, 2, 3, 4)]) == {}
+
+
+def testEviction(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    timestamp = int(datetime.datetime(2020, 7, 20, 12, 0, tzinfo=datetime.timezone.utc).timestamp())
+    addScores(dbManager, 'cam1', 90, timestamp - 9*24*60*60, timestamp)
+    addScores(dbManager, 'cam1', 180, timestamp - 9*24*60*60, timestamp)
+    score_history.foldScores(dbManager, timestamp)
+    # room for just one entry
+    cache = score_history.ScoreHistoryCache(dbManager, MODEL_ID, maxBytes=1)
+    checkMatches(cache, dbManager, 'cam1', 90, timestamp)
+    checkMatches(cache, dbManager, 'cam1', 180, timestamp)
+    assert list(cache.entries.keys()) == [('cam1', 180)]
+    assert cache.totalBytes == cache.entries[('cam1', 180)]['numBytes']
+    assert cache.stats['evicted'] == 1
+    # evicted entry is reloaded
+    checkMatches(cache, dbManager, 'cam1', 90, timestamp)
+    assert cache.stats['loads'] == 3
+    assert list(cache.entries.keys()) == [('cam1', 90)]
+
+
+def testUnfolded(tmp_path):
+    dbManager = db_manager.DbManager(sqliteFile=str(tmp_path / 'test.db'))
+    timestamp = int(datetime.datetime(2020, 7, 20, 12, 0, tzinfo=datetime.timezone.utc).timestamp())
+    addScores(dbManager, 'cam1', 90, timestamp - 9*24*60*60, timestamp)
+    # no fold yet (e.g. no archiver), so history comes from raw scores
+    cache = score_history.ScoreHistoryCache(dbManager, MODEL_ID)
+    checkMatches(cache, dbManager, 'cam1', 90, timestamp)
+    assert cache.stats['rawQueries'] == 1
+
+    # after a fold mid bucket, buckets loaded from raw scores aren't counted again
+    laterTimestamp = timestamp + 24*60*60
+    addScores(dbManager, 'cam1', 90, timestamp, laterTimestamp)
+    score_history.foldScores(dbManager, timestamp + 12*60*60 - 100)
+    cache.foldedCheckTime = 0
+    checkMatches(cache, dbManager, 'cam1', 90, laterTimestamp)
+    assert cache.stats['loads'] == 1
+    assert cache.stats['syncs'] == 1
+    # fresh cache combines folded and raw scores
+    cache = score_history.ScoreHistoryCache(dbManager, MODEL_ID)
+    checkMatches(cache, dbManager, 'cam1', 90, laterTimestamp)
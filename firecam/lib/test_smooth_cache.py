@@ -0,0 +1,87 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test smooth_cache
+
+"""
+
+from firecam.lib import smooth_cache
+import os
+import threading
+import numpy as np
+
+
+def getSmoothFn(value, calls):
+    def smoothFn():
+        calls.append(value)
+        return np.full((10, 10, 3), value, dtype=np.uint8)
+    return smoothFn
+
+
+def testMemoryTier():
+    cache = smooth_cache.SmoothCache(2 * 300)
+    calls = []
+    assert cache.get(('a', 'bilateral', 9), getSmoothFn(1, calls))[0, 0, 0] == 1
+    assert cache.get(('a', 'bilateral', 9), getSmoothFn(1, calls))[0, 0, 0] == 1
+    assert calls == [1]
+    # different filter params are different entries
+    cache.get(('a', 'bilateral', 5), getSmoothFn(2, calls))
+    cache.get(('b', 'bilateral', 9), getSmoothFn(3, calls)) # evicts ('a', 'bilateral', 9)
+    assert cache.totalBytes == 2 * 300
+    cache.get(('a', 'bilateral', 9), getSmoothFn(1, calls))
+    assert calls == [1, 2, 3, 1]
+    assert cache.stats == {'memoryHits': 1, 'diskHits': 0, 'misses': 4}
+
+    # memory tier disabled
+    cache = smooth_cache.SmoothCache(0)
+    cache.get(('a', 'bilateral', 9), getSmoothFn(1, calls))
+    cache.get(('a', 'bilateral', 9), getSmoothFn(1, calls))
+    assert calls == [1, 2, 3, 1, 1, 1]
+    assert cache.totalBytes == 0
+
+
+def testDiskTier(tmp_path):
+    cacheDir = str(tmp_path)
+    calls = []
+    cache = smooth_cache.SmoothCache(1000, cacheDir)
+    cache.get(('a', 'bilateral', 9), getSmoothFn(1, calls))
+    cache.get(('b', 'bilateral', 9), getSmoothFn(2, calls))
+    assert sorted(os.listdir(cacheDir)) == ['a_bilateral_9.npy', 'b_bilateral_9.npy']
+    fileBytes = os.path.getsize(os.path.join(cacheDir, 'a_bilateral_9.npy')) # .npy header + data
+
+    # new cache (e.g. another process) reads the files written by the first one
+    cache2 = smooth_cache.SmoothCache(1000, cacheDir, 2 * fileBytes)
+    assert cache2.diskBytes == 2 * fileBytes
+    assert cache2.get(('a', 'bilateral', 9), getSmoothFn(1, calls))[0, 0, 0] == 1
+    assert calls == [1, 2]
+    assert cache2.stats['diskHits'] == 1
+
+    # oldest file is removed when over limit
+    cache2.get(('c', 'bilateral', 9), getSmoothFn(3, calls))
+    assert cache2.diskBytes == 2 * fileBytes
+    assert len(os.listdir(cacheDir)) == 2
+
+
+def testGetSmoothCacheThreads(monkeypatch):
+    monkeypatch.setattr(smooth_cache.getSmoothCache, 'cache', None)
+    caches = []
+    threads = [threading.Thread(target=lambda: caches.append(smooth_cache.getSmoothCache())) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(caches) == 8
+    assert all([cache is caches[0] for cache in caches])
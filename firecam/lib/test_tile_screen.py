@@ -0,0 +1,90 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Test tile_screen
+
+"""
+
+from firecam.lib import rect_to_squares
+from firecam.lib import tile_screen
+import numpy as np
+
+
+def classify(screen, img, timestamp, scores):
+    crops, segments = rect_to_squares.cutBoxesArrayUint8(img)
+    (indexes, pending) = screen.select('cam1', 90, timestamp, crops, segments)
+    for i in indexes:
+        segments[i]['score'] = scores[i]
+    screen.update(pending, segments)
+    return (list(indexes), [segmentInfo['score'] for segmentInfo in segments])
+
+
+def testSelect():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (600, 900, 3), dtype=np.uint8) # 12 segments
+    firstScores = [i / 20 for i in range(12)]
+    screen = tile_screen.TileScreen(threshold=8, maxAge=600)
+
+    # first image classifies all segments
+    (indexes, scores) = classify(screen, img, 1000, firstScores)
+    assert indexes == list(range(12))
+
+    # unchanged image reuses previous scores
+    (indexes, scores) = classify(screen, img.copy(), 1060, [0.9] * 12)
+    assert indexes == []
+    assert scores == [np.float32(x) for x in firstScores]
+
+    # brighten a small patch in the last segment
+    img2 = img.copy()
+    img2[500:520, 800:820] = 255
+    (indexes, scores) = classify(screen, img2, 1120, [0.9] * 12)
+    assert indexes == [11]
+    assert scores[11] == 0.9
+
+    # segments are classified again after maxAge
+    (indexes, scores) = classify(screen, img2, 1000 + 600, [0.7] * 12)
+    assert indexes == list(range(11))
+    assert screen.stats['skipped'] == 12 + 11 + 1
+
+
+def testSameViewInBatch():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (600, 900, 3), dtype=np.uint8)
+    screen = tile_screen.TileScreen(threshold=8, maxAge=600)
+    classify(screen, img, 1000, [0.1] * 12)
+
+    # two images of same view selected before either is updated (e.g. in one batch)
+    img2 = img.copy()
+    img2[0:20, 0:20] = 255 # changes segment 0
+    img3 = img2.copy()
+    img3[500:520, 800:820] = 255 # changes segments 0 and 11
+    (crops2, segments2) = rect_to_squares.cutBoxesArrayUint8(img2)
+    (crops3, segments3) = rect_to_squares.cutBoxesArrayUint8(img3)
+    (indexes2, pending2) = screen.select('cam1', 90, 1060, crops2, segments2)
+    (indexes3, pending3) = screen.select('cam1', 90, 1060, crops3, segments3)
+    assert list(indexes2) == [0]
+    assert list(indexes3) == [0, 11]
+    segments2[0]['score'] = 0.2
+    segments3[0]['score'] = 0.3
+    segments3[11]['score'] = 0.4
+    screen.update(pending2, segments2)
+    screen.update(pending3, segments3)
+
+    # each image's scores are saved with its own signatures
+    (indexes, scores) = classify(screen, img3, 1120, [0.9] * 12)
+    assert indexes == []
+    assert scores[0] == np.float32(0.3)
+    assert scores[11] == np.float32(0.4)
@@ -22,12 +22,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from firecam.lib import settings
 from firecam.lib import goog_helper
 
+import os
 import logging
 import tempfile
+import numpy as np
 import tensorflow as tf
 
+def getLocalModelPath(modelPath, tmpDir):
+    """Return local path for given model, downloading it from GCS into tmpDir if needed
+
+    Args:
+        modelPath (str): local path or GCS path to model dir or file
+        tmpDir (str): local directory to store downloaded model
+
+    Returns:
+        Local path to model
+    """
+    gcsModel = goog_helper.parseGCSPath(modelPath)
+    if not gcsModel:
+        return modelPath
+    if getBackendForPath(modelPath): # single file models
+        localPath = os.path.join(tmpDir, gcsModel['name'].split('/')[-1])
+        goog_helper.downloadBucketFile(gcsModel['bucket'], gcsModel['name'], localPath)
+        return localPath
+    goog_helper.downloadBucketDir(gcsModel['bucket'], gcsModel['name'], tmpDir)
+    return tmpDir
+
+
 def loadModel(modelPath):
     """Load from given keras model
 
@@ -38,30 +62,147 @@ def loadModel(modelPath):
         Model object
     """
     # if model is on GCS, download it locally first
-    gcsModel = goog_helper.parseGCSPath(modelPath)
-    if gcsModel:
-        tmpDir = tempfile.TemporaryDirectory()
-        goog_helper.downloadBucketDir(gcsModel['bucket'], gcsModel['name'], tmpDir.name)
-        localPath = tmpDir.name
-    else:
-        localPath = modelPath
+    tmpDir = tempfile.TemporaryDirectory()
+    localPath = getLocalModelPath(modelPath, tmpDir.name)
     return tf.keras.models.load_model(localPath)
 
 
+INFERENCE_BACKENDS = ['keras', 'tf_function', 'tflite', 'onnx']
+def getBackendForPath(modelPath):
+    """Return the inference backend implied by the extension of given model path (or None)
+    """
+    if modelPath.endswith('.tflite'):
+        return 'tflite'
+    elif modelPath.endswith('.onnx'):
+        return 'onnx'
+    return None
+
+
+class TfFunctionModel:
+    """Keras model wrapped in a tf.function with fixed input signature, which avoids
+       the per call overhead of model.predict (data adapters, callbacks, retracing)
+    """
+    def __init__(self, kerasModel):
+        self.kerasModel = kerasModel
+        inputShape = [None] + list(kerasModel.inputs[0].shape[1:])
+        self.inferFn = tf.function(lambda x: kerasModel(x, training=False),
+                                   input_signature=[tf.TensorSpec(shape=inputShape, dtype=tf.float32)])
+
+
+    def predict(self, cropsNormalized):
+        return self.inferFn(tf.convert_to_tensor(cropsNormalized, dtype=tf.float32)).numpy()
+
+
+class TfliteModel:
+    """TFLite interpreter (XNNPACK delegate is applied by default on CPU for float models)
+    """
+    def __init__(self, modelPath, numThreads=None):
+        with open(modelPath, 'rb') as f:
+            self.interpreter = tf.lite.Interpreter(model_content=f.read(), num_threads=numThreads)
+        self.inputIndex = self.interpreter.get_input_details()[0]['index']
+        self.outputIndex = self.interpreter.get_output_details()[0]['index']
+        self.batchSize = None
+
+
+    def predict(self, cropsNormalized):
+        # resizing tensors is expensive, so only resize when the batch size changes
+        if len(cropsNormalized) != self.batchSize:
+            inputShape = self.interpreter.get_input_details()[0]['shape']
+            self.interpreter.resize_tensor_input(self.inputIndex, [len(cropsNormalized)] + list(inputShape[1:]))
+            self.interpreter.allocate_tensors()
+            self.batchSize = len(cropsNormalized)
+        self.interpreter.set_tensor(self.inputIndex, np.asarray(cropsNormalized, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.outputIndex)
+
+
+class OnnxModel:
+    """ONNX Runtime session (onnxruntime package is only required when this backend is used)
+    """
+    def __init__(self, modelPath, numThreads=None):
+        import onnxruntime
+        sessionOptions = onnxruntime.SessionOptions()
+        if numThreads:
+            sessionOptions.intra_op_num_threads = numThreads
+        with open(modelPath, 'rb') as f:
+            self.session = onnxruntime.InferenceSession(f.read(), sess_options=sessionOptions,
+                                                        providers=['CPUExecutionProvider'])
+        self.inputName = self.session.get_inputs()[0].name
+
+
+    def predict(self, cropsNormalized):
+        return self.session.run(None, {self.inputName: np.asarray(cropsNormalized, dtype=np.float32)})[0]
+
+
+def loadInferenceModel(modelPath, backend=None, numThreads=None, useServer=True):
+    """Load the given model for inference with the given backend
+
+    The backend is determined by the model file extension (.tflite, .onnx) if present,
+    otherwise by the backend parameter, otherwise by settings.inferenceBackend,
+    and defaults to 'keras' (model.predict)
+
+    If settings.inferenceSocket is set, the model is instead run by the local
+    inference server (bin/inference_server.py) listening on that socket, so
+    multiple processes can share a single copy of the model.
+
+    Args:
+        modelPath (str): path (local or GCS) to keras model dir, or .tflite/.onnx file
+        backend (str): [optional] one of INFERENCE_BACKENDS
+        numThreads (int): [optional] number of threads for tflite and onnx backends
+        useServer (bool): [optional] if False, always load the model in this process
+
+    Returns:
+        Model object usable by classifySegments
+    """
+    inferenceSocket = getattr(settings, 'inferenceSocket', None)
+    if useServer and inferenceSocket:
+        from firecam.lib import inference_service
+        logging.warning('Using inference server %s for model %s', inferenceSocket, modelPath)
+        return inference_service.InferenceClient(inferenceSocket, modelPath, backend)
+    backend = getBackendForPath(modelPath) or backend or getattr(settings, 'inferenceBackend', None) or 'keras'
+    if backend not in INFERENCE_BACKENDS:
+        raise Exception('Unknown inference backend %s' % backend)
+    numThreads = numThreads or getattr(settings, 'inferenceThreads', None)
+    logging.warning('Loading model %s with %s backend', modelPath, backend)
+    if backend in ['keras', 'tf_function']:
+        model = loadModel(modelPath)
+        return TfFunctionModel(model) if backend == 'tf_function' else model
+    with tempfile.TemporaryDirectory() as tmpDirName:
+        localPath = getLocalModelPath(modelPath, tmpDirName)
+        if backend == 'tflite':
+            return TfliteModel(localPath, numThreads)
+        return OnnxModel(localPath, numThreads)
+
+
+def predictCrops(model, cropsNormalized):
+    """Run the given model on normalized crops
+
+    Args:
+        model: model object from loadModel or loadInferenceModel calls above
+        cropsNormalized (np.array): normalized image data
+
+    Returns:
+        array of model outputs, one row per crop
+    """
+    # assuming crops is alrady normalized (done by cutBoxesArray)
+    if isinstance(model, tf.keras.Model):
+        return model.predict(cropsNormalized, verbose=0)
+    return model.predict(cropsNormalized)
+
+
 def classifySegments(model, cropsNormalized, segments):
     """Classify even segment with given model.  Segments are specified by two parallel list
        (one with raw data, other with metadata)
 
     Args:
-        model: model object from loadModel call above
+        model: model object from loadModel or loadInferenceModel calls above
         cropsNormalized (list): list of np arrays containing normalized image data
         segments (list): parallel list of metadata associated with each cropNormalized array
 
     Returns:
         list of results of classification
     """
-    # assuming crops is alrady normalized (done by cutBoxesArray)
-    results = model.predict(cropsNormalized, verbose=0)
+    results = predictCrops(model, cropsNormalized)
     # logging.warning('Results: %s', str(results))
     for i,scores in enumerate(results):
         segments[i]['score'] = scores[1]
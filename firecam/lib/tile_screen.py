@@ -0,0 +1,157 @@
+# Copyright 2020 Open Climate Tech Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+
+Cheap pre-screen (first stage of a cascade) that decides which image
+segments need to be classified by the smoke model.
+
+Each segment is reduced to a small grayscale signature (average of
+SIGNATURE_CELL x SIGNATURE_CELL pixel cells).  A segment is sent to the model
+only if some cell changed by at least the threshold since the last time the
+segment was classified for the same camera and heading, or if that was more
+than maxAge seconds ago.  Comparing against the last classified signature
+(rather than the previous frame) means slow changes like growing smoke
+accumulate until they cross the threshold.  Skipped segments reuse the
+score from the last classification.
+
+Enabled in InceptionV3AndHistoricalThreshold by settings.cascadeThreshold.
+benchmarks/bench_tile_screen.py measures the skip rate and recall on
+smoke bounding boxes for choosing the threshold.
+
+"""
+
+import logging
+import time
+import numpy as np
+
+SIGNATURE_CELL = 10 # pixels per side of signature cells
+DEFAULT_MAX_AGE = 10*60 # classify every segment at least this often (seconds)
+IDLE_EXPIRE_SECONDS = 60*60 # drop entries unused for this long
+STATS_INTERVAL = 10*60 # minimum time between expiring entries and logging stats
+
+
+def getSignatures(crops):
+    """Return grayscale signatures of the given crops
+
+    Args:
+        crops (np.array): uint8 crops (NxHxWx3) from rect_to_squares.cutBoxesArrayUint8
+
+    Returns:
+        np.array (uint8) with average brightness of each cell of each crop
+    """
+    cellsY = crops.shape[1] // SIGNATURE_CELL
+    cellsX = crops.shape[2] // SIGNATURE_CELL
+    trimmed = crops[:, :cellsY*SIGNATURE_CELL, :cellsX*SIGNATURE_CELL]
+    cells = trimmed.reshape(len(crops), cellsY, SIGNATURE_CELL, cellsX, SIGNATURE_CELL, crops.shape[3])
+    sums = cells.sum(axis=(2, 4, 5), dtype=np.uint32)
+    return (sums // (SIGNATURE_CELL * SIGNATURE_CELL * crops.shape[3])).astype(np.uint8)
+
+
+class TileScreen(object):
+    def __init__(self, threshold, maxAge=DEFAULT_MAX_AGE):
+        """Pre-screen segments by change since they were last classified
+
+        Args:
+            threshold (float): min change of brightness (0-255) in any signature cell to classify segment
+            maxAge (int): classify segments at least once every maxAge seconds
+        """
+        self.threshold = threshold
+        self.maxAge = maxAge
+        self.entries = {}
+        self.lastStatsTime = time.time()
+        self.stats = {'images': 0, 'segments': 0, 'skipped': 0, 'expired': 0}
+
+
+    def _expire(self):
+        """Drop entries that have not been used recently and log the skip rate
+        """
+        timeNow = time.time()
+        if timeNow - self.lastStatsTime < STATS_INTERVAL:
+            return
+        self.lastStatsTime = timeNow
+        for key in list(self.entries.keys()):
+            if timeNow - self.entries[key]['lastUsed'] > IDLE_EXPIRE_SECONDS:
+                del self.entries[key]
+                self.stats['expired'] += 1
+        logging.warning('TileScreen stats %s, skip rate %.3f, entries %d', self.stats,
+                        self.getSkipRate(), len(self.entries))
+
+
+    def getSkipRate(self):
+        return self.stats['skipped'] / max(self.stats['segments'], 1)
+
+
+    def select(self, cameraID, heading, timestamp, crops, segments):
+        """Select the segments of an image that need to be classified
+
+        The scores of the other segments are set from their last classification.
+        Call update() with the returned pending state after classifying the
+        selected segments.  Several images of the same camera and heading can be
+        selected before updating (e.g. in one batch), as each has its own pending state.
+
+        Args:
+            cameraID (str): camera ID
+            heading (int): direction camera is facing
+            timestamp (int): time of image
+            crops (np.array): uint8 crops
+            segments (list): parallel list of metadata for each crop
+
+        Returns:
+            Tuple (indexes, pending) with np.array of indexes of segments to classify, and state for update()
+        """
+        self._expire()
+        key = (cameraID, heading)
+        signatures = getSignatures(crops)
+        coords = [tuple(segmentInfo['coords']) for segmentInfo in segments]
+        entry = self.entries.get(key)
+        if (not entry) or (entry['coords'] != coords):
+            # first image or segmentation changed (e.g., different image size)
+            entry = {
+                'coords': coords,
+                'signatures': signatures.copy(),
+                'scores': np.zeros(len(segments), dtype=np.float32),
+                'classifiedAt': np.full(len(segments), -1, dtype=np.int64),
+            }
+            self.entries[key] = entry
+            needed = np.ones(len(segments), dtype=bool)
+        else:
+            diffs = np.abs(signatures.astype(np.int16) - entry['signatures'])
+            changes = diffs.reshape(len(segments), -1).max(axis=1)
+            ages = np.abs(timestamp - entry['classifiedAt'])
+            needed = (changes >= self.threshold) | (ages >= self.maxAge)
+        entry['lastUsed'] = time.time()
+        indexes = np.flatnonzero(needed)
+        pending = {'entry': entry, 'indexes': indexes, 'signatures': signatures[indexes], 'timestamp': timestamp}
+        for i in np.flatnonzero(~needed):
+            segments[i]['score'] = float(entry['scores'][i])
+        self.stats['images'] += 1
+        self.stats['segments'] += len(segments)
+        self.stats['skipped'] += len(segments) - len(indexes)
+        return (indexes, pending)
+
+
+    def update(self, pending, segments):
+        """Save the signatures and scores of the segments classified after the select() call
+        that returned the given pending state
+
+        Args:
+            pending (dict): pending state returned by select()
+            segments (list): segments (in same order as passed to select) with scores
+        """
+        entry = pending['entry']
+        indexes = pending['indexes']
+        entry['signatures'][indexes] = pending['signatures']
+        entry['scores'][indexes] = [segments[i]['score'] for i in indexes]
+        entry['classifiedAt'][indexes] = pending['timestamp']
@@ -27,6 +27,7 @@ from firecam.lib import settings
 from firecam.lib import collect_args
 from firecam.lib import goog_helper
 from firecam.lib import img_archive
+from firecam.lib import image_frame
 
 from firecam.lib import rect_to_squares
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # quiet down tensorflow logging (must be done before tf_helper)
@@ -47,9 +48,11 @@ import random
 import math
 import re
 import json
-import hashlib
 import gc
 import socket
+import threading
+import queue
+import contextlib
 from urllib.request import urlretrieve
 import tensorflow as tf
 from PIL import Image, ImageFile, ImageDraw, ImageFont
@@ -59,6 +62,16 @@ from shapely.geometry import Polygon,Point
 
 
 POST_DETECTION_UPDATE_MINS = 7 # minutes after detection to keep searching for new image frames for updated videos
+googleServicesLock = threading.Lock()
+
+def lockGoogleServices(constants):
+    """Return context manager serializing calls using constants['googleServices'] from pipeline threads,
+       because google API client objects aren't thread safe.  No locking needed without google services
+    """
+    if constants['googleServices']:
+        return googleServicesLock
+    return contextlib.nullcontext()
+
 
 def getNextImage(dbManager, cameras, stateless, counterName):
     """Gets the next image to check for smoke
@@ -73,53 +86,55 @@ def getNextImage(dbManager, cameras, stateless, counterName):
         stateless (bool): [optional] if specified use stateless mechanism for camera selection
 
     Returns:
-        Tuple containing camera name, current heading, current timestamp, and filepath of the image
+        Tuple containing camera name, current heading, current timestamp, fov, and Frame of the image
     """
-    if getNextImage.tmpDir == None:
-        getNextImage.tmpDir = tempfile.TemporaryDirectory()
-        logging.warning('TempDir %s', getNextImage.tmpDir.name)
-
-    if getNextImage.queueCamera and (len(getNextImage.queue) > 0):
-        camera = getNextImage.queueCamera
-    elif stateless:
-        camera = cameras[int(len(cameras)*random.random())]
-    else:
-        counterValue = dbManager.incrementCounter(counterName)
-        index = counterValue % len(cameras)
-        camera = cameras[index]
+    # lock protects the shared state below when called from multiple prefetch threads
+    # (the fetch itself is done without the lock so multiple fetches can overlap)
+    fetchResult = None
+    with getNextImage.lock:
+        if getNextImage.tmpDir == None:
+            getNextImage.tmpDir = tempfile.TemporaryDirectory()
+            logging.warning('TempDir %s', getNextImage.tmpDir.name)
 
-    try:
         if len(getNextImage.queue) > 0:
-            fetchResult = getNextImage.queue[0]
+            (camera, fetchResult) = getNextImage.queue[0]
             getNextImage.queue = getNextImage.queue[1:]
-            if len(getNextImage.queue) == 0:
-                getNextImage.queueCamera = None
+        elif stateless:
+            camera = cameras[int(len(cameras)*random.random())]
         else:
+            counterValue = dbManager.incrementCounter(counterName)
+            index = counterValue % len(cameras)
+            camera = cameras[index]
+
+    try:
+        if not fetchResult:
             fetchResult = img_archive.fetchImageAndMeta(dbManager, camera['name'], camera['url'], getNextImage.tmpDir.name)
         if isinstance(fetchResult, list):
             if len(fetchResult) > 1:
-                getNextImage.queue = fetchResult[1:]
-                getNextImage.queueCamera = camera
+                with getNextImage.lock:
+                    getNextImage.queue += [(camera, result) for result in fetchResult[1:]]
             fetchResult = fetchResult[0]
         (imgPath, heading, timestamp, fov) = fetchResult
         if imgPath == None or heading == None or timestamp == None:
             logging.error('Image or metadata unavailable for %s', camera['name'])
             return (None, None, None, None, None)
 
-        md5 = hashlib.md5(open(imgPath, 'rb').read()).hexdigest()
-        if ('md5' in camera) and (camera['md5'] == md5):
-            logging.warning('Camera %s image unchanged', camera['name'])
-            # skip to next camera
-            return (None, None, None, None, None)
-        camera['md5'] = md5
+        imgFrame = image_frame.Frame(imgPath)
+        md5 = imgFrame.getMd5()
+        with getNextImage.lock:
+            if ('md5' in camera) and (camera['md5'] == md5):
+                logging.warning('Camera %s image unchanged', camera['name'])
+                # skip to next camera
+                return (None, None, None, None, None)
+            camera['md5'] = md5
     except Exception as e:
         logging.error('Error fetching image from %s %s', camera['name'], str(e))
         return (None, None, None, None, None)
 
-    return (camera['name'], heading, timestamp, fov, imgPath)
+    return (camera['name'], heading, timestamp, fov, imgFrame)
 getNextImage.tmpDir = None
-getNextImage.queue = []
-getNextImage.queueCamera = None
+getNextImage.queue = [] # list of (camera, fetchResult) already fetched but not yet returned
+getNextImage.lock = threading.Lock()
 
 
 # XXXXX Use a fixed stable directory for testing
@@ -227,14 +242,14 @@ def firePixelCoords(img, fireSegment):
     return (x0, y0, x1, y1)
 
 
-def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, img, imgPath, fireSegment, saveFullImages=True):
+def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgFrame, fireSegment, saveFullImages=True):
     """Generate cropped movie by fetching old images from archive
 
     Args:
         constants (dict): "global" contants
         cameraID (str): camera name
         timestamp (int): time.time() value when image was taken
-        imgPath (str): filepath of the image
+        imgFrame (Frame): the image
         fireSegment (dict): dict describing segment with fire
         cropCoords (list): coordinates for cropping full image
         fileBoxCoords (list): coordinates for highlighting fire box withing cropped region
@@ -247,6 +262,8 @@ def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp
     if not cameraInfo or 'network' not in cameraInfo or not cameraInfo['network']:
         return ('', imgIDs, finalTimestamp, len(postImages))
 
+    imgPath = imgFrame.path
+    img = imgFrame.getImage()
     (x0, y0, x1, y1) = firePixelCoords(img, fireSegment)
     (cropX0, cropX1) = rect_to_squares.getRangeFromCenter(round((x0 + x1)/2), 640, 0, img.size[0])
     # 412 pixels because that is minimum pixel height in landscape mode for most mobile phones
@@ -261,8 +278,9 @@ def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp
     finalTimestamp = timestamp
 
     with tempfile.TemporaryDirectory() as tmpDirName:
-        imgSequence = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], tmpDirName,
-                                                    constants['camArchives'], cameraID, cameraHeading, startTimeDT, endTimeDT, 1)
+        with lockGoogleServices(constants):
+            imgSequence = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], tmpDirName,
+                                                        constants['camArchives'], cameraID, cameraHeading, startTimeDT, endTimeDT, 1)
         imgSequence = imgSequence or []
         preImages = []
         detectImage = None
@@ -289,14 +307,14 @@ def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp
         for (i, imgFile) in enumerate(imgSequence):
             imgParsed = img_archive.parseFilename(imgFile)
             if imgParsed['unixTime'] != timestamp:
-                algined = img_archive.alignImage(imgFile, imgPath)
+                algined = img_archive.alignImage(imgFile, imgFrame)
                 if not algined:
                     continue # skip this image
             if saveFullImages:
                 imgIDs.append(goog_helper.copyFile(imgFile, notificationsDateDir))
             cropName = 'img' + ("%03d" % i) + filePathParts[1]
             croppedPath = os.path.join(tmpDirName, cropName)
-            imgSeq = Image.open(imgFile)
+            imgSeq = imgFrame.getImage() if imgFile == imgPath else Image.open(imgFile)
             croppedImg = imgSeq.crop(cropCoords)
             if imgParsed['unixTime'] < timestamp:
                 color = 'yellow'
@@ -305,7 +323,8 @@ def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp
                 color = 'red'
                 message = 'Potential fire'
             drawFireBox(croppedImg, croppedPath, fireBoxCoords, timestamp=imgParsed['unixTime'], color=color, message=message, cameraProvider=cameraInfo['network'])
-            imgSeq.close()
+            if imgFile != imgPath:
+                imgSeq.close()
             croppedImg.close()
             mspecFile.write("file '" + croppedPath + "'\n")
             mspecFile.write('duration 1\n')
@@ -333,26 +352,26 @@ def genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp
         return (movieID, imgIDs, finalTimestamp, len(postImages))
 
 
-def genAnnotatedImages(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgPath, fireSegment):
+def genAnnotatedImages(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgFrame, fireSegment):
     """Generate annotated images (one cropped video, and other full size image)
 
     Args:
         constants (dict): "global" contants
         cameraID (str): camera name
         timestamp (int): time.time() value when image was taken
-        imgPath (str): filepath of the image
+        imgFrame (Frame): the image
         fireSegment (dict): dict describing segment with fire
 
     Returns:
         Tuple (str, str): filepaths of cropped and full size annotated iamges
     """
-    img = Image.open(imgPath)
-    (movieID, imgIDs, finalTimestamp, x) = genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, img, imgPath, fireSegment)
+    (movieID, imgIDs, finalTimestamp, x) = genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgFrame, fireSegment)
     if not movieID:
         return (movieID, imgIDs, '', finalTimestamp)
 
+    img = imgFrame.getImage().copy() # copy to avoid drawing on the shared image
     (x0, y0, x1, y1) = firePixelCoords(img, fireSegment)
-    filePathParts = os.path.splitext(imgPath)
+    filePathParts = os.path.splitext(imgFrame.path)
     annotatedPath = filePathParts[0] + '_Ann' + filePathParts[1]
     drawFireBox(img, annotatedPath, (x0, y0, x1, y1))
     img.close()
@@ -619,6 +638,7 @@ def isDuplicateProbables(dbManager, cameraID, heading, timestamp, protoNum):
     where CameraName='%s' and Heading=%s and timestamp > %s and timestamp < %s and ProtoNum=%s"""
     sqlStr = sqlTemplate % (cameraID, heading, timestamp - 60*60, timestamp, protoNum)
 
+    dbManager.flushWrites() # make sure all earlier writes from this process are visible
     dbResult = dbManager.query(sqlStr)
     if len(dbResult) > 0:
         logging.warning('Supressing due to recent probables')
@@ -940,11 +960,12 @@ def emailFireNotification(constants, cameraID, timestamp, imgPath, annotatedUrl,
         startTimeDT = datetime.datetime.fromtimestamp(timestamp - 3*60)
         endTimeDT = datetime.datetime.fromtimestamp(timestamp - 1*60)
         with tempfile.TemporaryDirectory() as tmpDirName:
-            oldImages = img_archive.getHpwrenImages(constants['googleServices'], settings, tmpDirName,
-                                                    constants['camArchives'], cameraID, startTimeDT, endTimeDT, 1)
-            attachments = oldImages or []
-            attachments.append(imgPath)
-            email_helper.sendEmail(constants['googleServices']['mail'], settings.fuegoEmail, emails, subject, body, attachments)
+            with lockGoogleServices(constants):
+                oldImages = img_archive.getHpwrenImages(constants['googleServices'], settings, tmpDirName,
+                                                        constants['camArchives'], cameraID, startTimeDT, endTimeDT, 1)
+                attachments = oldImages or []
+                attachments.append(imgPath)
+                email_helper.sendEmail(constants['googleServices']['mail'], settings.fuegoEmail, emails, subject, body, attachments)
 
 
 def smsFireNotification(dbManager, cameraID):
@@ -978,7 +999,7 @@ def publishAlert(dbManager, cameraID, fireHeading, rangeAngle, timestamp, weathe
     return True
 
 
-def fireDetected(constants, cameraID, cameraHeading, timestamp, fov, imgPath, fireSegment):
+def fireDetected(constants, cameraID, cameraHeading, timestamp, fov, imgFrame, fireSegment):
     """Update Detections DB and send alerts about given fire through all channels (pubsub, email, and sms)
 
     Args:
@@ -986,7 +1007,7 @@ def fireDetected(constants, cameraID, cameraHeading, timestamp, fov, imgPath, fi
         cameraID (str): camera name
         cameraHeading (int): direction camera is facing
         timestamp (int): time.time() value when image was taken
-        imgPath: filepath of the original image
+        imgFrame (Frame): the original image
         fireSegment (dictionary): dictionary with information for the segment with fire/smoke
     """
     dbManager = constants['dbManager']
@@ -997,10 +1018,9 @@ def fireDetected(constants, cameraID, cameraHeading, timestamp, fov, imgPath, fi
     notificationsDateDir = goog_helper.dateSubDir(settings.noticationsDir)
     (mapFiles, camLatitude, camLongitude) = dbManager.getCameraMapLocation(cameraID)
 
+    imgPath = imgFrame.path
     # get horizontal pixel width
-    img = Image.open(imgPath)
-    imgSizeX = img.size[0]
-    img.close()
+    imgSizeX = imgFrame.getSize()[0]
 
     # find angular heading, and check if it should be ignored due to frequent false positives
     (fireHeading, rangeAngle) = img_archive.getHeadingRange(cameraHeading, fov, fireSegment['MinX'], fireSegment['MaxX'], imgSizeX)
@@ -1033,7 +1053,7 @@ def fireDetected(constants, cameraID, cameraHeading, timestamp, fov, imgPath, fi
     rxBurns = rx_burns.getCurrentBurns(dbManager)
     mapUrl = genAnnotatedMaps(notificationsDateDir, mapFiles, camLatitude, camLongitude, imgPath, polygon, sourcePolygons, rxBurns)
 
-    (croppedID, imgIDs, annotatedID, finalTimestamp) = genAnnotatedImages(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgPath, fireSegment)
+    (croppedID, imgIDs, annotatedID, finalTimestamp) = genAnnotatedImages(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgFrame, fireSegment)
     if not croppedID:
         return
 
@@ -1050,31 +1070,35 @@ def fireDetected(constants, cameraID, cameraHeading, timestamp, fov, imgPath, fi
         smsFireNotification(dbManager, cameraID)
 
 
+fireUpdateLock = threading.Lock()
+
 def enqueueFireUpdate(constants, cameraID, cameraHeading, timestamp, finalTimestamp, fireSegment):
     fireUpdateQueue = constants['fireUpdateQueue']
-    # assert not already in queue already
-    filtered = list(filter(lambda x: (x['cameraID'] == cameraID) and (x['timestamp'] == timestamp), fireUpdateQueue))
-    assert len(filtered) == 0
     if time.time() > timestamp + POST_DETECTION_UPDATE_MINS*60: # discard if already POST_DETECTION_UPDATE_MINS minutes post detection time
         logging.warning('enqueueFireUpdate timed out %s', cameraID)
         return
-    fireUpdateQueue.append({
-        'cameraID': cameraID,
-        'cameraHeading': cameraHeading,
-        'timestamp': timestamp,
-        'finalTimestamp': finalTimestamp,
-        'fireSegment': fireSegment,
-    })
-    # resort by finalTimestamp after append
-    constants['fireUpdateQueue'] = sorted(fireUpdateQueue, key=lambda x: x['finalTimestamp'])
+    with fireUpdateLock: # queue is shared by post processing threads
+        # assert not already in queue already
+        filtered = list(filter(lambda x: (x['cameraID'] == cameraID) and (x['timestamp'] == timestamp), fireUpdateQueue))
+        assert len(filtered) == 0
+        fireUpdateQueue.append({
+            'cameraID': cameraID,
+            'cameraHeading': cameraHeading,
+            'timestamp': timestamp,
+            'finalTimestamp': finalTimestamp,
+            'fireSegment': fireSegment,
+        })
+        # resort by finalTimestamp after append (in place, so all users of the queue see it)
+        fireUpdateQueue.sort(key=lambda x: x['finalTimestamp'])
     logging.warning('enqueueFireUpdate %s', cameraID)
 
 
 def popFireUpdate(fireUpdateQueue):
-    if len(fireUpdateQueue) > 0:
-        if time.time() > fireUpdateQueue[0]['finalTimestamp'] + 60: # one minute after final
-            fireEvent = fireUpdateQueue.pop(0)
-            return (fireEvent['cameraID'], fireEvent['cameraHeading'], fireEvent['timestamp'], fireEvent['finalTimestamp'], fireEvent['fireSegment'])
+    with fireUpdateLock:
+        if len(fireUpdateQueue) > 0:
+            if time.time() > fireUpdateQueue[0]['finalTimestamp'] + 60: # one minute after final
+                fireEvent = fireUpdateQueue.pop(0)
+                return (fireEvent['cameraID'], fireEvent['cameraHeading'], fireEvent['timestamp'], fireEvent['finalTimestamp'], fireEvent['fireSegment'])
     return None
 
 
@@ -1085,8 +1109,9 @@ def checkNewImage(constants, cameraID, cameraHeading, timestamp, finalTimestamp)
     endTimeDT = datetime.datetime.fromtimestamp(timestamp + POST_DETECTION_UPDATE_MINS*60)
     newImages = False
     with tempfile.TemporaryDirectory() as tmpDirName:
-        images = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], tmpDirName,
-                                                 constants['camArchives'], cameraID, cameraHeading, startTimeDT, endTimeDT, 1)
+        with lockGoogleServices(constants):
+            images = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], tmpDirName,
+                                                     constants['camArchives'], cameraID, cameraHeading, startTimeDT, endTimeDT, 1)
         if len(images) == 0:
             return False
         lastImage = images[-1]
@@ -1102,16 +1127,15 @@ def updateMovie(constants, cameraID, cameraHeading, timestamp, fireSegment):
     timeDT = datetime.datetime.fromtimestamp(timestamp)
     isFinalMovie = False
     with tempfile.TemporaryDirectory() as tmpDirName:
-        imgPath = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], tmpDirName,
-                                                constants['camArchives'], cameraID, cameraHeading, timeDT, timeDT, 1)
+        with lockGoogleServices(constants):
+            imgPath = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], tmpDirName,
+                                                    constants['camArchives'], cameraID, cameraHeading, timeDT, timeDT, 1)
         if not imgPath:
             return (None, None)
-        imgPath = imgPath[-1]
-        img = Image.open(imgPath)
+        imgFrame = image_frame.Frame(imgPath[-1])
         notificationsDateDir = goog_helper.dateSubDir(settings.noticationsDir)
-        (movieID, imgIDs, finalTimestamp, postCount) = genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, img, imgPath, fireSegment, saveFullImages=False)
+        (movieID, imgIDs, finalTimestamp, postCount) = genMovie(notificationsDateDir, constants, cameraID, cameraHeading, timestamp, imgFrame, fireSegment, saveFullImages=False)
         isFinalMovie = postCount > 2
-        img.close()
     return (movieID, finalTimestamp, isFinalMovie)
 
 
@@ -1223,18 +1247,20 @@ def getArchivedImages(constants, cameras, startTimeDT, timeRangeSeconds):
     Returns:
         Tuple containing camera name, current timestamp, filepath of regular image, and filepath of difference image
     """
-    if getArchivedImages.tmpDir == None:
-        getArchivedImages.tmpDir = tempfile.TemporaryDirectory()
-        logging.warning('TempDir %s', getArchivedImages.tmpDir.name)
-
-    # setup caching of the archive files locally
-    if (getArchivedImages.cache == None) and settings.downloadDir:
-        writable = os.access(settings.downloadDir, os.W_OK|os.X_OK)
-        writeDirPath = settings.downloadDir
-        if not writable:
-            getArchivedImages.writeDir = tempfile.TemporaryDirectory()
-            writeDirPath = getArchivedImages.writeDir.name
-        getArchivedImages.cache = img_archive.cacheDir(settings.downloadDir, writeDirPath)
+    # lock so prefetch threads calling this concurrently set up the directories only once
+    with getArchivedImages.lock:
+        if getArchivedImages.tmpDir == None:
+            getArchivedImages.tmpDir = tempfile.TemporaryDirectory()
+            logging.warning('TempDir %s', getArchivedImages.tmpDir.name)
+
+        # setup caching of the archive files locally
+        if (getArchivedImages.cache == None) and settings.downloadDir:
+            writable = os.access(settings.downloadDir, os.W_OK|os.X_OK)
+            writeDirPath = settings.downloadDir
+            if not writable:
+                getArchivedImages.writeDir = tempfile.TemporaryDirectory()
+                writeDirPath = getArchivedImages.writeDir.name
+            getArchivedImages.cache = img_archive.cacheDir(settings.downloadDir, writeDirPath)
 
     if getArchivedImages.cache:
         downloadDirOrCache = getArchivedImages.cache
@@ -1248,8 +1274,9 @@ def getArchivedImages(constants, cameras, startTimeDT, timeRangeSeconds):
         timeDT += datetime.timedelta(hours=8)
     elif timeDT.hour >= 20:
         timeDT -= datetime.timedelta(hours=4)
-    files = img_archive.getHpwrenImages(constants['googleServices'], settings, downloadDirOrCache,
-                                        constants['camArchives'], cameraID, timeDT, timeDT, 1)
+    with lockGoogleServices(constants):
+        files = img_archive.getHpwrenImages(constants['googleServices'], settings, downloadDirOrCache,
+                                            constants['camArchives'], cameraID, timeDT, timeDT, 1)
     # logging.warning('files %s', str(files))
     if not files:
         return (None, None, None, None)
@@ -1270,15 +1297,17 @@ def getArchivedImages(constants, cameras, startTimeDT, timeRangeSeconds):
     return (None, None, None, None)
 getArchivedImages.tmpDir = None
 getArchivedImages.cache = None
+getArchivedImages.lock = threading.Lock()
 
 
-def fetchPriorAligned(constants, cameraID, heading, timestamp, baseImgPath, outputDirName):
+def fetchPriorAligned(constants, cameraID, heading, timestamp, baseFrame, outputDirName):
     imgDT = datetime.datetime.fromtimestamp(timestamp)
     # target 1 minute (60 seconds) prior by setting range from 1.5 to 0.5 minutes prior
     startDT = imgDT - datetime.timedelta(seconds = 90)
     endDT = imgDT - datetime.timedelta(seconds = 31)
-    oldImages = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], outputDirName,
-                    constants['camArchives'], cameraID, heading, startDT, endDT, 1)
+    with lockGoogleServices(constants):
+        oldImages = img_archive.getArchiveImages(constants['googleServices'], settings, constants['dbManager'], outputDirName,
+                        constants['camArchives'], cameraID, heading, startDT, endDT, 1)
     if not oldImages:
         return None
     priorImg = None
@@ -1290,26 +1319,343 @@ def fetchPriorAligned(constants, cameraID, heading, timestamp, baseImgPath, outp
             if imgParsed['unixTime'] == timestamp:  # skip current image if somehow that sneaks in
                 continue
             if img_archive.isPTZ(cameraID): # PTZ iamges require alignment
-                img = img_archive.alignImageObj(filePath, baseImgPath)
+                img = img_archive.alignImageObj(filePath, baseFrame)
                 if img:
                     priorImg = img
                     break
             else:
-                priorImg = Image.open(oldImages[0])
+                priorImg = image_frame.Frame(oldImages[0])
                 break
-    if priorImg:
-        priorImg.load() # force load to allow remove below to succeed on Windows
+    # force load to allow remove below to succeed on Windows
+    if isinstance(priorImg, image_frame.Frame):
+        priorImg.getBytes()
+    elif priorImg:
+        priorImg.load()
     for filePath in oldImages:
         os.remove(filePath)
     return priorImg
 
 
-def fetchDiffImage(constants, cameraID, heading, timestamp, baseImgPath, outputDirName):
-    priorImg = fetchPriorAligned(constants, cameraID, heading, timestamp, baseImgPath, outputDirName)
+def fetchDiffImage(constants, cameraID, heading, timestamp, baseFrame, outputDirName):
+    priorImg = fetchPriorAligned(constants, cameraID, heading, timestamp, baseFrame, outputDirName)
     if not priorImg:
         return None
-    imgOrig = Image.open(baseImgPath)
-    return img_archive.diffWithChecks(imgOrig, priorImg)
+    return img_archive.diffWithChecks(baseFrame, priorImg)
+
+
+def fetchFrame(constants, stateless, counterName, useArchivedImages, startTimeDT, timeRangeSeconds):
+    """Fetch the next image to check for smoke, either from the live cameras or from the archives
+
+    Args:
+        constants (dict): "global" contants
+        stateless (bool): if specified use stateless mechanism for camera selection
+        counterName (str): Name of row in counters table
+        useArchivedImages (bool): if true, get random images from HPWREN archive within given time range
+
+    Returns:
+        Tuple (cameraID, heading, timestamp, fov, imgFrame, classifyFrame) or None
+    """
+    cameras = constants['cameras']
+    if useArchivedImages:
+        (cameraID, timestamp, imgPath, classifyImgPath) = \
+            getArchivedImages(constants, cameras, startTimeDT, timeRangeSeconds)
+        if not cameraID:
+            return None
+        heading = img_archive.getHeading(cameraID)
+        fov = img_archive.getApproxCameraFov(cameraID)
+        imgFrame = image_frame.Frame(imgPath)
+        classifyFrame = imgFrame if classifyImgPath == imgPath else image_frame.Frame(classifyImgPath)
+    else: # regular (non diff mode), grab image and process
+        (cameraID, heading, timestamp, fov, imgFrame) = getNextImage(constants['dbManager'], cameras, stateless, counterName)
+        classifyFrame = imgFrame
+        if not cameraID:
+            return None
+    return (cameraID, heading, timestamp, fov, imgFrame, classifyFrame)
+
+
+def getImageSpec(frame, usableRegions):
+    """Generate the image_spec for detection policies for the given image
+
+    Args:
+        frame (tuple): result of fetchFrame()
+        usableRegions (dict): usable regions of cameras from DB
+
+    Returns:
+        image_spec list
+    """
+    (cameraID, heading, timestamp, fov, imgFrame, classifyFrame) = frame
+    image_spec = [{}]
+    image_spec[-1]['path'] = classifyFrame.path
+    image_spec[-1]['frame'] = classifyFrame
+    image_spec[-1]['timestamp'] = timestamp
+    image_spec[-1]['cameraID'] = cameraID
+    image_spec[-1]['heading'] = heading
+    if cameraID in usableRegions:
+        usableEntry = usableRegions[cameraID]
+        if 'startY' in usableEntry:
+            image_spec[-1]['startY'] = usableEntry['startY']
+        if 'endY' in usableEntry:
+            image_spec[-1]['endY'] = usableEntry['endY']
+    # ignore top and bottom 50 (cloud, metadata, too nearby)
+    if ('startY' not in image_spec[-1]) or not image_spec[-1]['startY']:
+        image_spec[-1]['startY'] = 50
+    if ('endY' not in image_spec[-1]) or not image_spec[-1]['endY']:
+        image_spec[-1]['endY'] = -50
+    return image_spec
+
+
+def getFetchDiffFn(constants, frame):
+    """Return the fetchDiff function for detection policies for the given image
+    """
+    (cameraID, heading, timestamp, fov, imgFrame, classifyFrame) = frame
+    return lambda x: fetchDiffImage(constants, cameraID, heading, timestamp, classifyFrame, x)
+
+
+def detectBatch(detectionPolicy, image_specs, fetchDiffs):
+    """Run the detection policy on all the given images.  Policies that support
+       detect_batch classify the segments of all images together in one call
+
+    Args:
+        detectionPolicy: detection policy object
+        image_specs (list): list of image_spec values, one per image
+        fetchDiffs (list): list of fetchDiff functions parallel to image_specs
+
+    Returns:
+        List of detection results parallel to image_specs
+    """
+    if (len(image_specs) > 1) and hasattr(detectionPolicy, 'detect_batch'):
+        return detectionPolicy.detect_batch(image_specs, checkShifts=True, fetchDiffs=fetchDiffs)
+    return [detectionPolicy.detect(image_spec, checkShifts=True, fetchDiff=fetchDiff)
+                for (image_spec, fetchDiff) in zip(image_specs, fetchDiffs)]
+
+
+def postProcessFrame(constants, frame, detectionResult, modelId, stateless, useArchivedImages):
+    """Record the detection result for given image, alert on new fires, and cleanup image files
+
+    Args:
+        constants (dict): "global" contants
+        frame (tuple): result of fetchFrame()
+        detectionResult (dict): result of detection policy for the frame
+        modelId (str): ID of the detection model
+        stateless (bool): if true, don't update state
+        useArchivedImages (bool): if true, images are from archive (no alerts)
+
+    Returns:
+        Tuple (isProbable, isAlert)
+    """
+    (cameraID, heading, timestamp, fov, imgFrame, classifyFrame) = frame
+    dbManager = constants['dbManager']
+    protoNum = constants['protoNum']
+    fireSegment = detectionResult['fireSegment']
+    isAlert = False
+    if fireSegment and not useArchivedImages:
+        recordProbables(dbManager, cameraID, heading, timestamp, imgFrame.path, fireSegment, modelId, stateless, protoNum)
+        if not (isDuplicateProbables(dbManager, cameraID, heading, timestamp, protoNum) or stateless):
+            fireDetected(constants, cameraID, heading, timestamp, fov, imgFrame, fireSegment)
+            isAlert = True
+    if not stateless and not protoNum:
+        img_archive.markImageProcessed(dbManager, cameraID, heading, timestamp)
+    deleteImageFiles(classifyFrame.path, imgFrame.path)
+    return (fireSegment != None, isAlert)
+
+
+def initializeStageStats(stageNames):
+    """Initialize the per stage timing metrics for pipelined processing
+
+    Returns:
+        stageStats (dict): for each stage the number of items, busy time, and time waiting for input
+    """
+    stageStats = {'lock': threading.Lock()}
+    for name in stageNames:
+        stageStats[name] = {'count': 0, 'busy': 0.0, 'wait': 0.0}
+    return stageStats
+
+
+def updateStageStats(stageStats, name, count, busyTime, waitTime):
+    with stageStats['lock']:
+        stageStats[name]['count'] += count
+        stageStats[name]['busy'] += busyTime
+        stageStats[name]['wait'] += waitTime
+
+
+def logStageStats(stageStats, queues):
+    """Log the average time per image (busy and waiting for input) for each stage and reset the metrics
+    """
+    with stageStats['lock']:
+        stageStrs = []
+        for name in [name for name in stageStats if name != 'lock']:
+            stats = stageStats[name]
+            count = max(stats['count'], 1)
+            stageStrs.append('%s=%.2f (wait %.2f)' % (name, stats['busy']/count, stats['wait']/count))
+            stageStats[name] = {'count': 0, 'busy': 0.0, 'wait': 0.0}
+    queueStrs = ['%s=%d' % (name, q.qsize()) for (name, q) in queues]
+    logging.warning('Pipeline secs/image: %s. Queues: %s', ', '.join(stageStrs), ', '.join(queueStrs))
+
+
+def putUntilStopped(outQueue, item, stopEvent):
+    """Put given item on bounded queue, waiting for space unless stopEvent is set
+
+    Returns:
+        True if item was put on the queue
+    """
+    while not stopEvent.is_set():
+        try:
+            outQueue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def discardFrame(frame):
+    """Release the decoded data and delete the image files of a fetched frame that won't be processed
+
+    Args:
+        frame (tuple): result of fetchFrame()
+    """
+    (cameraID, heading, timestamp, fov, imgFrame, classifyFrame) = frame
+    imgFrame.release()
+    classifyFrame.release()
+    try:
+        deleteImageFiles(classifyFrame.path, imgFrame.path)
+    except FileNotFoundError:
+        pass
+
+
+def runPipeline(constants, detectionPolicy, usableRegions, stateless, counterName, useArchivedImages,
+                startTimeDT, timeRangeSeconds, batchSize, limitImages, processingTimeTracker):
+    """Pipelined version of the main detection loop
+
+    Prefetch threads fetch and decode images, the calling thread runs the detection
+    policy on batches of images back to back, and post processing threads record
+    the results in DB and handle probables and alerts.  Stages are connected by
+    bounded queues.  Worker threads share the pooled dbManager, so their writes
+    go through its write behind queue.
+    An exception in any worker stops the pipeline and is re-raised.
+
+    Args:
+        constants (dict): "global" contants
+        detectionPolicy: detection policy object
+        usableRegions (dict): usable regions of cameras from DB
+        stateless (bool): if true, don't update state
+        counterName (str): Name of row in counters table
+        useArchivedImages (bool): if true, get random images from HPWREN archive within given time range
+        batchSize (int): max number of images classified together
+        limitImages (int): stop after processing given number of images
+        processingTimeTracker (dict): time tracker updated with time per image
+    """
+    args = constants['args']
+    numFetchThreads = args.fetchThreads
+    numPostThreads = args.postThreads or 2
+    fetchQueue = queue.Queue(maxsize=max(2*batchSize, numFetchThreads))
+    postQueue = queue.Queue(maxsize=2*batchSize)
+    stopEvent = threading.Event()
+    errors = []
+    stageStats = initializeStageStats(['fetch', 'detect', 'post'])
+    counts = {'images': 0, 'probables': 0, 'alerts': 0}
+
+    def runWorker(workerFn):
+        try:
+            workerFn(constants)
+        except Exception as e:
+            logging.error('Pipeline worker failed %s', str(e))
+            errors.append(e)
+            stopEvent.set()
+
+    def fetchLoop(workerConstants):
+        while not stopEvent.is_set():
+            timeStart = time.time()
+            frame = fetchFrame(workerConstants, stateless, counterName, useArchivedImages, startTimeDT, timeRangeSeconds)
+            if not frame:
+                continue # skip to next camera
+            image_spec = getImageSpec(frame, usableRegions)
+            # decode image here so detection stage doesn't wait on JPEG decoding
+            image_spec[-1]['frame'].getArray()
+            updateStageStats(stageStats, 'fetch', 1, time.time() - timeStart, 0)
+            if not putUntilStopped(fetchQueue, (frame, image_spec), stopEvent):
+                discardFrame(frame)
+
+    def postLoop(workerConstants):
+        timeStart = time.time()
+        while True:
+            try:
+                item = postQueue.get(timeout=1)
+            except queue.Empty:
+                if stopEvent.is_set(): # all detected images have been processed
+                    return
+                continue
+            timeGot = time.time()
+            (frame, detectionResult) = item
+            (isProbable, isAlert) = postProcessFrame(workerConstants, frame, detectionResult, detectionPolicy.modelId,
+                                                     stateless, useArchivedImages)
+            processEnqueuedUpdates(workerConstants)
+            updateStageStats(stageStats, 'post', 1, time.time() - timeGot, timeGot - timeStart)
+            with stageStats['lock']:
+                counts['images'] += 1
+                counts['probables'] += int(isProbable)
+                counts['alerts'] += int(isAlert)
+                if (counts['images'] % 10) == 0:
+                    logging.warning('Stats: alerts=%d, detects=%d, images=%d', counts['alerts'], counts['probables'], counts['images'])
+            timeStart = time.time()
+
+    fetchThreads = [threading.Thread(target=runWorker, args=(fetchLoop,), daemon=True) for i in range(numFetchThreads)]
+    postThreads = [threading.Thread(target=runWorker, args=(postLoop,), daemon=True) for i in range(numPostThreads)]
+    for thread in fetchThreads + postThreads:
+        thread.start()
+    logging.warning('Pipeline started with %d fetch threads, %d post threads', numFetchThreads, numPostThreads)
+
+    numImages = 0
+    while (not stopEvent.is_set()) and (numImages < limitImages):
+        # wait for at least one image, then take whatever else is ready up to batchSize
+        timeStart = time.time()
+        try:
+            items = [fetchQueue.get(timeout=1)]
+        except queue.Empty:
+            continue
+        while len(items) < batchSize:
+            try:
+                items.append(fetchQueue.get_nowait())
+            except queue.Empty:
+                break
+        timeGot = time.time()
+        frames = [frame for (frame, image_spec) in items]
+        image_specs = [image_spec for (frame, image_spec) in items]
+        fetchDiffs = [getFetchDiffFn(constants, frame) for frame in frames]
+        detectionResults = detectBatch(detectionPolicy, image_specs, fetchDiffs)
+        timeDetect = time.time()
+        for (frame, image_spec, detectionResult) in zip(frames, image_specs, detectionResults):
+            if not detectionResult['fireSegment']:
+                image_spec[-1]['frame'].release() # decoded data only needed for alerts
+            if not putUntilStopped(postQueue, (frame, detectionResult), stopEvent):
+                discardFrame(frame)
+        numImages += len(frames)
+        updateStageStats(stageStats, 'detect', len(frames), timeDetect - timeGot, timeGot - timeStart)
+        updateTimeTracker(processingTimeTracker, (time.time() - timeStart) / len(frames))
+        if (args.heartbeat):
+            heartBeat(args.heartbeat)
+        if args.time or (numImages % 50) < len(frames):
+            logStageStats(stageStats, [('fetch', fetchQueue), ('post', postQueue)])
+        # free all memory for current iteration and trigger GC to prevent memory growth
+        detectionResults = None
+        items = None
+        gc.collect()
+
+    # stop fetching and let post processing finish the images already detected
+    stopEvent.set()
+    for thread in fetchThreads + postThreads:
+        thread.join()
+    # cleanup images left in the queues (e.g. fetched ahead, or not post processed after a worker failed)
+    for (stageQueue, stageName) in [(fetchQueue, 'fetch'), (postQueue, 'post')]:
+        numLeft = 0
+        while not stageQueue.empty():
+            discardFrame(stageQueue.get_nowait()[0])
+            numLeft += 1
+        if numLeft:
+            logging.warning('Discarded %d images left in %s queue', numLeft, stageName)
+    if errors:
+        raise errors[0]
+    if numImages >= limitImages:
+        logging.warning('Reached limit on images')
 
 
 def getGroupConfig(detectGroup):
@@ -1355,15 +1701,25 @@ def main():
         ["o", "randomOffset", "(optional) random offset - skip given number of random images", int],
         ["l", "limitImages", "(optional) stop after processing given number of images", int],
         ["g", "detectGroup", "(optional) detectGroup to use vs. checking GCP instance group"],
+        ["k", "batchSize", "(optional) number of images to classify together in one batch", int],
+        ["f", "fetchThreads", "(optional) number of image prefetch threads (enables pipelined processing)", int],
+        ["w", "postThreads", "(optional) number of post processing threads for pipelined processing (default 2)", int],
     ]
     args = collect_args.collectArgs([], optionalArgs=optArgs, parentParsers=[goog_helper.getParentParser()])
     limitImages = args.limitImages if args.limitImages else 1e9
     # TODO: Fix googleServices auth to resurrect email alerts
     # googleServices = goog_helper.getGoogleServices(settings, args)
     googleServices = None
+    poolSize = None
+    if args.fetchThreads:
+        # connections shared by the pipeline threads and the main thread
+        poolSize = getattr(settings, 'dbPoolSize', None) or (args.fetchThreads + (args.postThreads or 2) + 1)
     dbManager = db_manager.DbManager(sqliteFile=settings.db_file,
                                     psqlHost=settings.psqlHost, psqlDb=settings.psqlDb,
-                                    psqlUser=settings.psqlUser, psqlPasswd=settings.psqlPasswd)
+                                    psqlUser=settings.psqlUser, psqlPasswd=settings.psqlPasswd,
+                                    poolSize=poolSize)
+    # scores and processed flags are written behind on a background thread
+    dbManager.startWriteBehind()
     groupConfig = getGroupConfig(args.detectGroup)
     if args.restrictType:
         restrictType = args.restrictType
@@ -1441,73 +1797,52 @@ def main():
     numImages = 0
     numProbables = 0
     numAlerts = 0
+    batchSize = args.batchSize if args.batchSize else 1
     processingTimeTracker = initializeTimeTracker()
+    if args.fetchThreads:
+        runPipeline(constants, detectionPolicy, usableRegions, stateless, counterName, useArchivedImages,
+                    startTimeDT, timeRangeSeconds, batchSize, limitImages, processingTimeTracker)
+        return
     while True:
         processEnqueuedUpdates(constants)
-        classifyImgPath = None
         timeStart = time.time()
-        if useArchivedImages:
-            (cameraID, timestamp, imgPath, classifyImgPath) = \
-                getArchivedImages(constants, cameras, startTimeDT, timeRangeSeconds)
-            if cameraID:
-                heading = img_archive.getHeading(cameraID)
-            fov = img_archive.getApproxCameraFov(cameraID)
-        else: # regular (non diff mode), grab image and process
-            (cameraID, heading, timestamp, fov, imgPath) = getNextImage(dbManager, cameras, stateless, counterName)
-            classifyImgPath = imgPath
-        if not cameraID:
+        frames = []
+        for i in range(batchSize):
+            frame = fetchFrame(constants, stateless, counterName, useArchivedImages, startTimeDT, timeRangeSeconds)
+            if frame:
+                frames.append(frame)
+        if len(frames) == 0:
             continue # skip to next camera
         timeFetch = time.time()
 
-        image_spec = [{}]
-        image_spec[-1]['path'] = classifyImgPath
-        image_spec[-1]['timestamp'] = timestamp
-        image_spec[-1]['cameraID'] = cameraID
-        image_spec[-1]['heading'] = heading
-        if cameraID in usableRegions:
-            usableEntry = usableRegions[cameraID]
-            if 'startY' in usableEntry:
-                image_spec[-1]['startY'] = usableEntry['startY']
-            if 'endY' in usableEntry:
-                image_spec[-1]['endY'] = usableEntry['endY']
-        # ignore top and bottom 50 (cloud, metadata, too nearby)
-        if ('startY' not in image_spec[-1]) or not image_spec[-1]['startY']:
-            image_spec[-1]['startY'] = 50
-        if ('endY' not in image_spec[-1]) or not image_spec[-1]['endY']:
-            image_spec[-1]['endY'] = -50
-
-        detectionResult = detectionPolicy.detect(image_spec, checkShifts=True,
-                            fetchDiff=lambda x: fetchDiffImage(constants, cameraID, heading, timestamp, classifyImgPath, x))
+        image_specs = [getImageSpec(frame, usableRegions) for frame in frames]
+        fetchDiffs = [getFetchDiffFn(constants, frame) for frame in frames]
+        detectionResults = detectBatch(detectionPolicy, image_specs, fetchDiffs)
         timeDetect = time.time()
-        numImages += 1
-        fireSegment = detectionResult['fireSegment']
-        if fireSegment:
-            numProbables += 1
-        if fireSegment and not useArchivedImages:
-            recordProbables(dbManager, cameraID, heading, timestamp, imgPath, fireSegment, detectionPolicy.modelId, stateless, protoNum)
-            if not (isDuplicateProbables(dbManager, cameraID, heading, timestamp, protoNum) or stateless):
-                fireDetected(constants, cameraID, heading, timestamp, fov, imgPath, fireSegment)
-                numAlerts += 1
-        if not stateless and not protoNum:
-            img_archive.markImageProcessed(dbManager, cameraID, heading, timestamp)
-        deleteImageFiles(classifyImgPath, imgPath)
+        reachedLimit = False
+        for (frame, detectionResult) in zip(frames, detectionResults):
+            numImages += 1
+            (isProbable, isAlert) = postProcessFrame(constants, frame, detectionResult, detectionPolicy.modelId,
+                                                     stateless, useArchivedImages)
+            numProbables += int(isProbable)
+            numAlerts += int(isAlert)
+            if (numImages % 10) == 0:
+                logging.warning('Stats: alerts=%d, detects=%d, images=%d', numAlerts, numProbables, numImages)
+                reachedLimit = reachedLimit or (numImages >= limitImages)
         if (args.heartbeat):
             heartBeat(args.heartbeat)
 
         timePost = time.time()
-        updateTimeTracker(processingTimeTracker, timePost - timeStart)
+        updateTimeTracker(processingTimeTracker, (timePost - timeStart) / len(frames))
         if args.time:
-            if not detectionResult['timeMid']:
-                detectionResult['timeMid'] = timeDetect
-            logging.warning('Timings: fetch=%.2f, detect0=%.2f, detect1=%.2f post=%.2f',
-                timeFetch-timeStart, detectionResult['timeMid']-timeFetch, timeDetect-detectionResult['timeMid'], timePost-timeDetect)
-        if (numImages % 10) == 0:
-            logging.warning('Stats: alerts=%d, detects=%d, images=%d', numAlerts, numProbables, numImages)
-            if numImages >= limitImages:
-                logging.warning('Reached limit on images')
-                return
+            timeMid = detectionResults[0]['timeMid'] or timeDetect
+            logging.warning('Timings (%d images): fetch=%.2f, detect0=%.2f, detect1=%.2f post=%.2f', len(frames),
+                timeFetch-timeStart, timeMid-timeFetch, timeDetect-timeMid, timePost-timeDetect)
+        if reachedLimit:
+            logging.warning('Reached limit on images')
+            return
         # free all memory for current iteration and trigger GC to prevent memory growth
-        detectionResult = None
+        detectionResults = None
         gc.collect()
 
 if __name__=="__main__":